@@ -9,6 +9,17 @@ function check_new_kernel() {
     fi
 }
 
+function configure_yum_proxy() {
+    local PROXY_URL=$1
+    /usr/bin/sed -i '/^proxy=/d' /etc/yum.conf
+    if [ -n "$PROXY_URL" ]; then
+        # yum connects directly if the proxy is not reachable. The proxy
+        # itself is checked, bypassing any proxy set in the environment
+        /usr/bin/curl --silent --fail --noproxy '*' --max-time 10 --output /dev/null "$PROXY_URL" || return 1
+        /usr/bin/sed -i "/^\[main\]/a proxy=$PROXY_URL" /etc/yum.conf
+    fi
+}
+
 function check_nova_service_up() {
     local host_name=$1
     local service_name=${2-"nova-compute"}
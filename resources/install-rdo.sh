@@ -231,189 +231,250 @@ function download_centos_kernel_image() {
     exec_with_retry 5 0 rpm -ivh --oldpackage "$CENTOS_KERNEL_TMP_FILE" > /dev/null
 }
 
-rdo_cleanup
+function phase_cleanup() {
+    rdo_cleanup
+}
 
-ADMIN_PASSWORD=$1
-FIP_RANGE=$2
-FIP_RANGE_START=$3
-FIP_RANGE_END=$4
-FIP_RANGE_GATEWAY=$5
-FIP_RANGE_NAME_SERVERS=${@:6}
+function phase_network() {
+    if [ "$MGMT_IFACE" == "$MGMT_EXT_IFACE" ]
+    then
+        disable_network_manager
+    fi
 
-RDO_RELEASE="newton"
-RDO_RELEASE_RPM_URL=https://rdoproject.org/repos/rdo-release.rpm
-DASHBOARD_THEME_URL=https://github.com/cloudbase/openstack-dashboard-cloudbase-theme/releases/download/10.0.0/openstack-dashboard-cloudbase-theme-10.0.0-0.noarch.rpm
-CIRROS_URL=https://www.cloudbase.it/downloads/cirros-0.3.4-x86_64.vhdx.gz
-CENTOS_KERNEL_RPM_URL=http://vault.centos.org/7.3.1611/updates/x86_64/Packages/kernel-3.10.0-514.6.2.el7.x86_64.rpm
-ANSWER_FILE=packstack-answers.txt
-DATA_IFACE=data
-EXT_IFACE=ext
-OVS_DATA_BRIDGE=br-data
-OVS_EXT_BRIDGE=br-ex
-NTP_HOSTS=0.pool.ntp.org,1.pool.ntp.org,2.pool.ntp.org,3.pool.ntp.org
-# NOTE: use the default key path as otherwise packstack asks for the user's
-# password when ssh-ing into the localhost
-# TODO: check if we can use ssh-add
-SSH_KEY_PATH=~/.ssh/id_rsa
-MGMT_ZONE=management
-MGMT_EXT_IFACE=mgmt-ext
-MGMT_INT_IFACE=mgmt-int
+    set_interface_static_ipv4_from_dhcp $MGMT_INT_IFACE $MGMT_ZONE
+    /usr/sbin/ifup $MGMT_IFACE
+    config_ovs_network_adapter $DATA_IFACE
+    /usr/sbin/ifup $DATA_IFACE
+    config_ovs_network_adapter $EXT_IFACE
+    /usr/sbin/ifup $EXT_IFACE
 
-if [ $(grep 'BOOTPROTO="none"' /etc/sysconfig/network-scripts/ifcfg-$MGMT_EXT_IFACE) ]
-then
-    MGMT_IFACE=$MGMT_EXT_IFACE
-    disable_network_manager
-else
-    MGMT_IFACE=$MGMT_INT_IFACE
-fi
+    read HOST_IP NETMASK_BITS BCAST  <<< `get_interface_ipv4 $MGMT_IFACE`
+    add_hostname_to_hosts $HOST_IP $(hostname)
+}
 
-set_interface_static_ipv4_from_dhcp $MGMT_INT_IFACE $MGMT_ZONE
-/usr/sbin/ifup $MGMT_IFACE
-config_ovs_network_adapter $DATA_IFACE
-/usr/sbin/ifup $DATA_IFACE
-config_ovs_network_adapter $EXT_IFACE
-/usr/sbin/ifup $EXT_IFACE
+function phase_packages() {
+    exec_with_retry 5 0 /usr/bin/yum update -y
+    exec_with_retry 5 0 /usr/bin/yum install -y ntpdate
 
-read HOST_IP NETMASK_BITS BCAST  <<< `get_interface_ipv4 $MGMT_IFACE`
-add_hostname_to_hosts $HOST_IP $(hostname)
+    if [ $http_proxy ]
+    then
+        # packstack fails when accessing Keystone otherwise
+        grep -q "^no_proxy=.*,$HOST_IP\$" /etc/environment || \
+            /usr/bin/sed -i '/^no_proxy=.*$/s/$/,'$HOST_IP'/' /etc/environment
+    fi
 
-exec_with_retry 5 0 /usr/bin/yum update -y
-exec_with_retry 5 0 /usr/bin/yum install -y ntpdate
+    rm -f $SKIP_NTP_CONFIG_PATH
+    exec_with_retry 5 0 /sbin/ntpdate pool.ntp.org || {
+        touch $SKIP_NTP_CONFIG_PATH
+        >&2 echo "ntpdate failed, make sure the NTP server is available"
+    }
 
-if [ $http_proxy ]
-then
-    # packstack fails when accessing Keystone otherwise
-    /usr/bin/sed -i '/^no_proxy=.*$/s/$/,'$HOST_IP'/' /etc/environment
-    export no_proxy=$no_proxy,$HOST_IP
-fi
+    exec_with_retry 5 0 /usr/bin/yum install -y centos-release-openstack-$RDO_RELEASE yum-utils
+    # Disabling due to 404 errors on the repo url
+    /usr/bin/yum-config-manager --disable centos-ceph-jewel
+
+    exec_with_retry 5 0 /usr/bin/yum update -y
+
+    exec_with_retry 5 0 /usr/bin/yum install -y openstack-packstack openstack-utils
+}
 
-SKIP_NTP_CONFIG=""
-exec_with_retry 5 0 /sbin/ntpdate pool.ntp.org || SKIP_NTP_CONFIG=1 && >&2 echo "ntpdate failed, make sure the NTP server is available"
+function phase_cirros_image() {
+    download_cirros_image "$CIRROS_URL" "$CIRROS_IMAGE_PATH"
+}
 
-exec_with_retry 5 0 /usr/bin/yum install -y centos-release-openstack-$RDO_RELEASE yum-utils
-# Disabling due to 404 errors on the repo url
-/usr/bin/yum-config-manager --disable centos-ceph-jewel
+function phase_answer_file() {
+    generate_ssh_key $SSH_KEY_PATH
 
-exec_with_retry 5 0 /usr/bin/yum update -y
+    /usr/bin/packstack --gen-answer-file=$ANSWER_FILE
 
-exec_with_retry 5 0 /usr/bin/yum install -y openstack-packstack openstack-utils
+    if [ "$(get_total_memory_mb)" -lt "8196" ]
+    then
+        # Reduce number of workers to save memory
+        MAX_SERVICE_WORKERS=2
+    else
+        # Don't exceed 4
+        MAX_SERVICE_WORKERS=4
+    fi
 
-CIRROS_TMP_FILE=$(/usr/bin/mktemp)
-download_cirros_image "$CIRROS_URL" "$CIRROS_TMP_FILE"
+    NPROC=$(/usr/bin/nproc)
+    SERVICE_WORKERS=$(($NPROC<$MAX_SERVICE_WORKERS?$NPROC:$MAX_SERVICE_WORKERS))
+    openstack-config --set $ANSWER_FILE general CONFIG_SERVICE_WORKERS $SERVICE_WORKERS
 
-generate_ssh_key $SSH_KEY_PATH
+    openstack-config --set $ANSWER_FILE general CONFIG_CONTROLLER_HOST $HOST_IP
+    openstack-config --set $ANSWER_FILE general CONFIG_COMPUTE_HOSTS $HOST_IP
+    openstack-config --set $ANSWER_FILE general CONFIG_NETWORK_HOSTS $HOST_IP
+    openstack-config --set $ANSWER_FILE general CONFIG_STORAGE_HOST $HOST_IP
+    openstack-config --set $ANSWER_FILE general CONFIG_AMQP_HOST $HOST_IP
+    openstack-config --set $ANSWER_FILE general CONFIG_MARIADB_HOST $HOST_IP
+    openstack-config --set $ANSWER_FILE general CONFIG_MONGODB_HOST $HOST_IP
 
-/usr/bin/packstack --gen-answer-file=$ANSWER_FILE
+    openstack-config --set $ANSWER_FILE general CONFIG_USE_EPEL n
+    openstack-config --set $ANSWER_FILE general CONFIG_HEAT_INSTALL y
 
-if [ "$(get_total_memory_mb)" -lt "8196" ]
-then
-    # Reduce number of workers to save memory
-    MAX_SERVICE_WORKERS=2
-else
-    # Don't exceed 4
-    MAX_SERVICE_WORKERS=4
-fi
+    openstack-config --set $ANSWER_FILE general CONFIG_PROVISION_TEMPEST n
+
+    openstack-config --set $ANSWER_FILE general CONFIG_CEILOMETER_INSTALL n
 
-NPROC=$(/usr/bin/nproc)
-SERVICE_WORKERS=$(($NPROC<$MAX_SERVICE_WORKERS?$NPROC:$MAX_SERVICE_WORKERS))
-openstack-config --set $ANSWER_FILE general CONFIG_SERVICE_WORKERS $SERVICE_WORKERS
+    openstack-config --set $ANSWER_FILE general CONFIG_NOVA_NETWORK_PUBIF $EXT_IFACE
+    openstack-config --set $ANSWER_FILE general CONFIG_NEUTRON_ML2_TYPE_DRIVERS vlan
+    openstack-config --set $ANSWER_FILE general CONFIG_NEUTRON_ML2_TENANT_NETWORK_TYPES vlan
+    openstack-config --set $ANSWER_FILE general CONFIG_NEUTRON_ML2_MECHANISM_DRIVERS openvswitch,hyperv
+    openstack-config --set $ANSWER_FILE general CONFIG_NEUTRON_ML2_VLAN_RANGES physnet1:500:2000
+    openstack-config --set $ANSWER_FILE general CONFIG_NEUTRON_OVS_BRIDGE_MAPPINGS physnet1:$OVS_DATA_BRIDGE
+    openstack-config --set $ANSWER_FILE general CONFIG_PROVISION_OVS_BRIDGE n
+    #openstack-config --set $ANSWER_FILE general CONFIG_NEUTRON_OVS_BRIDGE_IFACES $OVS_DATA_BRIDGE:$DATA_IFACE
 
-openstack-config --set $ANSWER_FILE general CONFIG_CONTROLLER_HOST $HOST_IP
-openstack-config --set $ANSWER_FILE general CONFIG_COMPUTE_HOSTS $HOST_IP
-openstack-config --set $ANSWER_FILE general CONFIG_NETWORK_HOSTS $HOST_IP
-openstack-config --set $ANSWER_FILE general CONFIG_STORAGE_HOST $HOST_IP
-openstack-config --set $ANSWER_FILE general CONFIG_AMQP_HOST $HOST_IP
-openstack-config --set $ANSWER_FILE general CONFIG_MARIADB_HOST $HOST_IP
-openstack-config --set $ANSWER_FILE general CONFIG_MONGODB_HOST $HOST_IP
+    if [ ! -f $SKIP_NTP_CONFIG_PATH ]
+    then
+        openstack-config --set $ANSWER_FILE general CONFIG_NTP_SERVERS $NTP_HOSTS
+    fi
 
-openstack-config --set $ANSWER_FILE general CONFIG_USE_EPEL n
-openstack-config --set $ANSWER_FILE general CONFIG_HEAT_INSTALL y
+    openstack-config --set $ANSWER_FILE general CONFIG_SSH_KEY "$SSH_KEY_PATH.pub"
 
-openstack-config --set $ANSWER_FILE general CONFIG_PROVISION_TEMPEST n
+    openstack-config --set $ANSWER_FILE general CONFIG_KEYSTONE_ADMIN_PW "$ADMIN_PASSWORD"
+    openstack-config --set $ANSWER_FILE general CONFIG_KEYSTONE_DEMO_PW "$ADMIN_PASSWORD"
 
-openstack-config --set $ANSWER_FILE general CONFIG_CEILOMETER_INSTALL n
+    openstack-config --set $ANSWER_FILE general CONFIG_PROVISION_DEMO_FLOATRANGE $FIP_RANGE
 
-openstack-config --set $ANSWER_FILE general CONFIG_NOVA_NETWORK_PUBIF $EXT_IFACE
-openstack-config --set $ANSWER_FILE general CONFIG_NEUTRON_ML2_TYPE_DRIVERS vlan
-openstack-config --set $ANSWER_FILE general CONFIG_NEUTRON_ML2_TENANT_NETWORK_TYPES vlan
-openstack-config --set $ANSWER_FILE general CONFIG_NEUTRON_ML2_MECHANISM_DRIVERS openvswitch,hyperv
-openstack-config --set $ANSWER_FILE general CONFIG_NEUTRON_ML2_VLAN_RANGES physnet1:500:2000
-openstack-config --set $ANSWER_FILE general CONFIG_NEUTRON_OVS_BRIDGE_MAPPINGS physnet1:$OVS_DATA_BRIDGE
-openstack-config --set $ANSWER_FILE general CONFIG_PROVISION_OVS_BRIDGE n
-#openstack-config --set $ANSWER_FILE general CONFIG_NEUTRON_OVS_BRIDGE_IFACES $OVS_DATA_BRIDGE:$DATA_IFACE
+    openstack-config --set $ANSWER_FILE general CONFIG_NAGIOS_INSTALL n
 
-if [ ! $SKIP_NTP_CONFIG ]
-then
-    openstack-config --set $ANSWER_FILE general CONFIG_NTP_SERVERS $NTP_HOSTS
-fi
+    openstack-config --set $ANSWER_FILE general CONFIG_PROVISION_IMAGE_URL "$CIRROS_IMAGE_PATH"
+    openstack-config --set $ANSWER_FILE general CONFIG_PROVISION_IMAGE_FORMAT vhd
+}
 
-openstack-config --set $ANSWER_FILE general CONFIG_SSH_KEY "$SSH_KEY_PATH.pub"
+function phase_openvswitch() {
+    exec_with_retry 5 0 /usr/bin/yum install -y openvswitch
+    /bin/systemctl start openvswitch.service
 
-openstack-config --set $ANSWER_FILE general CONFIG_KEYSTONE_ADMIN_PW "$ADMIN_PASSWORD"
-openstack-config --set $ANSWER_FILE general CONFIG_KEYSTONE_DEMO_PW "$ADMIN_PASSWORD"
+    if ovs_bridge_exists $OVS_DATA_BRIDGE
+    then
+        /usr/bin/ovs-vsctl del-br $OVS_DATA_BRIDGE
+    fi
 
-openstack-config --set $ANSWER_FILE general CONFIG_PROVISION_DEMO_FLOATRANGE $FIP_RANGE
+    /usr/bin/ovs-vsctl add-br $OVS_DATA_BRIDGE
+    /usr/bin/ovs-vsctl add-port $OVS_DATA_BRIDGE $DATA_IFACE
 
-openstack-config --set $ANSWER_FILE general CONFIG_NAGIOS_INSTALL n
+    if ovs_bridge_exists $OVS_EXT_BRIDGE
+    then
+        /usr/bin/ovs-vsctl del-br $OVS_EXT_BRIDGE
+    fi
 
-openstack-config --set $ANSWER_FILE general CONFIG_PROVISION_IMAGE_URL "$CIRROS_TMP_FILE"
-openstack-config --set $ANSWER_FILE general CONFIG_PROVISION_IMAGE_FORMAT vhd
+    /usr/bin/ovs-vsctl add-br $OVS_EXT_BRIDGE
+    /usr/bin/ovs-vsctl add-port $OVS_EXT_BRIDGE $EXT_IFACE
+}
 
-exec_with_retry 5 0 /usr/bin/yum install -y openvswitch
-/bin/systemctl start openvswitch.service
+function phase_packstack() {
+    # Install common Python modules to avoid conflicts in Packstack
+    exec_with_retry 5 0 /usr/bin/yum install -y python-pip python-cmd2 python-requests python-netifaces
 
-if ovs_bridge_exists $OVS_DATA_BRIDGE
-then
-    /usr/bin/ovs-vsctl del-br $OVS_DATA_BRIDGE
-fi
+    exec_with_retry 5 0 /bin/pip install "networking-hyperv>=2.0.0,<3.0.0"
 
-/usr/bin/ovs-vsctl add-br $OVS_DATA_BRIDGE
-/usr/bin/ovs-vsctl add-port $OVS_DATA_BRIDGE $DATA_IFACE
+    exec_with_retry 5 0 /usr/bin/packstack --answer-file=$ANSWER_FILE
 
-if ovs_bridge_exists $OVS_EXT_BRIDGE
-then
-    /usr/bin/ovs-vsctl del-br $OVS_EXT_BRIDGE
-fi
+    rm "$CIRROS_IMAGE_PATH"
+}
 
-/usr/bin/ovs-vsctl add-br $OVS_EXT_BRIDGE
-/usr/bin/ovs-vsctl add-port $OVS_EXT_BRIDGE $EXT_IFACE
+function phase_post_config() {
+    export OS_USERNAME=admin
+    export OS_PASSWORD="$ADMIN_PASSWORD"
+    export OS_TENANT_NAME=admin
+    export OS_AUTH_URL="http://$HOST_IP:5000/v2.0"
+
+    remove_httpd_default_site
+    disable_nova_compute
+    fix_extension_drivers_port_security
+    fix_cinder_chap_length
+    fix_cinder_keystone_authtoken
+    configure_public_subnet
+    configure_private_subnet
+    create_nova_flavors
+    enable_horizon_password_retrieve
+
+    exec_with_retry 10 0 rpm -Uvh $DASHBOARD_THEME_URL > /dev/null
+}
 
-# Install common Python modules to avoid conflicts in Packstack
-exec_with_retry 5 0 /usr/bin/yum install -y python-pip python-cmd2 python-requests python-netifaces
+function phase_firewall() {
+    # TODO: limit access to: -i $MGMT_IFACE
+    /usr/sbin/iptables -I INPUT -p tcp --dport 3260 -j ACCEPT
+    /usr/sbin/iptables -I INPUT -p tcp --dport 5672 -j ACCEPT
+    /usr/sbin/iptables -I INPUT -p tcp --dport 9696 -j ACCEPT
+    /usr/sbin/iptables -I INPUT -p tcp --dport 9292 -j ACCEPT
+    /usr/sbin/iptables -I INPUT -p tcp --dport 8776 -j ACCEPT
+    /usr/sbin/service iptables save
+}
 
-exec_with_retry 5 0 /bin/pip install "networking-hyperv>=2.0.0,<3.0.0"
+function phase_kernel() {
+    # This is needed due to a bug in LIS with kernel-3.10.0-514.10.2.el7
+    CENTOS_KERNEL_TMP_FILE=$(/usr/bin/mktemp)
+    download_centos_kernel_image "$CENTOS_KERNEL_RPM_URL" "$CENTOS_KERNEL_TMP_FILE"
+}
 
-exec_with_retry 5 0 /usr/bin/packstack --answer-file=$ANSWER_FILE
+# The installation is split in phases, executed in order with a separate
+# invocation each. A marker is written for each completed phase, so that
+# retrying the installation skips them.
+PHASE=$1
+ADMIN_PASSWORD=$2
+FIP_RANGE=$3
+FIP_RANGE_START=$4
+FIP_RANGE_END=$5
+FIP_RANGE_GATEWAY=$6
+FIP_RANGE_NAME_SERVERS=${@:7}
+
+PHASES="cleanup network packages cirros_image answer_file openvswitch packstack post_config firewall kernel"
+STATE_DIR=/var/lib/v-magine
+PHASES_DIR=$STATE_DIR/phases
+CIRROS_IMAGE_PATH=$STATE_DIR/cirros.vhdx
+SKIP_NTP_CONFIG_PATH=$STATE_DIR/skip-ntp-config
 
-rm "$CIRROS_TMP_FILE"
+RDO_RELEASE="newton"
+RDO_RELEASE_RPM_URL=https://rdoproject.org/repos/rdo-release.rpm
+DASHBOARD_THEME_URL=https://github.com/cloudbase/openstack-dashboard-cloudbase-theme/releases/download/10.0.0/openstack-dashboard-cloudbase-theme-10.0.0-0.noarch.rpm
+CIRROS_URL=https://www.cloudbase.it/downloads/cirros-0.3.4-x86_64.vhdx.gz
+CENTOS_KERNEL_RPM_URL=http://vault.centos.org/7.3.1611/updates/x86_64/Packages/kernel-3.10.0-514.6.2.el7.x86_64.rpm
+ANSWER_FILE=packstack-answers.txt
+DATA_IFACE=data
+EXT_IFACE=ext
+OVS_DATA_BRIDGE=br-data
+OVS_EXT_BRIDGE=br-ex
+NTP_HOSTS=0.pool.ntp.org,1.pool.ntp.org,2.pool.ntp.org,3.pool.ntp.org
+# NOTE: use the default key path as otherwise packstack asks for the user's
+# password when ssh-ing into the localhost
+# TODO: check if we can use ssh-add
+SSH_KEY_PATH=~/.ssh/id_rsa
+MGMT_ZONE=management
+MGMT_EXT_IFACE=mgmt-ext
+MGMT_INT_IFACE=mgmt-int
+
+if [[ ! " $PHASES " =~ " $PHASE " ]]
+then
+    >&2 echo "Unknown phase: \"$PHASE\". Valid phases: $PHASES"
+    exit 2
+fi
+
+if [ -f "$PHASES_DIR/$PHASE.done" ]
+then
+    echo "Phase $PHASE already completed, skipping"
+    exit 0
+fi
 
-export OS_USERNAME=admin
-export OS_PASSWORD="$ADMIN_PASSWORD"
-export OS_TENANT_NAME=admin
-export OS_AUTH_URL="http://$HOST_IP:5000/v2.0"
+if [ $(grep 'BOOTPROTO="none"' /etc/sysconfig/network-scripts/ifcfg-$MGMT_EXT_IFACE) ]
+then
+    MGMT_IFACE=$MGMT_EXT_IFACE
+else
+    MGMT_IFACE=$MGMT_INT_IFACE
+fi
 
-remove_httpd_default_site
-disable_nova_compute
-fix_extension_drivers_port_security
-fix_cinder_chap_length
-fix_cinder_keystone_authtoken
-configure_public_subnet
-configure_private_subnet
-create_nova_flavors
-enable_horizon_password_retrieve
+read HOST_IP NETMASK_BITS BCAST  <<< `get_interface_ipv4 $MGMT_IFACE`
 
-exec_with_retry 10 0 rpm -Uvh $DASHBOARD_THEME_URL > /dev/null
+if [ $http_proxy ]
+then
+    export no_proxy=$no_proxy,$HOST_IP
+fi
 
-# TODO: limit access to: -i $MGMT_IFACE
-/usr/sbin/iptables -I INPUT -p tcp --dport 3260 -j ACCEPT
-/usr/sbin/iptables -I INPUT -p tcp --dport 5672 -j ACCEPT
-/usr/sbin/iptables -I INPUT -p tcp --dport 9696 -j ACCEPT
-/usr/sbin/iptables -I INPUT -p tcp --dport 9292 -j ACCEPT
-/usr/sbin/iptables -I INPUT -p tcp --dport 8776 -j ACCEPT
-/usr/sbin/service iptables save
+/bin/mkdir -p $PHASES_DIR
+cd /root
 
-# This is needed due to a bug in LIS with kernel-3.10.0-514.10.2.el7
-CENTOS_KERNEL_TMP_FILE=$(/usr/bin/mktemp)
-download_centos_kernel_image "$CENTOS_KERNEL_RPM_URL" "$CENTOS_KERNEL_TMP_FILE"
+phase_$PHASE
 
-echo "Done!"
+/bin/touch "$PHASES_DIR/$PHASE.done"
+echo "Phase $PHASE done!"
@@ -11,9 +11,12 @@ import sys
 from oslo_utils import units
 from six.moves.urllib import request
 
+from v_magine import compute
 from v_magine import config
 from v_magine import constants
+from v_magine import exceptions
 from v_magine import kickstart
+from v_magine import package_proxy
 from v_magine import pybootdmgr
 from v_magine import security
 from v_magine import utils
@@ -29,9 +32,13 @@ VSWITCH_INTERNAL_NAME = "%s-internal" % constants.PRODUCT_NAME
 VSWITCH_DATA_NAME = "%s-data" % constants.PRODUCT_NAME
 
 FIREWALL_PXE_RULE_NAME = "%s PXE" % constants.PRODUCT_NAME
+FIREWALL_PACKAGE_PROXY_RULE_NAME = ("%s package proxy" %
+                                    constants.PRODUCT_NAME)
 
 DHCP_PORT = 67
 TFTP_PORT = 69
+PACKAGE_PROXY_PORT = package_proxy.DEFAULT_PORT
+PACKAGE_CACHE_MAX_SIZE = 8 * units.Gi
 
 FREERDP_WEBCONNECT_SERVICE_USER = "FreeRDP-WebConnect"
 
@@ -56,6 +63,7 @@ HYPERV_MSI_URL = ("https://www.cloudbase.it/downloads/"
                   "HyperVNovaCompute_Newton_14_0_1.msi")
 FREERDP_WEBCONNECT_MSI_URL = ("https://www.cloudbase.it/downloads/"
                               "FreeRDPWebConnect.msi")
+MSI_FILE_SIGNATURE = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
 
 OPENSTACK_INSTANCES_DIR = "Instances"
 OPENSTACK_LOG_DIR = "Log"
@@ -64,20 +72,81 @@ CONTROLLER_SSH_KEY_NAME = "%s_controller_rsa" % constants.PRODUCT_NAME
 
 HYPERVISOR_TYPE_HYPERV = "Hyper-V"
 
+FORCE_REMOTE_COMPUTE_TRANSPORT_CONFIG_NAME = "force_remote_compute_transport"
+COMPUTE_HOSTS_CONFIG_NAME = "compute_hosts"
+SSH_COMPRESSION_CONFIG_NAME = "ssh_compression"
+
 
 class DeploymentActions(object):
 
     def __init__(self):
         self._pybootd_manager = pybootdmgr.PyBootdManager()
+        self._package_proxy = None
         self._virt_driver = virt_factory.get_virt_driver()
         self._windows_utils = windows.WindowsUtils()
         self._config = config.AppConfig()
         self._vm_name = None
 
-    def check_installed_components(self):
+    def get_compute_host_transport(self, host, username, password,
+                                   remote=False):
+        """Returns the transport used to deploy a compute host.
+
+        The remote transport is used for the local host as well if remote
+        is True or if forced in the configuration, e.g. to check it on a
+        single host.
+        """
+        remote = remote or bool(self._config.get_config_value(
+            FORCE_REMOTE_COMPUTE_TRANSPORT_CONFIG_NAME))
+        if compute.is_localhost(host) and not remote:
+            return compute.LocalComputeHostTransport(self._windows_utils)
+        return compute.RemoteComputeHostTransport(
+            self._windows_utils, host, username, password)
+
+    def get_ssh_compression(self):
+        """Returns True if the controller SSH traffic is compressed.
+
+        Compression helps on slow links, e.g. for a nested deployment,
+        and is disabled by default as the internal vswitch is fast.
+        """
+        return bool(self._config.get_config_value(
+            SSH_COMPRESSION_CONFIG_NAME))
+
+    def get_compute_hosts(self):
+        """Returns the compute hosts of the last deployment."""
+        return list(self._config.get_config_value(
+            COMPUTE_HOSTS_CONFIG_NAME, default=[compute.LOCALHOST]))
+
+    def set_compute_hosts(self, compute_hosts):
+        self._config.set_config_value(COMPUTE_HOSTS_CONFIG_NAME,
+                                      list(compute_hosts))
+
+    def validate_compute_hosts(self, compute_hosts, username, password):
+        """Checks that the remote compute hosts can be managed.
+
+        The credentials for the local host are validated separately with
+        validate_host_user.
+        """
+        for host in compute_hosts:
+            if compute.is_localhost(host):
+                continue
+            LOG.debug("Validating compute host: %s", host)
+            try:
+                transport = self.get_compute_host_transport(
+                    host, username, password)
+                try:
+                    transport.get_hostname()
+                finally:
+                    transport.close()
+            except Exception as ex:
+                LOG.exception(ex)
+                raise exceptions.BaseVMagineException(
+                    'Cannot connect to the compute host "%(host)s" as user '
+                    '"%(username)s": %(error)s' %
+                    {"host": host, "username": username, "error": ex})
+
+    def check_installed_components(self, transport):
         installed_products = []
-        products = self._windows_utils.get_installed_products(
-            HYPERV_MSI_VENDOR)
+        products = transport.get_installed_products(HYPERV_MSI_VENDOR)
         for (product_id, caption) in products:
             if (caption.startswith(HYPERV_MSI_CAPTION_PREFIX) or
                     caption.startswith(FREERDP_WEBCONNECT_CAPTION_PREFIX)):
@@ -107,16 +176,18 @@ class DeploymentActions(object):
         ssh_dir = security.get_user_ssh_dir()
         return os.path.join(ssh_dir, CONTROLLER_SSH_KEY_NAME)
 
-    def get_vm_ip_address(self, vm_name):
+    def get_vm_ip_addresses(self, vm_name):
         if self._virt_driver.vm_exists(vm_name):
             (ipv4_addresses,
              ipv6_addresses) = self._virt_driver.get_guest_ip_addresses(
                 vm_name)
+            return (ipv4_addresses or []) + (ipv6_addresses or [])
+        return []
 
-            if ipv4_addresses:
-                return ipv4_addresses[0]
-            elif ipv6_addresses:
-                return ipv6_addresses[0]
+    def get_vm_ip_address(self, vm_name):
+        ip_addresses = self.get_vm_ip_addresses(vm_name)
+        if ip_addresses:
+            return ip_addresses[0]
 
     @staticmethod
     def _get_powershell_encoded_cmd(cmd):
@@ -146,26 +217,49 @@ class DeploymentActions(object):
             self._get_powershell_path(), "-EncodedCommand %s" % encoded_cmd,
             new_console=True)
 
+    @staticmethod
+    def get_password_md5(password):
+        return security.get_password_md5(password)
+
+    @staticmethod
+    def get_console_named_pipe(vm_name):
+        return r"\\.\pipe\%s" % vm_name
+
     def generate_controller_ssh_key(self):
         key_path = self._get_controller_ssh_key_path()
         return security.generate_ssh_key(key_path)
 
-    def uninstall_product(self, product_id, log_file):
-        self._windows_utils.uninstall_product(product_id, log_file)
+    def uninstall_product(self, transport, product_id, log_file):
+        transport.uninstall_product(product_id, log_file)
+
+    @staticmethod
+    def _check_msi_file(msi_path):
+        # MSI packages are OLE compound documents
+        with open(msi_path, 'rb') as f:
+            header = f.read(len(MSI_FILE_SIGNATURE))
+        if header != MSI_FILE_SIGNATURE:
+            raise Exception("The downloaded file is not a valid MSI "
+                            "package: %s" % msi_path)
 
     @utils.retry_on_error()
-    def download_hyperv_compute_msi(self, target_path):
-        utils.download_file(HYPERV_MSI_URL, target_path)
+    def download_hyperv_compute_msi(self, target_path,
+                                    cancellation_token=None):
+        utils.download_file(HYPERV_MSI_URL, target_path,
+                            cancellation_token=cancellation_token)
+        self._check_msi_file(target_path)
 
     @utils.retry_on_error()
-    def download_freerdp_webconnect_msi(self, target_path):
-        utils.download_file(FREERDP_WEBCONNECT_MSI_URL, target_path)
+    def download_freerdp_webconnect_msi(self, target_path,
+                                        cancellation_token=None):
+        utils.download_file(FREERDP_WEBCONNECT_MSI_URL, target_path,
+                            cancellation_token=cancellation_token)
+        self._check_msi_file(target_path)
 
     @staticmethod
     def _get_keystone_v2_url(auth_url):
         return auth_url[:-2] + "v2.0" if auth_url.endswith("v3") else auth_url
 
-    def install_freerdp_webconnect(self, msi_path, nova_config,
+    def install_freerdp_webconnect(self, transport, msi_path, nova_config,
                                    hyperv_host_username,
                                    hyperv_host_password):
 
@@ -190,23 +284,23 @@ class DeploymentActions(object):
         properties["HYPERV_HOST_USERNAME"] = hyperv_host_username
         properties["HYPERV_HOST_PASSWORD"] = hyperv_host_password
 
-        LOG.info("Installing FreeRDP-WebConnect")
-        self._windows_utils.install_msi(msi_path, features, properties,
-                                        "freerdp_webconnect.log")
-        LOG.info("FreeRDP-WebConnect installed")
+        hostname = transport.get_hostname()
+        LOG.info("Installing FreeRDP-WebConnect on %s", hostname)
+        transport.install_msi(transport.put_file(msi_path), features,
+                              properties, "freerdp_webconnect.log")
+        LOG.info("FreeRDP-WebConnect installed on %s", hostname)
 
         LOG.info("Adding FreeRDP-WebConnect user to Remote Desktop Users")
         # This is needed on client OS
-        group_domain, group_name = self._windows_utils.get_group_by_sid(
+        transport.add_user_to_group_by_sid(
+            FREERDP_WEBCONNECT_SERVICE_USER,
             windows.GROUP_SID_REMOTE_DESKTOP_USERS)
-        self._windows_utils.add_user_to_local_group(
-            FREERDP_WEBCONNECT_SERVICE_USER, group_name)
 
-    def _check_username(self, username):
+    def _check_username(self, username, hostname):
         username = username.strip()
         if "\\" not in username:
             username = "%(host)s\\%(username)s" % {
-                "host": socket.gethostname(),
+                "host": hostname,
                 "username": username}
         return username
 
@@ -216,9 +310,10 @@ class DeploymentActions(object):
             self._windows_utils.run_safe_process(
                 sys.executable, "openurl %s" % url)
 
-    def install_hyperv_compute(self, msi_path, nova_config,
+    def install_hyperv_compute(self, transport, msi_path, nova_config,
                                openstack_base_dir, hyperv_host_username,
                                hyperv_host_password):
+        hostname = transport.get_hostname()
         instances_path = os.path.join(openstack_base_dir,
                                       OPENSTACK_INSTANCES_DIR)
         openstack_log_dir = os.path.join(openstack_base_dir, OPENSTACK_LOG_DIR)
@@ -244,7 +339,7 @@ class DeploymentActions(object):
         properties["LOGDIR"] = openstack_log_dir
 
         rdp_console_url = "http://%(host)s:%(port)d" % {
-            "host": socket.gethostname(),
+            "host": hostname,
             "port": FREERDP_WEBCONNECT_HTTP_PORT}
 
         properties["RDPCONSOLEURL"] = rdp_console_url
@@ -271,16 +366,15 @@ class DeploymentActions(object):
 
         if hyperv_host_username:
             properties["NOVACOMPUTESERVICEUSER"] = self._check_username(
-                hyperv_host_username)
+                hyperv_host_username, hostname)
             properties["NOVACOMPUTESERVICEPASSWORD"] = hyperv_host_password
 
-        if not os.path.exists(openstack_log_dir):
-            os.makedirs(openstack_log_dir)
+        transport.makedirs(openstack_log_dir)
 
-        LOG.info("Installing Nova compute")
-        self._windows_utils.install_msi(msi_path, features, properties,
-                                        "nova_install.log")
-        LOG.info("Nova compute installed")
+        LOG.info("Installing Nova compute on %s", hostname)
+        transport.install_msi(transport.put_file(msi_path), features,
+                              properties, "nova_install.log")
+        LOG.info("Nova compute installed on %s", hostname)
 
     @staticmethod
     def get_openstack_vm_recommended_vcpu_count():
@@ -345,6 +439,27 @@ class DeploymentActions(object):
     def stop_pxe_service(self):
         self._pybootd_manager.stop()
 
+    def start_package_proxy(self, listen_address, proxy_url, proxy_username,
+                            proxy_password):
+        self.stop_package_proxy()
+
+        store = package_proxy.PackageStore(utils.get_package_cache_dir(),
+                                           PACKAGE_CACHE_MAX_SIZE)
+        self._package_proxy = package_proxy.PackageProxy(
+            store, listen_address, PACKAGE_PROXY_PORT,
+            utils.add_credentials_to_url(
+                proxy_url, proxy_username, proxy_password))
+        self._package_proxy.start()
+        return self._package_proxy.get_url()
+
+    def stop_package_proxy(self):
+        if self._package_proxy:
+            self._package_proxy.stop()
+            self._package_proxy = None
+
+    def vm_exists(self, vm_name):
+        return self._virt_driver.vm_exists(vm_name)
+
     def check_remove_vm(self, vm_name):
         if self._virt_driver.vm_exists(vm_name):
             if not self._virt_driver.vm_is_stopped(vm_name):
@@ -447,7 +562,8 @@ class DeploymentActions(object):
                                data_mac_address, ext_mac_address, inst_repo,
                                ssh_pub_key_path, mgmt_ext_ip, mgmt_ext_netmask,
                                mgmt_ext_gateway, mgmt_ext_name_servers,
-                               proxy_url, proxy_username, proxy_password):
+                               proxy_url, proxy_username, proxy_password,
+                               yum_proxy_url):
         def _format_udev_mac(mac):
             return mac.lower().replace('-', ':')
 
@@ -474,7 +590,8 @@ class DeploymentActions(object):
              "mgmt_ext_gateway": mgmt_ext_gateway,
              "mgmt_ext_dns1": mgmt_ext_dns1,
              "mgmt_ext_dns2": mgmt_ext_dns2,
-             "proxy_url": proxy_url})
+             "proxy_url": proxy_url,
+             "yum_proxy_url": yum_proxy_url})
 
     def create_vswitches(self, external_vswitch_name, internal_network_config):
         virt_driver = virt_factory.get_virt_driver()
@@ -496,6 +613,9 @@ class DeploymentActions(object):
                                                    FIREWALL_PXE_RULE_NAME,
                                                    local_ports,
                                                    base_virt_driver.UDP)
+        virt_driver.add_vswitch_host_firewall_rule(
+            VSWITCH_INTERNAL_NAME, FIREWALL_PACKAGE_PROXY_RULE_NAME,
+            str(PACKAGE_PROXY_PORT), base_virt_driver.TCP)
 
         if not virt_driver.vswitch_exists(VSWITCH_DATA_NAME):
             virt_driver.create_vswitch(VSWITCH_DATA_NAME)
@@ -537,10 +657,24 @@ class DeploymentActions(object):
             raise Exception("Checking for product updates failed")
 
     def get_compute_nodes(self):
-        # TODO: return a list of hosts once multiple hosts will be supported
-        localhost_version_info = self._windows_utils.get_windows_version_info()
-        # TODO: return the actual host name once the UI allows longer names
-        localhost_version_info['hostname'] = "localhost"
-        # localhost_version_info['hostname'] = socket.gethostname()
-        localhost_version_info['hypervisor_type'] = HYPERVISOR_TYPE_HYPERV
-        return [localhost_version_info]
+        compute_nodes = []
+        for host in self.get_compute_hosts():
+            # The credentials are not stored, the remote hosts are queried
+            # as the current user
+            try:
+                transport = self.get_compute_host_transport(host, None, None)
+                try:
+                    version_info = transport.get_windows_version_info()
+                finally:
+                    transport.close()
+            except Exception as ex:
+                LOG.exception(ex)
+                version_info = {"description": "Not reachable",
+                                "version": None}
+            # TODO: return the actual host name once the UI allows longer
+            # names
+            version_info['hostname'] = (
+                compute.LOCALHOST if compute.is_localhost(host) else host)
+            version_info['hypervisor_type'] = HYPERVISOR_TYPE_HYPERV
+            compute_nodes.append(version_info)
+        return compute_nodes
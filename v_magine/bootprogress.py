@@ -0,0 +1,99 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import logging
+import re
+
+LOG = logging
+
+MAX_LINE_LENGTH = 1024
+
+# Phases of the controller VM installation in the order in which they are
+# expected on the console, with the completed fraction of the installation
+# when they start. Installing the packages takes most of the time
+PHASES = [
+    ("pxelinux", re.compile(br"Loading (vmlinuz|initrd\.img)"),
+     "Loading the installer", 0),
+    ("kernel", re.compile(br"Linux version "),
+     "Booting the installer", 0.02),
+    ("stage2", re.compile(br"stage2|install\.img|squashfs\.img"),
+     "Downloading the installer image", 0.05),
+    ("installer", re.compile(br"Starting installer"),
+     "Starting the installer", 0.12),
+    ("packages", re.compile(br"Starting package installation|"
+                            br"Installing software"),
+     "Installing packages", 0.2),
+    ("post_install", re.compile(br"Performing post-installation setup|"
+                                br"Running post-installation scripts"),
+     "Running the post-installation scripts", 0.92),
+]
+PACKAGES_PHASE = "packages"
+# e.g.: "Installing bash.x86_64 (12/297)" or "Installing 12/297"
+PACKAGE_COUNTER_REGEX = re.compile(br"Installing .*?\(?(\d+)/(\d+)\)?\s*$")
+
+LINE_SEPARATOR_REGEX = re.compile(br"[\r\n]")
+
+
+class BootProgressTracker(object):
+    """Estimates the controller VM installation progress from its console.
+
+    The console output is split in lines, recognizing the installation
+    phases and the counter of the installed packages. The callback is
+    called with the phase name, its description and the completed fraction
+    each time the fraction or the description change. The phases can only
+    move forward, unrecognized or out of order lines are ignored.
+    """
+    def __init__(self, callback):
+        self._callback = callback
+        self._line = b""
+        self._phase_index = -1
+        self._description = None
+        self._fraction = 0
+
+    def get_phase(self):
+        if self._phase_index >= 0:
+            return PHASES[self._phase_index][0]
+
+    def feed(self, data):
+        lines = LINE_SEPARATOR_REGEX.split(self._line + data)
+        # Lines longer than the maximum are truncated, as only their
+        # beginning is relevant
+        self._line = lines.pop()[:MAX_LINE_LENGTH]
+        for line in lines:
+            if line:
+                self._process_line(line[:MAX_LINE_LENGTH])
+
+    def _process_line(self, line):
+        for (index, (phase, regex, description,
+                     fraction)) in enumerate(PHASES):
+            if index > self._phase_index and regex.search(line):
+                LOG.debug("Controller installation phase: %s", phase)
+                self._phase_index = index
+                self._set_progress(description, fraction)
+                return
+
+        if self.get_phase() == PACKAGES_PHASE:
+            match = PACKAGE_COUNTER_REGEX.search(line)
+            if match:
+                (count, total) = [int(value) for value in match.groups()]
+                if 0 < count <= total:
+                    self._set_packages_progress(count, total)
+
+    def _set_packages_progress(self, count, total):
+        start = PHASES[self._phase_index][3]
+        end = PHASES[self._phase_index + 1][3]
+        self._set_progress(
+            "%(description)s (%(count)d/%(total)d)" %
+            {"description": PHASES[self._phase_index][2],
+             "count": count, "total": total},
+            start + (end - start) * count / float(total))
+
+    def _set_progress(self, description, fraction):
+        fraction = max(fraction, self._fraction)
+        if (description, fraction) == (self._description, self._fraction):
+            return
+
+        self._description = description
+        self._fraction = fraction
+        self._callback(self.get_phase(), description, fraction)
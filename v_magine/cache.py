@@ -0,0 +1,40 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import threading
+import time
+
+
+class TTLCache(object):
+    """Thread safe cache of values expiring after the given time.
+
+    Values are computed outside of the lock, so concurrent lookups of
+    different keys do not wait for each other. Failed computations are not
+    cached.
+    """
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def get(self, key, func):
+        with self._lock:
+            if key in self._values:
+                (value, expiration_time) = self._values[key]
+                if time.time() < expiration_time:
+                    return value
+                del self._values[key]
+
+        value = func()
+        with self._lock:
+            self._values[key] = (value, time.time() + self._ttl)
+        return value
+
+    def invalidate(self, key=None):
+        """Removes the given key or, if not specified, all the keys."""
+        with self._lock:
+            if key is None:
+                self._values = {}
+            else:
+                self._values.pop(key, None)
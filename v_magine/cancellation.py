@@ -0,0 +1,115 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import contextlib
+import logging
+import threading
+import time
+
+from v_magine import exceptions
+
+LOG = logging
+
+_active_token = None
+_local = threading.local()
+
+
+class CancellationToken(object):
+    """Signals the cancellation of an operation to the code executing it.
+
+    Blocking operations can either wait on the token or register a callback
+    releasing the blocked resource, e.g. closing a channel.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._next_handle = 0
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks = {}
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as ex:
+                LOG.exception(ex)
+
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise exceptions.CancelDeploymentException()
+
+    def wait(self, timeout):
+        """Sleeps for the given time, returns True if cancelled."""
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+    def sleep(self, timeout):
+        """Sleeps for the given time, raises if cancelled."""
+        self.wait(timeout)
+        self.check()
+
+    def register(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._next_handle += 1
+                self._callbacks[self._next_handle] = callback
+                return self._next_handle
+        callback()
+
+    def unregister(self, handle):
+        with self._lock:
+            self._callbacks.pop(handle, None)
+
+
+def set_active_token(token):
+    """Sets the token used by code not receiving one explicitly.
+
+    This is meant for the lower layers, like the retry decorator or the
+    WMI job polling, shared by all the deployment operations.
+    """
+    global _active_token
+    _active_token = token
+
+
+def get_active_token():
+    if getattr(_local, "detached", False):
+        return None
+    return _active_token
+
+
+@contextlib.contextmanager
+def detached():
+    """Ignores the active token in the current thread.
+
+    Used for cleanup operations, like removing the VM of a cancelled
+    deployment, which must not be interrupted by the cancellation itself.
+    """
+    _local.detached = True
+    try:
+        yield
+    finally:
+        _local.detached = False
+
+
+def check():
+    token = get_active_token()
+    if token:
+        token.check()
+
+
+def sleep(timeout, token=None):
+    token = token or get_active_token()
+    if token:
+        token.sleep(timeout)
+    else:
+        time.sleep(timeout)
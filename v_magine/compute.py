@@ -0,0 +1,357 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import argparse
+import logging
+import ntpath
+import os
+import socket
+import sys
+import threading
+
+from v_magine import cancellation
+from v_magine import exceptions
+
+LOG = logging
+
+LOCALHOST = "localhost"
+
+DEFAULT_MAX_PARALLEL_HOSTS = 8
+# Windows Installer does not allow concurrent installations
+DEFAULT_MAX_OPERATIONS_PER_HOST = 1
+
+REMOTE_PROCESS_POLL_INTERVAL_S = 2
+REMOTE_TEMP_DIR_NAME = "v-magine"
+
+
+def is_localhost(host):
+    return host.lower() in [LOCALHOST, "127.0.0.1", ".",
+                            socket.gethostname().lower()]
+
+
+class BaseComputeHostTransport(object):
+    """Performs the operations needed to deploy a Hyper-V compute host."""
+    def get_hostname(self):
+        raise NotImplementedError()
+
+    def get_windows_version_info(self):
+        raise NotImplementedError()
+
+    def makedirs(self, path):
+        raise NotImplementedError()
+
+    def put_file(self, local_path):
+        """Copies a file on the host, returns its path on the host."""
+        raise NotImplementedError()
+
+    def get_installed_products(self, vendor):
+        raise NotImplementedError()
+
+    def install_msi(self, msi_path, features, properties, log_file):
+        raise NotImplementedError()
+
+    def uninstall_product(self, product_id, log_file):
+        raise NotImplementedError()
+
+    def add_user_to_group_by_sid(self, username, group_sid):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class LocalComputeHostTransport(BaseComputeHostTransport):
+    def __init__(self, windows_utils):
+        self._windows_utils = windows_utils
+
+    def get_hostname(self):
+        return socket.gethostname()
+
+    def get_windows_version_info(self):
+        return self._windows_utils.get_windows_version_info()
+
+    def makedirs(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def put_file(self, local_path):
+        return local_path
+
+    def get_installed_products(self, vendor):
+        return self._windows_utils.get_installed_products(vendor)
+
+    def install_msi(self, msi_path, features, properties, log_file):
+        self._windows_utils.install_msi(msi_path, features, properties,
+                                        log_file)
+
+    def uninstall_product(self, product_id, log_file):
+        self._windows_utils.uninstall_product(product_id, log_file)
+
+    def add_user_to_group_by_sid(self, username, group_sid):
+        (group_domain,
+         group_name) = self._windows_utils.get_group_by_sid(group_sid)
+        self._windows_utils.add_user_to_local_group(username, group_name)
+
+
+class RemoteComputeHostTransport(BaseComputeHostTransport):
+    """Deploys a remote host through WMI and its administrative shares.
+
+    Commands are executed with WMI Win32_Process.Create in a batch file
+    writing the exit code to a file, as WMI does not provide it. The local
+    host can be used as a stand-in for a remote host, in which case the
+    credentials are ignored as WMI does not allow them for local
+    connections.
+    """
+    def __init__(self, windows_utils, host, username, password):
+        self._windows_utils = windows_utils
+        self._host = host
+        self._username = username
+        self._password = password
+
+        if is_localhost(host):
+            self._username = None
+            self._password = None
+        else:
+            windows_utils.connect_remote_host(host, username, password)
+
+        self._conn = windows_utils.get_wmi_conn(
+            host, self._username, self._password)
+        self._hostname = None
+        self._temp_dir = None
+        self._cmd_count = 0
+
+    def _get_unc_path(self, path):
+        (drive, rest) = ntpath.splitdrive(path)
+        return r"\\%(host)s\%(drive)s$%(rest)s" % {
+            "host": self._host, "drive": drive[0], "rest": rest}
+
+    def _get_temp_dir(self):
+        if not self._temp_dir:
+            windows_dir = self._windows_utils.get_windows_dir(self._conn)
+            self._temp_dir = ntpath.join(windows_dir, "Temp",
+                                         REMOTE_TEMP_DIR_NAME)
+            self.makedirs(self._temp_dir)
+        return self._temp_dir
+
+    def get_hostname(self):
+        if not self._hostname:
+            self._hostname = self._windows_utils.get_hostname(self._conn)
+        return self._hostname
+
+    def get_windows_version_info(self):
+        return self._windows_utils.get_windows_version_info(self._conn)
+
+    def makedirs(self, path):
+        unc_path = self._get_unc_path(path)
+        if not os.path.exists(unc_path):
+            os.makedirs(unc_path)
+
+    def put_file(self, local_path):
+        path = ntpath.join(self._get_temp_dir(),
+                           os.path.basename(local_path))
+        with open(local_path, 'rb') as src:
+            with open(self._get_unc_path(path), 'wb') as dst:
+                while True:
+                    cancellation.check()
+                    data = src.read(1024 * 1024)
+                    if not data:
+                        break
+                    dst.write(data)
+        return path
+
+    def _remove_files(self, paths):
+        for path in paths:
+            unc_path = self._get_unc_path(path)
+            try:
+                if os.path.exists(unc_path):
+                    os.remove(unc_path)
+            except Exception as ex:
+                LOG.exception(ex)
+                LOG.warn("Failed to remove %(path)s on host %(host)s",
+                         {"path": path, "host": self._host})
+
+    def _execute(self, cmd):
+        self._cmd_count += 1
+        base_path = ntpath.join(self._get_temp_dir(),
+                                "cmd%d" % self._cmd_count)
+        batch_path = "%s.cmd" % base_path
+        exit_code_path = "%s.exitcode" % base_path
+
+        # The batch file contains the credentials passed to the command
+        try:
+            # Parentheses are needed, as e.g. "echo 0> file" redirects
+            # stream 0 instead of writing the exit code
+            with open(self._get_unc_path(batch_path), 'wb') as f:
+                f.write(("@echo off\r\n%(cmd)s\r\n"
+                         "(echo %%ERRORLEVEL%%)>"
+                         "\"%(exit_code_path)s\"\r\n" %
+                         {"cmd": cmd.replace("%", "%%"),
+                          "exit_code_path": exit_code_path}).encode())
+
+            LOG.debug("Executing on %(host)s: %(cmd)s",
+                      {"host": self._host, "cmd": cmd})
+            pid = self._windows_utils.create_process(
+                self._conn, 'cmd.exe /c "%s"' % batch_path)
+            while self._windows_utils.is_process_running(self._conn, pid):
+                cancellation.sleep(REMOTE_PROCESS_POLL_INTERVAL_S)
+
+            with open(self._get_unc_path(exit_code_path), 'rb') as f:
+                exit_code = int(f.read().decode().strip())
+        finally:
+            self._remove_files([batch_path, exit_code_path])
+
+        if exit_code:
+            raise exceptions.BaseVMagineException(
+                "Command failed on host %(host)s with exit code "
+                "%(exit_code)d: %(cmd)s" %
+                {"host": self._host, "exit_code": exit_code, "cmd": cmd})
+
+    def get_installed_products(self, vendor):
+        return self._windows_utils.get_installed_products(vendor, self._conn)
+
+    def install_msi(self, msi_path, features, properties, log_file):
+        log_path = ntpath.join(self._get_temp_dir(), log_file)
+        # There's no interactive session to display the UI
+        self._execute(self._windows_utils.get_msi_install_cmd(
+            msi_path, features, properties, log_path, hidden=True))
+
+    def uninstall_product(self, product_id, log_file):
+        log_path = ntpath.join(self._get_temp_dir(), log_file)
+        self._execute(self._windows_utils.get_msi_uninstall_cmd(
+            product_id, log_path, hidden=True))
+
+    def add_user_to_group_by_sid(self, username, group_sid):
+        (group_domain, group_name) = self._windows_utils.get_group_by_sid(
+            group_sid, self._conn)
+        self._windows_utils.add_user_to_local_group(username, group_name,
+                                                    self._host)
+
+    def close(self):
+        if self._username:
+            self._windows_utils.disconnect_remote_host(self._host)
+
+
+class ComputeHostsRunner(object):
+    """Runs an operation on multiple compute hosts concurrently.
+
+    At most max_parallel_hosts hosts are processed at the same time and at
+    most max_operations_per_host operations run at the same time on each
+    host, including the ones started by other runs.
+    """
+    def __init__(self, max_parallel_hosts=DEFAULT_MAX_PARALLEL_HOSTS,
+                 max_operations_per_host=DEFAULT_MAX_OPERATIONS_PER_HOST):
+        self._hosts_semaphore = threading.BoundedSemaphore(
+            max_parallel_hosts)
+        self._max_operations_per_host = max_operations_per_host
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+
+    def _get_host_semaphore(self, host):
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(
+                    self._max_operations_per_host)
+            return self._host_semaphores[host]
+
+    def run(self, hosts, func, completed_callback=None):
+        """Calls func for each host.
+
+        completed_callback is called with the number of completed and total
+        hosts each time the operation completes on a host.
+        """
+        hosts = sorted(set(hosts), key=hosts.index)
+        errors = {}
+        completed = []
+
+        def _run_on_host(host):
+            try:
+                with self._hosts_semaphore, self._get_host_semaphore(host):
+                    cancellation.check()
+                    func(host)
+            except Exception as ex:
+                LOG.exception(ex)
+                errors[host] = ex
+
+            with self._lock:
+                completed.append(host)
+                completed_count = len(completed)
+            if completed_callback:
+                completed_callback(completed_count, len(hosts))
+
+        threads = []
+        for host in hosts:
+            thread = threading.Thread(target=_run_on_host, args=(host,),
+                                      name="ComputeHost-%s" % host)
+            thread.daemon = True
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        cancellation.check()
+        if len(errors) == 1 and len(hosts) == 1:
+            raise errors[hosts[0]]
+        if errors:
+            raise exceptions.ComputeHostsDeploymentException(
+                "The deployment failed on the following hosts: %s" %
+                "; ".join(["%(host)s: %(ex)s" % {"host": host,
+                                                  "ex": errors[host]}
+                           for host in hosts if host in errors]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Checks the execution of commands on a compute host "
+                    "through WMI, as done when deploying remote hosts")
+    parser.add_argument("--host", default=LOCALHOST,
+                        help="Host, the local host is used as a stand-in "
+                             "for a remote host")
+    parser.add_argument("--username")
+    parser.add_argument("--password")
+    parsed_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    # Imported here as it requires the Windows specific modules
+    from v_magine import windows
+
+    transport = RemoteComputeHostTransport(
+        windows.WindowsUtils(), parsed_args.host, parsed_args.username,
+        parsed_args.password)
+    failures = 0
+    try:
+        for exit_code in [0, 1, 9, 10, 1603]:
+            try:
+                transport._execute("exit /b %d" % exit_code)
+                result = 0
+            except exceptions.BaseVMagineException as ex:
+                LOG.info(ex)
+                result = exit_code
+            except Exception as ex:
+                LOG.exception(ex)
+                result = None
+
+            if result != exit_code:
+                failures += 1
+                LOG.error("Exit code %(exit_code)d, got: %(result)s",
+                          {"exit_code": exit_code, "result": result})
+
+        # The commands files must not be left on the host
+        temp_dir_unc_path = transport._get_unc_path(
+            transport._get_temp_dir())
+        leftovers = [name for name in os.listdir(temp_dir_unc_path)
+                     if name.startswith("cmd")]
+        if leftovers:
+            failures += 1
+            LOG.error("Command files left on the host: %s",
+                      ", ".join(leftovers))
+    finally:
+        transport.close()
+
+    LOG.info("Failed checks: %d", failures)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import collections
+import re
+
+DEFAULT_READ_SIZE = 64 * 1024
+
+
+class StreamMatcher(object):
+    """Aho-Corasick automaton finding byte patterns in a stream.
+
+    The automaton state is kept between chunks, so that matches split
+    across chunks are found. The transitions are computed in advance for
+    all the bytes, so each byte costs a single lookup, and the bytes which
+    cannot start a pattern are skipped while no match is in progress.
+    """
+    def __init__(self, patterns):
+        goto = [{}]
+        outputs = [[]]
+        for (index, pattern) in enumerate(patterns):
+            state = 0
+            for byte in bytearray(pattern):
+                if byte not in goto[state]:
+                    goto.append({})
+                    outputs.append([])
+                    goto[state][byte] = len(goto) - 1
+                state = goto[state][byte]
+            outputs[state].append(index)
+
+        fail = [0] * len(goto)
+        transitions = [None] * len(goto)
+        transitions[0] = [goto[0].get(byte, 0) for byte in range(256)]
+        queue = collections.deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            outputs[state] = outputs[state] + outputs[fail[state]]
+            state_transitions = list(transitions[fail[state]])
+            for (byte, next_state) in goto[state].items():
+                fail[next_state] = transitions[fail[state]][byte]
+                state_transitions[byte] = next_state
+                queue.append(next_state)
+            transitions[state] = state_transitions
+
+        self._transitions = transitions
+        self._outputs = outputs
+        self._start_regex = re.compile(b"[" + b"".join(
+            [re.escape(bytes(bytearray([byte]))) for byte in goto[0]]) +
+            b"]")
+        self._state = 0
+
+    def reset(self):
+        self._state = 0
+
+    def feed(self, data):
+        """Returns the (pattern index, end offset) of the matches in data."""
+        matches = []
+        state = self._state
+        transitions = self._transitions
+        outputs = self._outputs
+        data_bytes = bytearray(data)
+
+        offset = 0
+        size = len(data_bytes)
+        while offset < size:
+            if not state:
+                match = self._start_regex.search(data, offset)
+                if not match:
+                    break
+                offset = match.start()
+
+            state = transitions[state][data_bytes[offset]]
+            offset += 1
+            for index in outputs[state]:
+                matches.append((index, offset))
+
+        self._state = state
+        return matches
+
+
+class ConsoleReader(object):
+    """Reads a console stream in chunks, finding the registered patterns.
+
+    The patterns are provided as (pattern, event) tuples. Memory usage does
+    not depend on the console output, as only the matcher state is kept
+    between chunks.
+    """
+    def __init__(self, stream, patterns, read_size=DEFAULT_READ_SIZE):
+        self._stream = stream
+        self._read_size = read_size
+        self._events = [event for (pattern, event) in patterns]
+        self._matcher = StreamMatcher(
+            [pattern for (pattern, event) in patterns])
+
+    def read(self):
+        """Returns the next chunk and the events found in it.
+
+        The events are (event, end offset) tuples in the order in which the
+        patterns end in the chunk, the chunk is empty at the end of the
+        stream. The end offset of a pattern split across chunks is relative
+        to the chunk containing its last byte.
+        """
+        data = self._stream.read(self._read_size)
+        if not data:
+            return (b"", [])
+        return (data, [(self._events[index], end)
+                       for (index, end) in self._matcher.feed(data)])
@@ -41,3 +41,15 @@ class InvalidIPAddressException(BaseVMagineException):
 
 class InvalidUrlException(BaseVMagineException):
     pass
+
+
+class StepSchedulerException(BaseVMagineException):
+    pass
+
+
+class GuestNotReadyException(BaseVMagineException):
+    pass
+
+
+class ComputeHostsDeploymentException(BaseVMagineException):
+    pass
@@ -0,0 +1,118 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+LOG = logging
+
+STEP_STATUS_RUNNING = "running"
+STEP_STATUS_COMPLETED = "completed"
+STEP_STATUS_FAILED = "failed"
+
+# Left out of the fingerprint, as it is written to disk unsalted
+SECRET_INPUT_NAMES = ("admin_password", "hyperv_host_password",
+                      "proxy_password")
+
+
+def _json_default(obj):
+    if isinstance(obj, bytes):
+        return obj.decode()
+    # e.g. range objects
+    return list(obj)
+
+
+def get_fingerprint(inputs):
+    inputs = dict((name, value) for (name, value) in inputs.items()
+                  if name not in SECRET_INPUT_NAMES)
+    data = json.dumps(inputs, sort_keys=True, default=_json_default)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class DeploymentJournal(object):
+    """Persists the status and outputs of each deployment step.
+
+    The journal is bound to a fingerprint of the deployment inputs, a
+    journal with a different fingerprint is discarded when loaded.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._fingerprint = None
+        self._steps = {}
+
+    def load(self, fingerprint):
+        """Returns True if a journal matching the fingerprint was loaded."""
+        self._fingerprint = fingerprint
+        self._steps = {}
+
+        if os.path.exists(self._path):
+            try:
+                with open(self._path, 'rb') as f:
+                    data = json.loads(f.read().decode())
+                if data.get("fingerprint") == fingerprint:
+                    self._steps = data.get("steps", {})
+                    LOG.info("Deployment journal loaded, completed steps: %s",
+                             ", ".join(self.get_completed_steps()))
+                    return True
+                LOG.info("Deployment inputs changed, discarding journal")
+            except Exception as ex:
+                LOG.exception(ex)
+                LOG.warn("Invalid deployment journal, discarding it")
+
+        self._save()
+        return False
+
+    def reset(self):
+        self._steps = {}
+        self._save()
+
+    def clear(self):
+        self._steps = {}
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+    def _save(self):
+        data = json.dumps({"fingerprint": self._fingerprint,
+                           "steps": self._steps},
+                          sort_keys=True, indent=2, default=_json_default)
+
+        tmp_path = "%s.tmp" % self._path
+        with open(tmp_path, 'wb') as f:
+            f.write(data.encode())
+        # os.rename does not overwrite existing files on Windows
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        os.rename(tmp_path, self._path)
+
+    def _set_step_info(self, step_name, **kwargs):
+        step_info = self._steps.setdefault(step_name, {})
+        step_info.update(kwargs)
+        self._save()
+
+    def get_completed_steps(self):
+        return sorted([name for (name, step_info) in self._steps.items()
+                       if step_info.get("status") == STEP_STATUS_COMPLETED])
+
+    def is_step_completed(self, step_name):
+        return (self._steps.get(step_name, {}).get("status") ==
+                STEP_STATUS_COMPLETED)
+
+    def get_step_outputs(self, step_name):
+        return dict(self._steps.get(step_name, {}).get("outputs", {}))
+
+    def set_step_started(self, step_name):
+        self._set_step_info(step_name, status=STEP_STATUS_RUNNING,
+                            start_time=time.time(), end_time=None,
+                            error=None, outputs={})
+
+    def set_step_completed(self, step_name, outputs):
+        self._set_step_info(step_name, status=STEP_STATUS_COMPLETED,
+                            end_time=time.time(), outputs=outputs)
+
+    def set_step_failed(self, step_name, error):
+        self._set_step_info(step_name, status=STEP_STATUS_FAILED,
+                            end_time=time.time(), error=error)
@@ -0,0 +1,283 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import six
+from six.moves import queue
+
+LOG = logging
+
+ARCHIVE_DIR_NAME = "logs"
+INDEX_FILE_NAME = "index.json"
+
+DEFAULT_MAX_SEGMENT_SIZE = 16 * 1024 * 1024
+DEFAULT_MAX_SEGMENT_AGE_S = 24 * 60 * 60
+DEFAULT_MAX_ARCHIVE_SIZE = 256 * 1024 * 1024
+DEFAULT_MAX_QUEUE_SIZE = 16 * 1024
+# Interval for the segment age checks when no output is written
+AGE_CHECK_INTERVAL_S = 60
+
+DROPPED_RECORDS_MSG = "\n[%d log records dropped]\n"
+
+_CMD_WRITE = "write"
+_CMD_SET_DEPLOYMENT = "set_deployment"
+_CMD_FLUSH = "flush"
+_CMD_STOP = "stop"
+
+
+class _Segment(object):
+    def __init__(self, log_file, size, start_time):
+        self.log_file = log_file
+        self.size = size
+        self.start_time = start_time
+
+
+class LogStore(object):
+    """Writes logs asynchronously, archiving them in compressed segments.
+
+    Each log is written to "<name>.log" in log_dir by a single writer
+    thread, so write only queues the data and never blocks on the disk.
+    When the queue is full the data is dropped and a marker with the number
+    of dropped records is added to the log. A segment is rotated when it
+    exceeds max_segment_size or max_segment_age_s and when the deployment
+    ID changes, gzip compressed in the archive directory and added to its
+    index with the deployment ID. The oldest archived segments are removed
+    when the archive exceeds max_archive_size.
+    """
+    def __init__(self, log_dir, max_segment_size=DEFAULT_MAX_SEGMENT_SIZE,
+                 max_segment_age_s=DEFAULT_MAX_SEGMENT_AGE_S,
+                 max_archive_size=DEFAULT_MAX_ARCHIVE_SIZE,
+                 max_queue_size=DEFAULT_MAX_QUEUE_SIZE):
+        self._log_dir = log_dir
+        self._archive_dir = os.path.join(log_dir, ARCHIVE_DIR_NAME)
+        self._index_path = os.path.join(self._archive_dir, INDEX_FILE_NAME)
+        self._max_segment_size = max_segment_size
+        self._max_segment_age_s = max_segment_age_s
+        self._max_archive_size = max_archive_size
+
+        self._queue = queue.Queue(max_queue_size)
+        self._thread = None
+        self._segments = {}
+        self._deployment_id = None
+
+        self._dropped_lock = threading.Lock()
+        self._dropped = {}
+
+        self._index_lock = threading.Lock()
+        self._index = {"next_seq": 1, "segments": []}
+
+    def start(self):
+        if not os.path.isdir(self._archive_dir):
+            os.makedirs(self._archive_dir)
+        self._load_index()
+
+        self._thread = threading.Thread(target=self._run, name="LogStore")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the writer thread after writing the queued data."""
+        if not self._thread:
+            return
+
+        self._queue.put((_CMD_STOP,))
+        self._thread.join()
+        self._thread = None
+
+    def get_log_path(self, log_name):
+        return os.path.join(self._log_dir, "%s.log" % log_name)
+
+    def write(self, log_name, data):
+        if isinstance(data, six.text_type):
+            data = data.encode("utf-8")
+        try:
+            self._queue.put_nowait((_CMD_WRITE, log_name, data))
+        except queue.Full:
+            with self._dropped_lock:
+                self._dropped[log_name] = self._dropped.get(log_name, 0) + 1
+
+    def set_deployment_id(self, deployment_id):
+        """Rotates the current segments and tags the next ones."""
+        self._queue.put((_CMD_SET_DEPLOYMENT, deployment_id))
+
+    def flush(self, timeout=None):
+        """Waits for the data queued so far to be written."""
+        if not self._thread:
+            return
+        event = threading.Event()
+        self._queue.put((_CMD_FLUSH, event))
+        event.wait(timeout)
+
+    def get_segments(self, deployment_id=None, log_name=None):
+        """Returns the paths of the archived segments, oldest first."""
+        with self._index_lock:
+            return [os.path.join(self._archive_dir, segment["file"])
+                    for segment in self._index["segments"]
+                    if (deployment_id is None or
+                        segment["deployment_id"] == deployment_id) and
+                    (log_name is None or segment["log"] == log_name)]
+
+    def _load_index(self):
+        if not os.path.exists(self._index_path):
+            return
+        try:
+            with open(self._index_path, 'rb') as f:
+                index = json.loads(f.read().decode())
+            with self._index_lock:
+                self._index = index
+        except Exception as ex:
+            LOG.exception(ex)
+            LOG.warn("Invalid log archive index, discarding it")
+
+    def _save_index(self):
+        with self._index_lock:
+            data = json.dumps(self._index, sort_keys=True, indent=2)
+
+        tmp_path = "%s.tmp" % self._index_path
+        with open(tmp_path, 'wb') as f:
+            f.write(data.encode())
+        # os.rename does not overwrite existing files on Windows
+        if os.path.exists(self._index_path):
+            os.remove(self._index_path)
+        os.rename(tmp_path, self._index_path)
+
+    def _open_segment(self, log_name):
+        log_path = self.get_log_path(log_name)
+        # Left over by a previous run
+        if os.path.exists(log_path) and os.path.getsize(log_path):
+            self._archive(log_name, None, os.path.getmtime(log_path))
+
+        segment = _Segment(open(log_path, 'ab'), 0, time.time())
+        self._segments[log_name] = segment
+        return segment
+
+    def _rotate(self, log_name):
+        segment = self._segments.pop(log_name)
+        segment.log_file.close()
+        if segment.size:
+            self._archive(log_name, self._deployment_id, segment.start_time)
+
+    def _archive(self, log_name, deployment_id, start_time):
+        log_path = self.get_log_path(log_name)
+        with self._index_lock:
+            seq = self._index["next_seq"]
+            self._index["next_seq"] += 1
+        file_name = "%(log)s-%(deployment)s-%(seq)06d.log.gz" % {
+            "log": log_name, "deployment": deployment_id or "none",
+            "seq": seq}
+        path = os.path.join(self._archive_dir, file_name)
+
+        try:
+            with open(log_path, 'rb') as f_in:
+                with gzip.open("%s.tmp" % path, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+            os.rename("%s.tmp" % path, path)
+            raw_size = os.path.getsize(log_path)
+            os.remove(log_path)
+        except Exception as ex:
+            LOG.exception(ex)
+            LOG.error("Failed to archive log: %s", log_path)
+            return
+
+        with self._index_lock:
+            self._index["segments"].append(
+                {"file": file_name, "log": log_name,
+                 "deployment_id": deployment_id, "start_time": start_time,
+                 "end_time": time.time(), "raw_size": raw_size,
+                 "size": os.path.getsize(path)})
+        self._remove_old_segments()
+        self._save_index()
+
+    def _remove_old_segments(self):
+        with self._index_lock:
+            segments = self._index["segments"]
+            archive_size = sum(segment["size"] for segment in segments)
+            # The last segment is always kept
+            while archive_size > self._max_archive_size and len(segments) > 1:
+                segment = segments.pop(0)
+                archive_size -= segment["size"]
+                path = os.path.join(self._archive_dir, segment["file"])
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _write(self, log_name, data):
+        segment = self._segments.get(log_name)
+        if not segment:
+            segment = self._open_segment(log_name)
+
+        with self._dropped_lock:
+            dropped = self._dropped.pop(log_name, 0)
+        if dropped:
+            data = (DROPPED_RECORDS_MSG % dropped).encode() + data
+
+        segment.log_file.write(data)
+        segment.size += len(data)
+        if segment.size >= self._max_segment_size:
+            self._rotate(log_name)
+
+    def _rotate_old_segments(self):
+        now = time.time()
+        for (log_name, segment) in list(self._segments.items()):
+            if now - segment.start_time >= self._max_segment_age_s:
+                self._rotate(log_name)
+
+    def _flush_segments(self):
+        for segment in self._segments.values():
+            segment.log_file.flush()
+
+    def _process(self, cmd):
+        if cmd[0] == _CMD_WRITE:
+            self._write(*cmd[1:])
+        elif cmd[0] == _CMD_SET_DEPLOYMENT:
+            for log_name in list(self._segments):
+                self._rotate(log_name)
+            self._deployment_id = cmd[1]
+        elif cmd[0] == _CMD_FLUSH:
+            self._flush_segments()
+            cmd[1].set()
+
+    def _run(self):
+        while True:
+            try:
+                cmd = self._queue.get(timeout=AGE_CHECK_INTERVAL_S)
+            except queue.Empty:
+                self._rotate_old_segments()
+                continue
+
+            if cmd[0] == _CMD_STOP:
+                break
+            try:
+                self._process(cmd)
+                # The files are flushed once the queue is drained
+                if self._queue.empty():
+                    self._flush_segments()
+                    self._rotate_old_segments()
+            except Exception as ex:
+                LOG.exception(ex)
+
+        for segment in self._segments.values():
+            segment.log_file.close()
+        self._segments = {}
+
+
+class LogStoreHandler(logging.Handler):
+    """Logging handler writing the formatted records to a LogStore."""
+    def __init__(self, log_store, log_name):
+        super(LogStoreHandler, self).__init__()
+        self._log_store = log_store
+        self._log_name = log_name
+
+    def emit(self, record):
+        try:
+            self._log_store.write(self._log_name,
+                                  "%s\n" % self.format(record))
+        except Exception:
+            self.handleError(record)
@@ -11,7 +11,6 @@ import sys
 import threading
 import trollius
 
-from pybootd import daemons as pybootd_daemons
 from PyQt5 import QtCore
 from PyQt5 import QtGui
 from PyQt5 import QtWebKit
@@ -19,13 +18,18 @@ from PyQt5 import QtWidgets
 from PyQt5 import QtWebKitWidgets
 
 import v_magine  # noqa
+from v_magine import config
 from v_magine import constants
+from v_magine import logstore
+from v_magine import outputbus
 from v_magine import utils
 from v_magine import webbrowser
 from v_magine import worker as deployment_worker
 
 LOG = logging
 
+OUTPUT_FRAME_RATE_CONFIG_NAME = "output_frame_rate"
+
 
 class Controller(QtCore.QObject):
     on_stdout_data_event = QtCore.pyqtSignal(str)
@@ -61,6 +65,15 @@ class Controller(QtCore.QObject):
         self._splash_window = None
         self._progress_counter = 0
 
+        # The deployment output is delivered to the UI in frames, as a
+        # signal for each SSH or console chunk makes the UI unresponsive
+        self._output_bus = outputbus.OutputBus(
+            self._send_output_frame,
+            frame_rate=config.AppConfig().get_config_value(
+                OUTPUT_FRAME_RATE_CONFIG_NAME,
+                default=outputbus.DEFAULT_FRAME_RATE))
+        self._output_bus.start()
+
         self._worker.set_stdout_callback(self._send_stdout_data)
         self._worker.set_stderr_callback(self._send_stderr_data)
         self._worker.set_error_callback(self._error)
@@ -73,10 +86,23 @@ class Controller(QtCore.QObject):
     def set_splash_window(self, splash_window):
         self._splash_window = splash_window
 
-    def _progress_status_update(self, enable, step, total_steps, msg):
+    @staticmethod
+    def _format_progress_msg(msg, percentage, eta):
+        if eta >= 60:
+            eta_msg = "about %d minutes left" % round(eta / 60.0)
+        else:
+            eta_msg = "less than a minute left"
+        return "%(msg)s (%(percentage)d%%, %(eta_msg)s)" % {
+            "msg": msg, "percentage": percentage, "eta_msg": eta_msg}
+
+    def _progress_status_update(self, enable, step, total_steps, msg,
+                                percentage=None, eta=None):
         # TODO: synchronize this method
         send_update_event = False
 
+        if percentage is not None and eta is not None:
+            msg = self._format_progress_msg(msg, percentage, eta)
+
         if enable and not step:
             self._progress_counter += 1
             send_update_event = True
@@ -90,11 +116,17 @@ class Controller(QtCore.QObject):
             self.on_show_progress_status_event.emit(
                 enable, step, total_steps, msg)
 
+    def _send_output_frame(self, stream, data):
+        if stream == outputbus.STDERR:
+            self.on_stderr_data_event.emit(data)
+        else:
+            self.on_stdout_data_event.emit(data)
+
     def _send_stdout_data(self, data):
-        self.on_stdout_data_event.emit(data)
+        self._output_bus.write(outputbus.STDOUT, data)
 
     def _send_stderr_data(self, data):
-        self.on_stderr_data_event.emit(data)
+        self._output_bus.write(outputbus.STDERR, data)
 
     def _error(self, ex):
         self.on_error_event.emit(str(ex))
@@ -253,7 +285,8 @@ class Controller(QtCore.QObject):
         _run_async_task(
             lambda: self._worker.validate_host_config(
                 args.get("hyperv_host_username"),
-                args.get("hyperv_host_password")),
+                args.get("hyperv_host_password"),
+                args.get("compute_hosts")),
             _host_config_validated)
 
     @QtCore.pyqtSlot(str)
@@ -335,6 +368,7 @@ class Controller(QtCore.QObject):
 
     def _install_done(self, future):
         success = future.result()
+        LOG.info("Deployment output: %s", self._output_bus.get_metrics())
         self.on_install_done_event.emit(success)
         if success:
             self.show_deployment_details()
@@ -543,11 +577,17 @@ class QWebPageWithoutJsWarning(QtWebKitWidgets.QWebPage):
 def _config_logging(log_dir):
     log_format = ("%(asctime)-15s %(levelname)s %(module)s %(funcName)s "
                   "%(lineno)d %(thread)d %(threadName)s %(message)s")
-    log_file = os.path.join(log_dir, '%s.log' % constants.PRODUCT_NAME)
-    logging.basicConfig(filename=log_file, level=logging.DEBUG,
-                        format=log_format)
+    # The log files are written and rotated by the log store thread
+    log_store = logstore.LogStore(log_dir)
+    log_store.start()
+    handler = logstore.LogStoreHandler(log_store, constants.PRODUCT_NAME)
+    handler.setFormatter(logging.Formatter(log_format))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.DEBUG)
     logging.getLogger("paramiko").setLevel(logging.WARNING)
     logging.info("{0} - {1}".format(constants.PRODUCT_NAME, constants.VERSION))
+    return log_store
 
 
 def _create_splash_window(main_window):
@@ -564,15 +604,16 @@ def _create_splash_window(main_window):
 def main(url=None):
     app = QtWidgets.QApplication(sys.argv)
 
+    log_store = None
     if url:
         main_window = webbrowser.MainWindow(url)
         main_window.show()
     else:
         base_dir = utils.get_base_dir()
         os.chdir(base_dir)
-        _config_logging(base_dir)
+        log_store = _config_logging(base_dir)
 
-        controller = Controller(deployment_worker.Worker())
+        controller = Controller(deployment_worker.Worker(log_store=log_store))
 
         main_window = MainWindow(controller)
         splash = _create_splash_window(main_window)
@@ -590,6 +631,8 @@ def main(url=None):
     thread.join()
     loop.close()
 
+    if log_store:
+        log_store.stop()
     sys.exit(exit_code)
 
 
@@ -631,11 +674,7 @@ def _run_async_loop(loop):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1 and sys.argv[1] == 'pybootd':
-        del sys.argv[1]
-        pybootd_daemons.main()
+    if len(sys.argv) == 3 and sys.argv[1] == 'openurl':
+        main(sys.argv[2])
     else:
-        if len(sys.argv) == 3 and sys.argv[1] == 'openurl':
-            main(sys.argv[2])
-        else:
-            main()
+        main()
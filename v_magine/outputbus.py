@@ -0,0 +1,224 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import collections
+import logging
+import re
+import threading
+import time
+
+import six
+
+LOG = logging
+
+STDOUT = "stdout"
+STDERR = "stderr"
+
+DEFAULT_FRAME_RATE = 30
+MIN_FRAME_RATE = 1
+MAX_FRAME_RATE = 120
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024
+DEFAULT_MAX_BUFFER_SIZE = 1024 * 1024
+# Fraction of max_buffer_size kept when the buffer is full, so that the
+# buffer is not compacted again on each following write
+LOW_WATER_MARK = 0.75
+
+# Text followed by a carriage return and overwritten by the following text
+# on the same line, e.g. progress bars. Only the last update is displayed
+OVERWRITTEN_TEXT_REGEX = re.compile(r"(?:[^\r\n]*\r)+(?=[^\r\n])")
+
+DROPPED_OUTPUT_MSG = "\r\n[%d bytes of output dropped]\r\n"
+
+
+class _Chunk(object):
+    def __init__(self, stream, data, timestamp):
+        self.stream = stream
+        self.data = data
+        self.timestamp = timestamp
+
+
+class OutputBus(object):
+    """Coalesces output streams into frames delivered at a bounded rate.
+
+    The output written by any thread is buffered and delivered to the frame
+    callback, called with the stream and the data, at most frame_rate times
+    per second for each stream, with consecutive writes to the same stream
+    merged. At most max_frame_size bytes are delivered per frame. If the
+    buffered output exceeds max_buffer_size, the overwritten progress lines
+    are removed first and then the oldest output is dropped, down to a
+    fraction of max_buffer_size. Invalid frame rates are replaced by the
+    default one and the others are limited to a sane range.
+    """
+    def __init__(self, frame_callback, frame_rate=DEFAULT_FRAME_RATE,
+                 max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+                 max_buffer_size=DEFAULT_MAX_BUFFER_SIZE):
+        self._frame_callback = frame_callback
+        self._frame_interval = 1.0 / self._get_frame_rate(frame_rate)
+        self._max_frame_size = max_frame_size
+        self._max_buffer_size = max_buffer_size
+        self._low_water_size = int(max_buffer_size * LOW_WATER_MARK)
+
+        self._cond = threading.Condition()
+        self._chunks = collections.deque()
+        self._buffer_size = 0
+        self._dropped_size = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self._metrics_lock = threading.Lock()
+        self._metrics = {"bytes_in": 0, "bytes_out": 0, "frames": 0,
+                         "compacted_bytes": 0, "dropped_bytes": 0,
+                         "max_latency": 0, "total_latency": 0}
+
+    @staticmethod
+    def _get_frame_rate(frame_rate):
+        try:
+            frame_rate = float(frame_rate)
+        except (TypeError, ValueError):
+            frame_rate = None
+        # NaN values are not equal to themselves
+        if frame_rate is None or frame_rate != frame_rate:
+            LOG.warn("Invalid output frame rate, using the default one")
+            return DEFAULT_FRAME_RATE
+        return min(max(frame_rate, MIN_FRAME_RATE), MAX_FRAME_RATE)
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="OutputBus")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the bus after delivering the buffered output."""
+        if not self._thread:
+            return
+
+        with self._cond:
+            self._stopped.set()
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+
+    def write(self, stream, data):
+        if not data:
+            return
+        if isinstance(data, six.binary_type):
+            data = data.decode("utf-8", "replace")
+
+        with self._cond:
+            self._chunks.append(_Chunk(stream, data, time.time()))
+            self._buffer_size += len(data)
+            self._add_metrics(bytes_in=len(data))
+            if self._buffer_size > self._max_buffer_size:
+                self._compact()
+                self._drop()
+            self._cond.notify()
+
+    def _merge_chunks(self):
+        chunks = collections.deque()
+        for chunk in self._chunks:
+            if chunks and chunks[-1].stream == chunk.stream:
+                chunks[-1].data += chunk.data
+            else:
+                chunks.append(chunk)
+        self._chunks = chunks
+
+    def _compact(self):
+        self._merge_chunks()
+        size = 0
+        for chunk in self._chunks:
+            chunk.data = OVERWRITTEN_TEXT_REGEX.sub("\r", chunk.data)
+            size += len(chunk.data)
+        self._add_metrics(compacted_bytes=self._buffer_size - size)
+        self._buffer_size = size
+
+    def _drop(self):
+        total_dropped = 0
+        while self._buffer_size > self._low_water_size:
+            chunk = self._chunks[0]
+            excess = self._buffer_size - self._low_water_size
+            if len(chunk.data) > excess:
+                chunk.data = chunk.data[excess:]
+                dropped = excess
+            else:
+                self._chunks.popleft()
+                dropped = len(chunk.data)
+            self._buffer_size -= dropped
+            total_dropped += dropped
+        # Reported to the user with the next frame
+        self._dropped_size += total_dropped
+        self._add_metrics(dropped_bytes=total_dropped)
+
+    def _add_metrics(self, **kwargs):
+        with self._metrics_lock:
+            for (name, value) in kwargs.items():
+                self._metrics[name] += value
+
+    def get_metrics(self):
+        """Returns the output counters, latencies are in seconds."""
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        total_latency = metrics.pop("total_latency")
+        metrics["avg_latency"] = (total_latency / metrics["frames"]
+                                  if metrics["frames"] else 0)
+        return metrics
+
+    def _get_frame(self):
+        frame = []
+        frame_size = 0
+        timestamp = None
+        if self._dropped_size:
+            frame.append((STDOUT, DROPPED_OUTPUT_MSG % self._dropped_size))
+            self._dropped_size = 0
+
+        while self._chunks and frame_size < self._max_frame_size:
+            chunk = self._chunks[0]
+            data = chunk.data[:self._max_frame_size - frame_size]
+            if len(data) < len(chunk.data):
+                chunk.data = chunk.data[len(data):]
+            else:
+                self._chunks.popleft()
+            timestamp = timestamp or chunk.timestamp
+
+            if frame and frame[-1][0] == chunk.stream:
+                frame[-1] = (chunk.stream, frame[-1][1] + data)
+            else:
+                frame.append((chunk.stream, data))
+            frame_size += len(data)
+        self._buffer_size -= frame_size
+        return (frame, frame_size, timestamp)
+
+    def _deliver_frame(self):
+        with self._cond:
+            (frame, frame_size, timestamp) = self._get_frame()
+
+        for (stream, data) in frame:
+            try:
+                self._frame_callback(stream, data)
+            except Exception as ex:
+                LOG.exception(ex)
+
+        if timestamp:
+            latency = time.time() - timestamp
+            with self._metrics_lock:
+                self._metrics["bytes_out"] += frame_size
+                self._metrics["frames"] += 1
+                self._metrics["total_latency"] += latency
+                self._metrics["max_latency"] = max(
+                    self._metrics["max_latency"], latency)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._chunks and not self._stopped.is_set():
+                    self._cond.wait()
+                if not self._chunks:
+                    return
+
+            frame_time = time.time()
+            self._deliver_frame()
+            # Output written in the meantime is delivered with the next frame
+            if not self._stopped.is_set():
+                self._stopped.wait(max(
+                    0, frame_time + self._frame_interval - time.time()))
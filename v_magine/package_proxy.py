@@ -0,0 +1,596 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+"""Caching HTTP proxy for the packages downloaded by the controller VM.
+
+The proxy listens on the host address of the internal virtual switch and
+is used by yum on the controller VM, so that redeployments on the same host
+do not download the same packages again. It can be run against any HTTP
+repository, e.g. a local stand-in one:
+
+    python -m http.server 8000
+    python -m v_magine.package_proxy --cache-dir cache --port 3142
+    curl -x http://127.0.0.1:3142 http://127.0.0.1:8000/Packages/a.rpm
+"""
+
+import argparse
+import base64
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+from six.moves import http_client
+from six.moves import socketserver
+from six.moves.urllib import parse
+
+LOG = logging
+
+DEFAULT_PORT = 3142
+DEFAULT_MAX_CACHE_SIZE = 8 * 1024 * 1024 * 1024
+
+INDEX_FILE_NAME = "index.json"
+OBJECTS_DIR_NAME = "objects"
+TEMP_DIR_NAME = "tmp"
+
+UPSTREAM_TIMEOUT_S = 60
+COPY_BUFFER_SIZE = 64 * 1024
+TUNNEL_SELECT_TIMEOUT_S = 1
+
+# Packages and the repository metadata files named after their checksum
+# never change, unlike e.g. repomd.xml or the mirror lists
+CACHEABLE_PATH_REGEXES = [
+    re.compile(r"^.*\.d?rpm$"),
+    re.compile(r"^.*/repodata/[0-9a-f]{32,}-[^/]+$"),
+]
+
+HOP_BY_HOP_HEADERS = ["connection", "keep-alive", "proxy-authenticate",
+                      "proxy-authorization", "proxy-connection", "te",
+                      "trailers", "transfer-encoding", "upgrade"]
+
+RANGE_REGEX = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def get_cache_key(url):
+    """Returns the cache key of a URL, or None if it is not cacheable.
+
+    Files with the same name can differ between repositories and mirrors,
+    e.g. for another release or architecture, so the key includes the host
+    and the full path. The same content downloaded from different mirrors
+    is still stored once.
+    """
+    split_url = parse.urlsplit(url)
+    if split_url.query or not any([regex.match(split_url.path)
+                                   for regex in CACHEABLE_PATH_REGEXES]):
+        return None
+    return "%(host)s:%(port)d%(path)s" % {
+        "host": split_url.hostname.lower(), "port": split_url.port or 80,
+        "path": split_url.path}
+
+
+class _StoreWriter(object):
+    """Writes a file to the store, which is added only once committed."""
+    def __init__(self, store, key, temp_dir):
+        self._store = store
+        self._key = key
+        (fd, self._path) = tempfile.mkstemp(dir=temp_dir)
+        self._file = os.fdopen(fd, 'wb')
+        self._hash = hashlib.sha256()
+        self._size = 0
+
+    def write(self, data):
+        self._file.write(data)
+        self._hash.update(data)
+        self._size += len(data)
+
+    def commit(self):
+        self._file.close()
+        self._store._add(self._key, self._path, self._hash.hexdigest(),
+                         self._size)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._path)
+
+
+class PackageStore(object):
+    """Content addressed, size bounded LRU store of the cached files.
+
+    Each file is stored once, named after its SHA-256 digest, and the index
+    maps the cache keys to the digests in least recently used order. When
+    the total size exceeds the maximum, the least recently used keys are
+    evicted along with the files not referenced anymore.
+    """
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_CACHE_SIZE):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._index_path = os.path.join(cache_dir, INDEX_FILE_NAME)
+        self._temp_dir = os.path.join(cache_dir, TEMP_DIR_NAME)
+        self._lock = threading.Lock()
+        self._keys = collections.OrderedDict()
+        self._sizes = {}
+
+        for path in [cache_dir, self._temp_dir]:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self._load()
+
+    def _get_object_path(self, digest):
+        return os.path.join(self._cache_dir, OBJECTS_DIR_NAME, digest[:2],
+                            digest)
+
+    def _load(self):
+        # Files left by interrupted downloads
+        for name in os.listdir(self._temp_dir):
+            os.remove(os.path.join(self._temp_dir, name))
+
+        index = {"keys": [], "sizes": {}}
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, 'rb') as f:
+                    index = json.loads(f.read().decode())
+            except Exception as ex:
+                LOG.exception(ex)
+                LOG.warn("Invalid package cache index, discarding it")
+
+        for (digest, size) in index["sizes"].items():
+            path = self._get_object_path(digest)
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                self._sizes[digest] = size
+        for (key, digest) in index["keys"]:
+            if digest in self._sizes:
+                self._keys[key] = digest
+
+        # Files not in the index anymore, e.g. if they could not be removed
+        # while being served during the eviction
+        objects_dir = os.path.join(self._cache_dir, OBJECTS_DIR_NAME)
+        if os.path.isdir(objects_dir):
+            for dir_name in os.listdir(objects_dir):
+                for digest in os.listdir(os.path.join(objects_dir,
+                                                      dir_name)):
+                    if digest not in self._sizes:
+                        self._remove_object(digest)
+
+        LOG.info("Package cache: %(count)d files, %(size)d bytes",
+                 {"count": len(self._keys), "size": self.get_size()})
+
+    def _save(self):
+        tmp_path = "%s.tmp" % self._index_path
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps({"keys": list(self._keys.items()),
+                                "sizes": self._sizes}).encode())
+        # os.rename does not overwrite existing files on Windows
+        if os.path.exists(self._index_path):
+            os.remove(self._index_path)
+        os.rename(tmp_path, self._index_path)
+
+    def save(self):
+        """Persists the least recently used order of the keys."""
+        with self._lock:
+            self._save()
+
+    def _remove_object(self, digest):
+        try:
+            os.remove(self._get_object_path(digest))
+        except OSError as ex:
+            LOG.warn("Unable to remove cached file %(digest)s: %(ex)s",
+                     {"digest": digest, "ex": ex})
+
+    def _remove_unreferenced(self, digest):
+        if digest not in self._keys.values():
+            del self._sizes[digest]
+            self._remove_object(digest)
+
+    def _evict(self):
+        while self._keys and self.get_size() > self._max_size:
+            (key, digest) = self._keys.popitem(last=False)
+            LOG.debug("Evicting from the package cache: %s", key)
+            self._remove_unreferenced(digest)
+
+    def get_size(self):
+        return sum(self._sizes.values())
+
+    def open(self, key):
+        """Returns the cached file object and its size, or None."""
+        with self._lock:
+            digest = self._keys.pop(key, None)
+            if digest is None:
+                return None
+            self._keys[key] = digest
+            return (open(self._get_object_path(digest), 'rb'),
+                    self._sizes[digest])
+
+    def create_writer(self, key):
+        return _StoreWriter(self, key, self._temp_dir)
+
+    def _add(self, key, path, digest, size):
+        if size > self._max_size:
+            os.remove(path)
+            return
+
+        with self._lock:
+            object_path = self._get_object_path(digest)
+            if digest in self._sizes:
+                os.remove(path)
+            else:
+                object_dir = os.path.dirname(object_path)
+                if not os.path.isdir(object_dir):
+                    os.makedirs(object_dir)
+                os.rename(path, object_path)
+                self._sizes[digest] = size
+
+            old_digest = self._keys.pop(key, None)
+            self._keys[key] = digest
+            if old_digest not in [None, digest]:
+                self._remove_unreferenced(old_digest)
+            self._evict()
+            self._save()
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        LOG.debug("Package proxy request from %s failed", client_address[0],
+                  exc_info=True)
+
+
+class _PackageProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def _proxy(self):
+        return self.server.package_proxy
+
+    def log_message(self, format, *args):
+        LOG.debug("Package proxy request from %(client)s: %(msg)s",
+                  {"client": self.client_address[0], "msg": format % args})
+
+    def _is_no_cache(self):
+        return "no-cache" in "%s %s" % (self.headers.get("Pragma", ""),
+                                        self.headers.get("Cache-Control", ""))
+
+    def _get_range(self, size):
+        """Returns the requested (start, end) range, or None for all."""
+        match = RANGE_REGEX.match(self.headers.get("Range", ""))
+        if not match or not any(match.groups()):
+            return None
+
+        (start, end) = match.groups()
+        if not start:
+            start = max(size - int(end), 0)
+            end = size - 1
+        else:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        return (start, end)
+
+    def _copy(self, src, size, writer=None):
+        """Copies size bytes, or until EOF if None, returns the count."""
+        count = 0
+        while size is None or count < size:
+            data = src.read(COPY_BUFFER_SIZE if size is None else
+                            min(COPY_BUFFER_SIZE, size - count))
+            if not data:
+                break
+            self.wfile.write(data)
+            if writer:
+                writer.write(data)
+            count += len(data)
+        return count
+
+    def _send_cached(self, f, size):
+        byte_range = self._get_range(size)
+        if byte_range and byte_range[0] > byte_range[1]:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if byte_range:
+            (start, end) = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (start, end, size))
+            f.seek(start)
+        else:
+            (start, end) = (0, size - 1)
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+        if self.command != "HEAD":
+            self._proxy._add_stats(
+                cache_bytes=self._copy(f, end - start + 1))
+
+    def _get_upstream_request_headers(self):
+        headers = [(name, value) for (name, value) in self.headers.items()
+                   if name.lower() not in HOP_BY_HOP_HEADERS]
+        headers.append(("Connection", "close"))
+        return headers
+
+    def _forward(self, split_url, key):
+        conn = self._proxy._get_upstream_connection(split_url)
+        try:
+            conn.putrequest(self.command, self._proxy._get_upstream_target(
+                split_url), skip_host=True, skip_accept_encoding=True)
+            for (name, value) in self._get_upstream_request_headers():
+                conn.putheader(name, value)
+            for (name, value) in self._proxy._get_upstream_auth_headers():
+                conn.putheader(name, value)
+            conn.endheaders()
+            response = conn.getresponse()
+        except (socket.error, http_client.HTTPException) as ex:
+            LOG.debug("Package proxy upstream request failed: %s", ex)
+            conn.close()
+            self.send_error(502, "Upstream request failed: %s" % ex)
+            return
+
+        writer = None
+        try:
+            self.send_response(response.status, response.reason)
+            for (name, value) in response.getheaders():
+                if name.lower() not in HOP_BY_HOP_HEADERS + [
+                        "content-length"]:
+                    self.send_header(name, value)
+
+            length = response.getheader("Content-Length")
+            if length is not None:
+                length = int(length)
+                self.send_header("Content-Length", str(length))
+            else:
+                # The end of the response is given by closing the connection
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+
+            if self.command == "HEAD":
+                return
+
+            if key and response.status == 200:
+                writer = self._proxy.store.create_writer(key)
+            count = self._copy(response, length, writer)
+            self._proxy._add_stats(upstream_bytes=count)
+
+            if writer and length in [None, count]:
+                writer.commit()
+                writer = None
+        finally:
+            if writer:
+                writer.abort()
+            conn.close()
+
+    def _send_status(self):
+        body = json.dumps(self._proxy.get_stats()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self):
+        split_url = parse.urlsplit(self.path)
+        if self.path == "/":
+            # Requested directly, e.g. to check if the proxy is reachable
+            self._send_status()
+            return
+        if split_url.scheme != "http" or not split_url.hostname:
+            self.send_error(400, "Only absolute http URLs are supported")
+            return
+
+        key = get_cache_key(self.path)
+        # yum asks to bypass the caches after a checksum mismatch, in which
+        # case the cached file is replaced
+        cached = (key and not self._is_no_cache() and
+                  self._proxy.store.open(key))
+        if cached:
+            (f, size) = cached
+            with f:
+                self._proxy._add_stats(hits=1)
+                self._send_cached(f, size)
+        else:
+            # Partial downloads are not cached
+            if "Range" in self.headers:
+                key = None
+            self._proxy._add_stats(misses=1 if key else 0)
+            self._forward(split_url, key)
+
+    do_HEAD = do_GET
+
+    def do_CONNECT(self):
+        """Tunnels HTTPS connections, which cannot be cached."""
+        (host, _, port) = self.path.rpartition(":")
+        try:
+            upstream = self._proxy._connect_tunnel(host, int(port))
+        except (ValueError, socket.error, http_client.HTTPException) as ex:
+            LOG.debug("Package proxy tunnel failed: %s", ex)
+            self.send_error(502, "Tunnel failed: %s" % ex)
+            return
+
+        try:
+            self.send_response(200, "Connection established")
+            self.end_headers()
+            self.close_connection = True
+            self._proxy._relay(self.connection, upstream)
+        finally:
+            upstream.close()
+
+
+class PackageProxy(object):
+    """Caching HTTP proxy, optionally chained to an upstream proxy.
+
+    Only plain HTTP requests for immutable repository files are cached.
+    The other requests, including the HTTPS tunnels, are forwarded.
+    """
+    def __init__(self, store, listen_address, port=DEFAULT_PORT,
+                 upstream_proxy_url=None):
+        self.store = store
+        self._listen_address = listen_address
+        self._port = port
+        self._upstream_proxy = None
+        if upstream_proxy_url:
+            self._upstream_proxy = parse.urlsplit(upstream_proxy_url)
+        self._server = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "cache_bytes": 0,
+                       "upstream_bytes": 0}
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(
+            (self._listen_address, self._port), _PackageProxyRequestHandler)
+        self._server.package_proxy = self
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="PackageProxy")
+        self._thread.daemon = True
+        self._thread.start()
+        LOG.info("Package proxy listening on %s", self.get_url())
+
+    def stop(self):
+        if not self._server:
+            return
+
+        self._stopped.set()
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self.store.save()
+        LOG.info("Package proxy stopped: %s", self.get_stats())
+
+    def get_url(self):
+        return "http://%s:%d" % self._server.server_address[:2]
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["cache_size"] = self.store.get_size()
+        return stats
+
+    def _add_stats(self, **kwargs):
+        with self._stats_lock:
+            for (name, value) in kwargs.items():
+                self._stats[name] += value
+
+    def _get_upstream_connection(self, split_url):
+        if self._upstream_proxy:
+            return http_client.HTTPConnection(
+                self._upstream_proxy.hostname,
+                self._upstream_proxy.port or 80,
+                timeout=UPSTREAM_TIMEOUT_S)
+        return http_client.HTTPConnection(
+            split_url.hostname, split_url.port or 80,
+            timeout=UPSTREAM_TIMEOUT_S)
+
+    def _get_upstream_target(self, split_url):
+        if self._upstream_proxy:
+            return split_url.geturl()
+        return parse.urlunsplit(("", "", split_url.path or "/",
+                                 split_url.query, ""))
+
+    def _get_upstream_auth_headers(self):
+        if not self._upstream_proxy or not self._upstream_proxy.username:
+            return []
+        credentials = "%s:%s" % (
+            parse.unquote(self._upstream_proxy.username),
+            parse.unquote(self._upstream_proxy.password or ""))
+        return [("Proxy-Authorization", "Basic %s" % base64.b64encode(
+            credentials.encode()).decode())]
+
+    def _connect_tunnel(self, host, port):
+        if not self._upstream_proxy:
+            return socket.create_connection((host, port),
+                                            UPSTREAM_TIMEOUT_S)
+
+        sock = socket.create_connection(
+            (self._upstream_proxy.hostname, self._upstream_proxy.port or 80),
+            UPSTREAM_TIMEOUT_S)
+        try:
+            request = "CONNECT %(host)s:%(port)d HTTP/1.1\r\n" % {
+                "host": host, "port": port}
+            request += "Host: %(host)s:%(port)d\r\n" % {
+                "host": host, "port": port}
+            for (name, value) in self._get_upstream_auth_headers():
+                request += "%s: %s\r\n" % (name, value)
+            sock.sendall((request + "\r\n").encode())
+
+            response = b""
+            while b"\r\n\r\n" not in response:
+                data = sock.recv(COPY_BUFFER_SIZE)
+                if not data:
+                    raise http_client.BadStatusLine(response)
+                response += data
+            status = response.split(b"\r\n")[0].split()
+            if len(status) < 2 or status[1] != b"200":
+                raise http_client.HTTPException(
+                    "Upstream proxy tunnel failed: %s" %
+                    response.split(b"\r\n")[0].decode())
+            return sock
+        except Exception:
+            sock.close()
+            raise
+
+    def _relay(self, client_sock, upstream_sock):
+        socks = [client_sock, upstream_sock]
+        while not self._stopped.is_set():
+            (readable, _, _) = select.select(socks, [], [],
+                                             TUNNEL_SELECT_TIMEOUT_S)
+            for sock in readable:
+                data = sock.recv(COPY_BUFFER_SIZE)
+                if not data:
+                    return
+                other_sock = upstream_sock if sock is client_sock else (
+                    client_sock)
+                other_sock.sendall(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs the caching package proxy")
+    parser.add_argument("--cache-dir", required=True,
+                        help="Directory of the cached files")
+    parser.add_argument("--max-size-mb", type=int,
+                        default=DEFAULT_MAX_CACHE_SIZE // (1024 * 1024),
+                        help="Maximum size of the cached files")
+    parser.add_argument("--listen-address", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--upstream-proxy",
+                        help="Proxy URL used for the upstream requests")
+    parsed_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    store = PackageStore(parsed_args.cache_dir,
+                         parsed_args.max_size_mb * 1024 * 1024)
+    proxy = PackageProxy(store, parsed_args.listen_address, parsed_args.port,
+                         parsed_args.upstream_proxy)
+    proxy.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import six
+
+from v_magine import constants
+from v_magine import timeline
+
+LOG = logging
+
+
+class _PrefetchThread(threading.Thread):
+    def __init__(self, name, download_func, target_path):
+        super(_PrefetchThread, self).__init__(name="Prefetch-%s" % name)
+        self.daemon = True
+        # Thread uses _name for the thread name
+        self._prefetch_name = name
+        self._download_func = download_func
+        self._target_path = target_path
+        self._exc_info = None
+        self._lock = threading.Lock()
+        self._discarded = False
+
+    def get_target_path(self):
+        return self._target_path
+
+    def get_exc_info(self):
+        return self._exc_info
+
+    def _remove_target(self):
+        if os.path.exists(self._target_path):
+            os.remove(self._target_path)
+        os.rmdir(os.path.dirname(self._target_path))
+
+    def discard(self):
+        with self._lock:
+            self._discarded = True
+            if not self.is_alive():
+                self._remove_target()
+
+    def run(self):
+        start_time = time.time()
+        try:
+            with timeline.span("prefetch_%s" % self._prefetch_name,
+                               timeline.CATEGORY_DOWNLOAD):
+                self._download_func(self._target_path)
+            LOG.info("Prefetched %(path)s in %(elapsed).2f s",
+                     {"path": self._target_path,
+                      "elapsed": time.time() - start_time})
+        except Exception as ex:
+            LOG.exception(ex)
+            self._exc_info = sys.exc_info()
+
+        with self._lock:
+            if self._discarded:
+                self._remove_target()
+
+
+class DownloadPrefetcher(object):
+    """Downloads files in the background until they are needed.
+
+    The download function is expected to verify the downloaded file and to
+    raise an exception if the download fails. Each download goes to its own
+    temporary directory, so that the downloads still in progress after a
+    cleanup cannot overwrite or remove the files of later downloads.
+    """
+    def __init__(self):
+        self._threads = {}
+
+    def start(self, name, download_func, file_name):
+        target_path = os.path.join(
+            tempfile.mkdtemp(prefix="%s-prefetch-" % constants.PRODUCT_NAME),
+            file_name)
+        LOG.debug("Prefetching %(name)s to %(path)s",
+                  {"name": name, "path": target_path})
+        thread = _PrefetchThread(name, download_func, target_path)
+        self._threads[name] = thread
+        thread.start()
+
+    def is_done(self, name):
+        return not self._threads[name].is_alive()
+
+    def get(self, name):
+        """Waits for the download to complete and returns the file path."""
+        thread = self._threads[name]
+        thread.join()
+
+        exc_info = thread.get_exc_info()
+        if exc_info:
+            six.reraise(*exc_info)
+        return thread.get_target_path()
+
+    def cleanup(self):
+        """Removes the downloaded files.
+
+        Downloads still in progress are not waited for, their files are
+        removed as soon as they complete.
+        """
+        for thread in self._threads.values():
+            thread.discard()
+        self._threads = {}
@@ -0,0 +1,206 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import json
+import logging
+import os
+import threading
+import time
+
+LOG = logging
+
+MAX_HISTORY_SAMPLES = 10
+# A running step is never reported as completed
+MAX_RUNNING_STEP_FRACTION = 0.95
+# The speed compared with the past deployments is estimated only after
+# enough progress has been made
+MIN_SPEED_FACTOR_PROGRESS = 0.05
+MIN_SPEED_FACTOR = 0.5
+MAX_SPEED_FACTOR = 2
+UNKNOWN_STEP_DURATION = 1
+
+# Seconds, used until durations have been recorded on this host
+DEFAULT_STEP_DURATIONS = {
+    "generate_ssh_key": 1,
+    "generate_md5_password": 0.1,
+    "check_remove_vm": 3,
+    "create_vswitches": 8,
+    "start_package_proxy": 0.5,
+    "create_kickstart_image": 2,
+    "create_openstack_vm": 10,
+    "start_pxe_service": 1,
+    "pxe_boot_openstack_vm": 600,
+    "reboot_openstack_vm": 2,
+    "wait_for_rdo_vm_reboot": 45,
+    "connect_rdo_vm": 1,
+    "configure_rdo_vm_yum_proxy": 2,
+    "update_rdo_vm": 300,
+    "install_rdo": 1200,
+    "check_rdo_vm_new_kernel": 1,
+    "install_lis": 120,
+    "get_nova_config": 5,
+    "check_compute_hosts": 2,
+    "uninstall_hyperv_components": 5,
+    "install_hyperv_compute": 90,
+    "install_freerdp_webconnect": 30,
+}
+
+
+def _median(values):
+    values = sorted(values)
+    count = len(values)
+    if count % 2:
+        return values[count // 2]
+    return (values[count // 2 - 1] + values[count // 2]) / 2.0
+
+
+class ProgressHistory(object):
+    """Durations and output line counts of the steps of past deployments."""
+    def __init__(self, path):
+        self._path = path
+        self._steps = {}
+
+        if os.path.exists(self._path):
+            try:
+                with open(self._path, 'rb') as f:
+                    self._steps = json.loads(f.read().decode())
+            except Exception as ex:
+                LOG.exception(ex)
+                LOG.warn("Invalid progress history, discarding it")
+
+    def get_duration(self, step_name):
+        samples = self._steps.get(step_name)
+        if samples:
+            return _median([sample["duration"] for sample in samples])
+        return DEFAULT_STEP_DURATIONS.get(step_name, UNKNOWN_STEP_DURATION)
+
+    def get_output_lines(self, step_name):
+        """Returns the expected output lines, or None if unknown."""
+        samples = self._steps.get(step_name)
+        if samples:
+            return _median([sample["output_lines"] for sample in samples])
+
+    def add_sample(self, step_name, duration, output_lines):
+        samples = self._steps.setdefault(step_name, [])
+        samples.append({"duration": duration, "output_lines": output_lines})
+        del samples[:-MAX_HISTORY_SAMPLES]
+
+    def save(self):
+        tmp_path = "%s.tmp" % self._path
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(self._steps, sort_keys=True,
+                               indent=2).encode())
+        # os.rename does not overwrite existing files on Windows
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        os.rename(tmp_path, self._path)
+
+
+class ProgressEstimator(object):
+    """Estimates the deployment progress and the remaining time.
+
+    Each step is weighted by its median duration in the past deployments.
+    The progress of the running steps is estimated from their output, e.g.
+    the VM console or packstack, compared with the output of the past
+    deployments, or from the elapsed time if the output is not known.
+    """
+    def __init__(self, history, update_callback=None):
+        self._history = history
+        self._update_callback = update_callback
+        self._lock = threading.Lock()
+        self._weights = {}
+        self._expected_output_lines = {}
+        self._started = {}
+        self._output_lines = {}
+        self._step_fractions = {}
+        self._durations = {}
+        self._start_time = None
+        self._last_percentage = None
+
+    def start(self, step_names):
+        with self._lock:
+            self._start_time = time.time()
+            for name in step_names:
+                self._weights[name] = self._history.get_duration(name)
+                self._expected_output_lines[name] = (
+                    self._history.get_output_lines(name))
+
+    def set_step_started(self, name):
+        with self._lock:
+            self._started[name] = time.time()
+            self._output_lines[name] = 0
+
+    def set_step_completed(self, name, outputs=None):
+        with self._lock:
+            self._durations[name] = time.time() - self._started.pop(name)
+        self._notify()
+
+    def set_step_fraction(self, name, fraction):
+        """Sets the completed fraction of a step reporting its progress.
+
+        Returns True if the update callback has been called.
+        """
+        with self._lock:
+            self._step_fractions[name] = fraction
+        return self._notify()
+
+    def add_output(self, data):
+        """Accounts the output lines to the running steps producing output."""
+        lines = data.count(b"\n" if isinstance(data, bytes) else "\n")
+        if not lines:
+            return
+
+        with self._lock:
+            for name in self._started:
+                self._output_lines[name] += lines
+        self._notify()
+
+    def _get_running_step_fraction(self, name, now):
+        expected_lines = self._expected_output_lines.get(name)
+        if name in self._step_fractions:
+            fraction = self._step_fractions[name]
+        elif expected_lines:
+            fraction = self._output_lines[name] / float(expected_lines)
+        else:
+            fraction = (now - self._started[name]) / self._weights[name]
+        return min(fraction, MAX_RUNNING_STEP_FRACTION)
+
+    def get_progress(self):
+        """Returns the percentage and the estimated remaining seconds."""
+        with self._lock:
+            if not self._weights:
+                return (0, None)
+
+            now = time.time()
+            done = sum([self._weights[name] for name in self._durations])
+            for name in self._started:
+                done += (self._weights[name] *
+                         self._get_running_step_fraction(name, now))
+            total = sum(self._weights.values())
+
+            speed_factor = 1
+            if done >= total * MIN_SPEED_FACTOR_PROGRESS:
+                speed_factor = min(max((now - self._start_time) / done,
+                                       MIN_SPEED_FACTOR), MAX_SPEED_FACTOR)
+            return (100.0 * done / total, (total - done) * speed_factor)
+
+    def _notify(self):
+        if not self._update_callback:
+            return False
+
+        (percentage, eta) = self.get_progress()
+        # Avoid flooding the UI, e.g. with console output
+        if int(percentage) != self._last_percentage:
+            self._last_percentage = int(percentage)
+            self._update_callback(percentage, eta)
+            return True
+        return False
+
+    def save_history(self):
+        """Records the durations and output of the completed steps."""
+        with self._lock:
+            for (name, duration) in self._durations.items():
+                self._history.add_sample(name, duration,
+                                         self._output_lines[name])
+        self._history.save()
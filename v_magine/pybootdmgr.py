@@ -2,58 +2,270 @@
 # All Rights Reserved.
 # Licensed under the AGPLv3, see LICENCE file for details.
 
-import atexit
-import iniparse
+import collections
 import logging
 import os
-import subprocess
-import sys
+import select
+import threading
 
 import jinja2
+from pybootd import pxed
+from pybootd import util as pybootd_util
+from v_magine import tftp
 from v_magine import utils
-from v_magine import windows
 
 LOG = logging
 
+DEFAULT_BOOT_FILE = "pxelinux.0"
+DEFAULT_LEASE_TIME_S = 24 * 60 * 60
+DEFAULT_DNS = "8.8.8.8"
+DEFAULT_DOMAIN = "localdomain"
 
-class PyBootdManager(object):
-    def __init__(self):
-        self._pybootd_ini_path = None
-        self._pybootd_proc = None
-        self._pxelinux_cfg_dir = None
+# Interval for checking if the PXE service is being stopped
+POLL_INTERVAL_S = 0.5
+# Maximum time to wait for the TFTP transfers in progress when stopping
+TFTP_TRANSFERS_STOP_TIMEOUT_S = 5
+BOOTP_MAX_PACKET_SIZE = 556
+# Maximum number of recent TFTP transfers included in the stats
+MAX_RECENT_TFTP_TRANSFERS = 16
 
-    def _get_pybootd_ini_template_path(self):
-        return os.path.join(utils.get_resources_dir(), "pybootd.ini")
 
-    def _get_pxelinux_cfg_path(self):
-        return os.path.join(utils.get_resources_dir(), "pxelinux.template")
+class PxeConfig(object):
+    """Configuration of the in-process BOOTP/DHCP and TFTP servers.
 
-    def _generate_pybootd_ini(self, listen_address, tftp_root_url,
-                              reservations, pool_start,
-                              pool_count=None):
-        pybootd_ini_template_path = self._get_pybootd_ini_template_path()
+    Only the clients whose MAC address is in mac_addresses get a lease.
+    """
+    def __init__(self, listen_address, tftp_root_dir, pool_start,
+                 pool_count, mac_addresses, boot_file=DEFAULT_BOOT_FILE,
+                 lease_time_s=DEFAULT_LEASE_TIME_S, dns=DEFAULT_DNS,
+                 domain=DEFAULT_DOMAIN,
+                 tftp_max_block_size=tftp.MAX_BLOCK_SIZE,
+                 tftp_max_window_size=tftp.DEFAULT_MAX_WINDOW_SIZE):
+        self.listen_address = listen_address
+        self.tftp_root_dir = tftp_root_dir
+        self.pool_start = pool_start
+        self.pool_count = pool_count
+        self.mac_addresses = mac_addresses
+        self.boot_file = boot_file
+        self.lease_time_s = lease_time_s
+        self.dns = dns
+        self.domain = domain
+        self.tftp_max_block_size = tftp_max_block_size
+        self.tftp_max_window_size = tftp_max_window_size
 
-        pybootd_ini_path = utils.copy_to_temp_file(pybootd_ini_template_path)
+    def get_pybootd_config(self):
+        """Returns the pybootd configuration of the BOOTP/DHCP server."""
+        sections = {
+            "bootp": {
+                "address": self.listen_address,
+                "pool_start": self.pool_start,
+                "pool_count": self.pool_count,
+                "domain": self.domain,
+                "server_name": "debug",
+                "boot_file": self.boot_file,
+                "lease_time": self.lease_time_s,
+                "access": "mac",
+                "allow_simple_dhcp": "enable",
+                "dns": self.dns,
+                "set_gateway": "false"},
+            # pybootd does not handle reservations yet
+            "mac": dict((mac_address, "enable")
+                        for mac_address in self.mac_addresses),
+            "uuid": {},
+        }
 
-        with open(pybootd_ini_path, 'r') as f:
-            cfg = iniparse.INIConfig(f)
+        config = pybootd_util.EasyConfigParser()
+        for (section, options) in sections.items():
+            config.add_section(section)
+            for (name, value) in options.items():
+                config.set(section, name, str(value))
+        return config
 
-        if not pool_count:
-            pool_count = len(reservations)
 
-        cfg.bootp.address = listen_address
-        cfg.bootp.pool_start = pool_start
-        cfg.bootp.pool_count = pool_count
-        cfg.tftp.root = tftp_root_url
+class _PxeServerThread(threading.Thread):
+    """Serves the requests received on the sockets of a pybootd server."""
+    def __init__(self, name, server, max_packet_size, stopped):
+        super(_PxeServerThread, self).__init__(name=name)
+        self.daemon = True
+        self._server = server
+        self._max_packet_size = max_packet_size
+        self._stopped = stopped
+        self._exception = None
+
+    def get_exception(self):
+        return self._exception
+
+    def _handle(self, sock, addr, data):
+        raise NotImplementedError()
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                (readable, _, _) = select.select(
+                    self._server.sock, [], [], POLL_INTERVAL_S)
+                for sock in readable:
+                    (data, addr) = sock.recvfrom(self._max_packet_size)
+                    try:
+                        self._handle(sock, addr, data)
+                    except Exception as ex:
+                        LOG.exception(ex)
+        except Exception as ex:
+            LOG.exception(ex)
+            self._exception = ex
+        finally:
+            for sock in self._server.sock:
+                sock.close()
+
+
+class _BootpServerThread(_PxeServerThread):
+    def __init__(self, server, stopped):
+        super(_BootpServerThread, self).__init__(
+            "BootpServer", server, BOOTP_MAX_PACKET_SIZE, stopped)
+        self.request_count = 0
+
+    def is_managed_ip(self, ip):
+        return self._server.is_managed_ip(ip)
+
+    def get_leases(self):
+        # MAC address -> IP address
+        return dict(self._server.ippool)
+
+    def _handle(self, sock, addr, data):
+        self.request_count += 1
+        self._server.handle(sock, addr, data)
+
+
+class _TftpServerThread(_PxeServerThread):
+    def __init__(self, server, stopped):
+        super(_TftpServerThread, self).__init__(
+            "TftpServer", server, tftp.MAX_PACKET_SIZE, stopped)
+        self._transfers_lock = threading.Lock()
+        self._transfers = []
+        self._request_count = 0
+        self._completed_transfers = collections.deque(
+            maxlen=MAX_RECENT_TFTP_TRANSFERS)
+        self._bytes_sent = 0
+        self._transfer_time = 0
+
+    def _run_transfer(self, transfer):
+        stats = transfer.run()
+        with self._transfers_lock:
+            self._completed_transfers.append(stats)
+            self._bytes_sent += stats["bytes"]
+            self._transfer_time += stats["duration"]
+
+    def _handle(self, sock, addr, data):
+        self._request_count += 1
+        transfer = self._server.create_transfer(sock, addr, data)
+        if not transfer:
+            return
+
+        # Each transfer uses its own socket
+        transfer_thread = threading.Thread(target=self._run_transfer,
+                                           args=(transfer,),
+                                           name="TftpTransfer")
+        transfer_thread.daemon = True
+        with self._transfers_lock:
+            self._transfers = [t for t in self._transfers if t.is_alive()]
+            self._transfers.append(transfer_thread)
+        transfer_thread.start()
+
+    def get_stats(self):
+        with self._transfers_lock:
+            return {
+                "tftp_requests": self._request_count,
+                "tftp_active_transfers": len(
+                    [t for t in self._transfers if t.is_alive()]),
+                "tftp_bytes_sent": self._bytes_sent,
+                "tftp_throughput": (self._bytes_sent / self._transfer_time
+                                    if self._transfer_time else 0),
+                "tftp_recent_transfers": list(self._completed_transfers)}
+
+    def join_transfers(self, timeout):
+        with self._transfers_lock:
+            transfers = list(self._transfers)
+        for transfer in transfers:
+            transfer.join(timeout)
+            if transfer.is_alive():
+                LOG.warn("TFTP transfer still in progress")
 
-        # pybootd does not handle reservations yet
-        for (mac_address, ip_addr) in reservations:
-            cfg.mac[mac_address] = "enable"
 
-        with open(pybootd_ini_path, 'wb') as f:
-            f.write(str(cfg).encode())
+class PxeService(object):
+    """Hosts the pybootd BOOTP/DHCP server and the TFTP server in process.
 
-        return pybootd_ini_path
+    The servers are bound when started, so errors like a port already in
+    use are raised by start, and each server runs on a dedicated thread.
+    """
+    def __init__(self, pxe_config):
+        self._pxe_config = pxe_config
+        self._stopped = threading.Event()
+        self._bootp_thread = None
+        self._tftp_thread = None
+
+    def start(self):
+        self._stopped.clear()
+        config = self._pxe_config.get_pybootd_config()
+        logger = logging.getLogger("pybootd")
+
+        servers = []
+        try:
+            bootp_server = pxed.BootpServer(logger=logger, config=config)
+            servers.append(bootp_server)
+            bootp_server.bind()
+            bootp_thread = _BootpServerThread(bootp_server, self._stopped)
+
+            tftp_server = tftp.TftpServer(
+                self._pxe_config.tftp_root_dir,
+                self._pxe_config.listen_address,
+                max_block_size=self._pxe_config.tftp_max_block_size,
+                max_window_size=self._pxe_config.tftp_max_window_size,
+                is_allowed_client=bootp_thread.is_managed_ip)
+            servers.append(tftp_server)
+            tftp_server.bind()
+            tftp_thread = _TftpServerThread(tftp_server, self._stopped)
+        except Exception:
+            for server in servers:
+                for sock in server.sock:
+                    sock.close()
+            raise
+
+        bootp_thread.start()
+        tftp_thread.start()
+        self._bootp_thread = bootp_thread
+        self._tftp_thread = tftp_thread
+
+    def stop(self):
+        self._stopped.set()
+        for thread in [self._bootp_thread, self._tftp_thread]:
+            if thread:
+                thread.join()
+        if self._tftp_thread:
+            self._tftp_thread.join_transfers(TFTP_TRANSFERS_STOP_TIMEOUT_S)
+        self._bootp_thread = None
+        self._tftp_thread = None
+
+    def is_healthy(self):
+        return bool(not self._stopped.is_set() and
+                    self._bootp_thread and self._bootp_thread.is_alive() and
+                    self._tftp_thread and self._tftp_thread.is_alive())
+
+    def get_stats(self):
+        stats = {"bootp_requests": 0, "leases": {}}
+        if self._bootp_thread:
+            stats["bootp_requests"] = self._bootp_thread.request_count
+            stats["leases"] = self._bootp_thread.get_leases()
+        if self._tftp_thread:
+            stats.update(self._tftp_thread.get_stats())
+        return stats
+
+
+class PyBootdManager(object):
+    def __init__(self):
+        self._pxe_service = None
+        self._pxelinux_cfg_dir = None
+
+    def _get_pxelinux_cfg_path(self):
+        return os.path.join(utils.get_resources_dir(), "pxelinux.template")
 
     def generate_mac_pxelinux_cfg(self, pxe_mac_address, params):
         mac_cfg_path = os.path.join(self._pxelinux_cfg_dir,
@@ -72,41 +284,32 @@ class PyBootdManager(object):
               pool_count=None):
         self.stop()
 
-        tftp_root_url = "file://"
-        if sys.platform == "win32":
-            # Note: pybootd fails if the drive is in the url
-            tftp_root_url += tftp_root_dir.replace("\\", "/")[2:]
-        else:
-            tftp_root_url += tftp_root_dir
-
-        self._pybootd_ini_path = self._generate_pybootd_ini(
-            listen_address, tftp_root_url, reservations,
-            pool_start, pool_count)
-
         self._pxelinux_cfg_dir = os.path.join(tftp_root_dir, "pxelinux.cfg")
         if not os.path.isdir(self._pxelinux_cfg_dir):
             os.makedirs(self._pxelinux_cfg_dir)
 
-        args = [sys.executable, "pybootd", "--config", self._pybootd_ini_path]
-        LOG.info("Starting pybootd: %s" % args)
+        if not pool_count:
+            pool_count = len(reservations)
+
+        pxe_config = PxeConfig(
+            listen_address, tftp_root_dir, pool_start, pool_count,
+            [mac_address for (mac_address, ip_addr) in reservations])
+
+        LOG.info("Starting the PXE service on %s", listen_address)
+        pxe_service = PxeService(pxe_config)
+        pxe_service.start()
+        self._pxe_service = pxe_service
 
-        si = subprocess.STARTUPINFO()
-        si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        self._pybootd_proc = subprocess.Popen(args,
-                                              # stdout=subprocess.PIPE,
-                                              # stderr=subprocess.PIPE,
-                                              shell=False,
-                                              startupinfo=si)
+    def is_healthy(self):
+        return bool(self._pxe_service and self._pxe_service.is_healthy())
 
-        # Make sure we terminate the process before exiting
-        # TODO(alexpilotti): Platform independence
-        atexit.register(windows.kill_process, self._pybootd_proc.pid)
+    def get_stats(self):
+        if self._pxe_service:
+            return self._pxe_service.get_stats()
 
     def stop(self):
-        if self._pybootd_proc:
-            LOG.info('Killing pybootd')
-            self._pybootd_proc.kill()
-            self._pybootd_proc = None
-        if self._pybootd_ini_path:
-            os.remove(self._pybootd_ini_path)
-            self._pybootd_ini_path = None
+        if self._pxe_service:
+            LOG.info("Stopping the PXE service, stats: %s",
+                     self._pxe_service.get_stats())
+            self._pxe_service.stop()
+            self._pxe_service = None
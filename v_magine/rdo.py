@@ -2,76 +2,208 @@
 # All Rights Reserved.
 # Licensed under the AGPLv3, see LICENCE file for details.
 
+import codecs
+import io
 import logging
 import os
-import paramiko
+import select
 import time
 
+import six
+from six.moves import configparser
+
+from v_magine import cancellation
 from v_magine import exceptions
+from v_magine import ssh
+from v_magine import timeline
 from v_magine import utils
 
 LOG = logging
 
+# The cancellation is checked at least once per interval while waiting for
+# the channel output
+SSH_CHANNEL_SELECT_TIMEOUT_S = 1
+SSH_CHANNEL_READ_SIZE = 64 * 1024
+SSH_OUTPUT_ENCODING = "utf-8"
+
+CENTOS_UTILS_SCRIPT = "centos-utils.sh"
+INSTALL_RDO_SCRIPT = "install-rdo.sh"
+LIS_ARCHIVE = "LIS.tar.gz"
+
+# The phases of install-rdo.sh, in execution order
+RDO_INSTALL_PHASES = [
+    "cleanup",
+    "network",
+    "packages",
+    "cirros_image",
+    "answer_file",
+    "openvswitch",
+    "packstack",
+    "post_config",
+    "firewall",
+    "kernel",
+]
+RDO_INSTALL_PHASES_DIR = "/var/lib/v-magine/phases"
+RDO_INSTALL_PHASE_MARKER_EXT = ".done"
+
+
+def _parse_config(content):
+    if six.PY3:
+        # Options can be repeated, e.g. multi-valued options
+        parser = configparser.RawConfigParser(strict=False)
+    else:
+        parser = configparser.RawConfigParser()
+    # Option names are case sensitive
+    parser.optionxform = str
+    if six.PY3:
+        parser.read_string(content)
+    else:
+        parser.readfp(io.StringIO(content))
+    return parser
+
+
+class OutputDecoder(object):
+    """Decodes a stream of output chunks, passing complete lines to callback.
+
+    Multibyte sequences split across chunks are reassembled and invalid ones
+    are replaced, as a decoding error must not fail the command.
+    """
+    def __init__(self, callback, encoding=SSH_OUTPUT_ENCODING):
+        self._callback = callback
+        self._decoder = codecs.getincrementaldecoder(encoding)(
+            errors="replace")
+        self._pending = u""
+
+    def feed(self, data):
+        self._pending += self._decoder.decode(data)
+        # Carriage returns are included to display progress bars, e.g. yum
+        index = max(self._pending.rfind(u"\n"), self._pending.rfind(u"\r"))
+        if index >= 0:
+            lines = self._pending[:index + 1]
+            self._pending = self._pending[index + 1:]
+            self._callback(lines)
+
+    def flush(self, final=False):
+        """Passes any incomplete line, e.g. a prompt, to the callback."""
+        if final:
+            self._pending += self._decoder.decode(b"", final=True)
+        if self._pending:
+            self._callback(self._pending)
+            self._pending = u""
+
 
 class RDOInstaller(object):
 
-    def __init__(self, stdout_callback, stderr_callback):
+    def __init__(self, stdout_callback, stderr_callback,
+                 cancellation_token=None,
+                 output_read_size=SSH_CHANNEL_READ_SIZE, ssh_compress=False):
         self._stdout_callback = stdout_callback
         self._stderr_callback = stderr_callback
-        self._ssh = None
+        self._output_read_size = output_read_size
+        self._cancellation_token = (cancellation_token or
+                                    cancellation.CancellationToken())
+        # Compression is negotiated for the whole connection, including
+        # the uploads of already compressed archives
+        self._session = ssh.SSHSession(self._cancellation_token,
+                                       compress=ssh_compress)
+        self._upload_cache = ssh.UploadCache(self._session)
 
     @utils.retry_on_error(sleep_seconds=5)
+    @timeline.timed(timeline.CATEGORY_SSH, "ssh_shell")
     def _exec_shell_cmd_check_exit_status(self, cmd):
-        chan = self._ssh.invoke_shell(term=self._term_type,
-                                      width=self._term_cols,
-                                      height=self._term_rows)
-        # Close session after the command executed
-        time.sleep(3)
-        chan.send("%s\nexit\n" % cmd)
-
-        running = True
-        while running:
-            if chan.recv_ready():
-                data = chan.recv(4096).decode('ascii')
-                self._stdout_callback(data)
-            if chan.recv_stderr_ready():
-                data = chan.recv_stderr(4096).decode('ascii')
-                self._stderr_callback(data)
-            if chan.exit_status_ready():
-                running = False
-
-        exit_status = chan.recv_exit_status()
+        chan = self._start_shell_cmd(cmd)
+        try:
+            exit_status = self._session.call_cancellable(
+                chan, self._pump_shell_channel, chan)
+        finally:
+            self._session.release_channel(chan)
+        self._check_shell_exit_status(exit_status)
+
+    def _start_shell_cmd(self, cmd):
+        chan = self._session.acquire_channel()
+        try:
+            chan.get_pty(term=self._term_type, width=self._term_cols,
+                         height=self._term_rows)
+            chan.invoke_shell()
+            # Close session after the command executed. The shell reads its
+            # input only once started, no need to wait for it
+            chan.send("%s\nexit\n" % cmd)
+            return chan
+        except Exception:
+            self._session.release_channel(chan)
+            raise
+
+    @staticmethod
+    def _check_shell_exit_status(exit_status):
         if exit_status:
             raise Exception("Command failed with exit code: %d" % exit_status)
 
+    def _get_shell_output_decoders(self):
+        return (OutputDecoder(self._stdout_callback),
+                OutputDecoder(self._stderr_callback))
+
+    def _read_channel_output(self, chan, stdout, stderr):
+        """Reads the available output, returns True once completed."""
+        # Sampled first, as the output is sent before the exit status: all
+        # the output is in the channel buffers once the status is received
+        completed = chan.exit_status_ready()
+        while True:
+            stdout_ready = chan.recv_ready()
+            if stdout_ready:
+                stdout.feed(chan.recv(self._output_read_size))
+            stderr_ready = chan.recv_stderr_ready()
+            if stderr_ready:
+                stderr.feed(chan.recv_stderr(self._output_read_size))
+            if not completed or not (stdout_ready or stderr_ready):
+                break
+
+        if completed:
+            stdout.flush(final=True)
+            stderr.flush(final=True)
+        return completed
+
+    def _pump_shell_channel(self, chan):
+        (stdout, stderr) = self._get_shell_output_decoders()
+        while True:
+            self._cancellation_token.check()
+            # The channel file descriptor is signaled when stdout or stderr
+            # data is available and stays signaled once the channel is closed
+            (readable, _, _) = select.select(
+                [chan], [], [], SSH_CHANNEL_SELECT_TIMEOUT_S)
+            if not readable:
+                # No more output for now, show what is waiting for a newline
+                stdout.flush()
+                stderr.flush()
+
+            if self._read_channel_output(chan, stdout, stderr):
+                return chan.recv_exit_status()
+
     @utils.retry_on_error()
+    @timeline.timed(timeline.CATEGORY_SSH, "ssh_exec")
     def _exec_cmd(self, cmd):
-        chan = self._ssh.get_transport().open_session()
-        chan.exec_command(cmd)
-        return chan.recv_exit_status()
+        with self._session.open_channel() as chan:
+            chan.exec_command(cmd)
+            return self._session.call_cancellable(chan,
+                                                  chan.recv_exit_status)
 
-    @utils.retry_on_error(max_attempts=30, sleep_seconds=30)
     def connect(self, host, ssh_key_path, username, password, term_type,
                 term_cols, term_rows):
         LOG.debug("Connection info: %s" % str((host, username, password)))
 
         self.disconnect()
-        LOG.debug("connecting")
 
         self._term_type = term_type
         self._term_cols = term_cols
         self._term_rows = term_rows
 
-        self._ssh = paramiko.SSHClient()
-        self._ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self._ssh.connect(host, username=username, password=password,
-                          key_filename=ssh_key_path)
+        self._session.connect(host, username, password, ssh_key_path)
         LOG.debug("connected")
 
     def disconnect(self):
-        if self._ssh:
-            self._ssh.close()
-            self._ssh = None
+        self._session.close()
+
+    def get_ssh_metrics(self):
+        return self._session.get_metrics()
 
     def update_os(self):
         LOG.info("Updating OS")
@@ -83,26 +215,59 @@ class RDOInstaller(object):
         self._exec_cmd("reboot")
         self.disconnect()
 
+    @staticmethod
+    def _get_utils_function_cmd(cmd):
+        return (". /root/%(centos_utils)s && %(cmd)s" %
+                {"centos_utils": CENTOS_UTILS_SCRIPT, "cmd": cmd})
+
     def _exec_utils_function(self, cmd):
-        centos_utils = "centos-utils.sh"
-        self._copy_resource_file(centos_utils)
-        return self._exec_cmd(". /root/%(centos_utils)s && %(cmd)s" %
-                              {"centos_utils": centos_utils, "cmd": cmd})
+        self._copy_resource_file(CENTOS_UTILS_SCRIPT)
+        return self._exec_cmd(self._get_utils_function_cmd(cmd))
 
     def check_new_kernel(self):
         return self._exec_utils_function("check_new_kernel")
 
-    def _get_config_value(self, config_file, section, name):
-        stdin, stdout, stderr = self._ssh.exec_command(
-            '/usr/bin/openstack-config --get \"%(config_file)s\" '
-            '\"%(section)s\" \"%(name)s\"' %
-            {'config_file': config_file, 'section': section, 'name': name})
-
-        if stdout.channel.recv_exit_status() != 0:
+    @staticmethod
+    def _get_configure_yum_proxy_cmd(proxy_url):
+        return 'configure_yum_proxy "%s"' % (proxy_url or "")
+
+    def configure_yum_proxy(self, proxy_url):
+        """Sets the yum proxy, returns False if it is not reachable."""
+        return self._exec_utils_function(
+            self._get_configure_yum_proxy_cmd(proxy_url)) == 0
+
+    @timeline.timed(timeline.CATEGORY_SSH, "ssh_read_file")
+    def _read_file(self, path):
+        (exit_status, content) = self._session.exec_command(
+            'cat "%s"' % path)
+        if exit_status != 0:
             raise exceptions.ConfigFileErrorException(
-                "Could not read configuration file \"%s\"" % config_file)
+                "Could not read configuration file \"%s\"" % path)
+        return content.decode(SSH_OUTPUT_ENCODING)
+
+    def get_config_values(self, config_file, config_names):
+        """Returns the requested values of an INI configuration file.
 
-        return stdout.read()[:-1]
+        The file is read once and parsed locally. config_names maps each
+        section to the list of the names to retrieve, the result has the
+        same structure with the values.
+        """
+        parser = _parse_config(self._read_file(config_file))
+
+        config = {}
+        for (section, names) in config_names.items():
+            config[section] = {}
+            for name in names:
+                try:
+                    config[section][name] = parser.get(section, name)
+                except configparser.Error:
+                    raise exceptions.ConfigFileErrorException(
+                        "Option \"%(name)s\" not found in section "
+                        "\"%(section)s\" of configuration file "
+                        "\"%(config_file)s\"" %
+                        {"name": name, "section": section,
+                         "config_file": config_file})
+        return config
 
     def get_nova_config(self):
         config_file = "/etc/nova/nova.conf"
@@ -135,23 +300,34 @@ class RDOInstaller(object):
                             "password"
                         ]}
 
-        config = {}
-        for (section, names) in config_names.items():
-            config[section] = {}
-            for name in names:
-                config[section][name] = self._get_config_value(
-                    config_file, section, name)
-        return config
+        return self.get_config_values(config_file, config_names)
 
     @utils.retry_on_error()
     def _copy_resource_file(self, file_name):
         LOG.debug("Copying %s" % file_name)
-        sftp = self._ssh.open_sftp()
-        path = os.path.join(utils.get_resources_dir(), file_name)
-        sftp.put(path, '/root/%s' % file_name)
-        sftp.close()
+        with timeline.span("sftp_put", timeline.CATEGORY_SSH,
+                           file_name=file_name):
+            # Unchanged files already on the controller are not uploaded
+            self._upload_cache.upload(
+                [(os.path.join(utils.get_resources_dir(), file_name),
+                  '/root/%s' % file_name)],
+                self._get_upload_progress_callback(file_name))
         LOG.debug("%s copied" % file_name)
 
+    def _get_upload_progress_callback(self, file_name):
+        last_percentage = [None]
+
+        def _report_progress(remote_path, transferred, total):
+            percentage = 100 * transferred // total if total else 100
+            if percentage != last_percentage[0]:
+                last_percentage[0] = percentage
+                # Overwrite the same console line until completed
+                self._stdout_callback(
+                    "\rCopying %(file_name)s: %(percentage)d%%%(end)s" %
+                    {"file_name": file_name, "percentage": percentage,
+                     "end": "\r\n" if transferred == total else ""})
+        return _report_progress
+
     @utils.retry_on_error(sleep_seconds=5)
     def check_hyperv_compute_services(self, host_name):
         if (self._exec_utils_function(
@@ -168,35 +344,74 @@ class RDOInstaller(object):
     def _shell_escape(s):
         return s.replace("\\", "\\\\").replace("'", "\\'")
 
+    def _get_install_rdo_cmd(self, phase, rdo_admin_password, fip_range,
+                             fip_range_start, fip_range_end, fip_gateway,
+                             fip_name_servers):
+        return ('/bin/chmod u+x /root/%(install_script)s && '
+                '/root/%(install_script)s %(phase)s '
+                '$\'%(rdo_admin_password)s\' '
+                '\"%(fip_range)s\" \"%(fip_range_start)s\" '
+                '\"%(fip_range_end)s\" '
+                '\"%(fip_gateway)s\" %(fip_name_servers)s' %
+                {'install_script': INSTALL_RDO_SCRIPT,
+                 'phase': phase,
+                 'rdo_admin_password': self._shell_escape(rdo_admin_password),
+                 'fip_range': fip_range,
+                 'fip_range_start': fip_range_start,
+                 'fip_range_end': fip_range_end,
+                 'fip_gateway': fip_gateway if fip_gateway is not None else '',
+                 'fip_name_servers': " ".join(fip_name_servers)})
+
+    def _get_completed_rdo_install_phases(self):
+        (exit_status, output) = self._session.exec_command(
+            'ls -1 "%s" 2>/dev/null' % RDO_INSTALL_PHASES_DIR)
+        return set([name[:-len(RDO_INSTALL_PHASE_MARKER_EXT)]
+                    for name in output.decode(SSH_OUTPUT_ENCODING).split()
+                    if name.endswith(RDO_INSTALL_PHASE_MARKER_EXT)])
+
+    def _report_rdo_install_phase(self, phase, duration):
+        LOG.info("RDO installation phase %(phase)s completed in "
+                 "%(duration).2f s", {"phase": phase, "duration": duration})
+        self._stdout_callback(
+            "\r\nRDO installation phase %(phase)s completed in "
+            "%(duration)d s\r\n" % {"phase": phase, "duration": duration})
+
     def install_rdo(self, rdo_admin_password, fip_range, fip_range_start,
                     fip_range_end, fip_gateway, fip_name_servers):
-        install_script = 'install-rdo.sh'
-        self._copy_resource_file(install_script)
+        self._copy_resource_file(INSTALL_RDO_SCRIPT)
 
         LOG.info("Installing RDO")
-        self._exec_shell_cmd_check_exit_status(
-            '/bin/chmod u+x /root/%(install_script)s && '
-            '/root/%(install_script)s '
-            '$\'%(rdo_admin_password)s\' '
-            '\"%(fip_range)s\" \"%(fip_range_start)s\" \"%(fip_range_end)s\" '
-            '\"%(fip_gateway)s\" %(fip_name_servers)s' %
-            {'install_script': install_script,
-             'rdo_admin_password': self._shell_escape(rdo_admin_password),
-             'fip_range': fip_range,
-             'fip_range_start': fip_range_start,
-             'fip_range_end': fip_range_end,
-             'fip_gateway': fip_gateway if fip_gateway is not None else '',
-             'fip_name_servers': " ".join(fip_name_servers)})
+        # The phases completed by a previous attempt are skipped
+        completed_phases = self._get_completed_rdo_install_phases()
+        for phase in RDO_INSTALL_PHASES:
+            if phase in completed_phases:
+                LOG.info("RDO installation phase %s already completed", phase)
+                continue
+
+            start_time = time.time()
+            try:
+                with timeline.span("rdo_install_phase",
+                                   timeline.CATEGORY_SSH, phase=phase):
+                    self._exec_shell_cmd_check_exit_status(
+                        self._get_install_rdo_cmd(
+                            phase, rdo_admin_password, fip_range,
+                            fip_range_start, fip_range_end, fip_gateway,
+                            fip_name_servers))
+            except Exception:
+                LOG.error("RDO installation phase %s failed", phase)
+                raise
+            self._report_rdo_install_phase(phase, time.time() - start_time)
         LOG.info("RDO installed")
 
-    def install_lis(self):
-        lis_archive = "LIS.tar.gz"
+    @staticmethod
+    def _get_install_lis_cmd():
+        return ('LIS_DIR=$(mktemp -d) && pushd $LIS_DIR && '
+                'tar zxvf /root/%(lis_archive)s && ./install.sh && '
+                'popd && rm -rf $LIS_DIR' %
+                {'lis_archive': LIS_ARCHIVE})
 
+    def install_lis(self):
         LOG.info("Installing LIS")
-        self._copy_resource_file(lis_archive)
-        self._exec_shell_cmd_check_exit_status(
-            'LIS_DIR=$(mktemp -d) && pushd $LIS_DIR && '
-            'tar zxvf /root/%(lis_archive)s && ./install.sh && '
-            'popd && rm -rf $LIS_DIR' %
-            {'lis_archive': lis_archive})
+        self._copy_resource_file(LIS_ARCHIVE)
+        self._exec_shell_cmd_check_exit_status(self._get_install_lis_cmd())
         LOG.info("LIS installed")
@@ -0,0 +1,105 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import logging
+import socket
+import time
+
+from v_magine import cancellation
+from v_magine import exceptions
+
+LOG = logging
+
+SSH_PORT = 22
+SSH_BANNER_PREFIX = b"SSH-"
+
+
+class SSHReadinessProber(object):
+    """Detects when a guest accepts SSH connections.
+
+    The SSH port is polled with exponential backoff until the server sends
+    its banner. If a guest IP function is provided, e.g. returning the
+    addresses reported by the Hyper-V KVP guest intrinsic items, the host
+    address is also expected to be reported by the guest. As the KVP daemon
+    might not be running, this check is skipped after a grace period.
+    """
+    def __init__(self, host, port=SSH_PORT, guest_ips_func=None,
+                 connect_timeout=2, min_interval=0.25, max_interval=5,
+                 guest_ip_grace_period=30, cancellation_token=None):
+        self._host = host
+        self._port = port
+        self._guest_ips_func = guest_ips_func
+        self._connect_timeout = connect_timeout
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._guest_ip_grace_period = guest_ip_grace_period
+        self._cancellation_token = cancellation_token
+
+    def is_ssh_ready(self):
+        sock = None
+        try:
+            sock = socket.create_connection((self._host, self._port),
+                                            self._connect_timeout)
+            sock.settimeout(self._connect_timeout)
+            return sock.recv(len(SSH_BANNER_PREFIX)) == SSH_BANNER_PREFIX
+        except (socket.error, socket.timeout):
+            return False
+        finally:
+            if sock:
+                sock.close()
+
+    def _is_guest_ip_reported(self):
+        try:
+            return self._host in (self._guest_ips_func() or [])
+        except Exception as ex:
+            LOG.warn("Unable to retrieve the guest IP addresses: %s", ex)
+            # Don't block on the optional check
+            return True
+
+    def _sleep(self, interval, deadline):
+        cancellation.sleep(max(min(interval, deadline - time.time()), 0),
+                           self._cancellation_token)
+        return min(interval * 2, self._max_interval)
+
+    def wait_for_shutdown(self, timeout):
+        """Waits until the guest stops accepting SSH connections.
+
+        Returns False if the guest is still reachable after the timeout.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not self.is_ssh_ready():
+                LOG.debug("SSH on %s not reachable anymore", self._host)
+                return True
+            self._sleep(self._min_interval, deadline)
+        return False
+
+    def wait_until_ready(self, timeout):
+        start_time = time.time()
+        deadline = start_time + timeout
+        interval = self._min_interval
+        ssh_ready_time = None
+
+        while True:
+            if self.is_ssh_ready():
+                if ssh_ready_time is None:
+                    ssh_ready_time = time.time()
+
+                if (not self._guest_ips_func or
+                        self._is_guest_ip_reported()):
+                    break
+                if (time.time() - ssh_ready_time >=
+                        self._guest_ip_grace_period):
+                    LOG.warn("The guest did not report the IP address "
+                             "%s, skipping check", self._host)
+                    break
+
+            if time.time() >= deadline:
+                raise exceptions.GuestNotReadyException(
+                    "SSH on host %(host)s not available after %(timeout)d "
+                    "seconds" % {"host": self._host, "timeout": timeout})
+            interval = self._sleep(interval, deadline)
+
+        LOG.info("SSH on %(host)s ready after %(elapsed).2f s",
+                 {"host": self._host, "elapsed": time.time() - start_time})
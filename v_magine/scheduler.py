@@ -0,0 +1,237 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import logging
+import sys
+import threading
+import time
+
+import six
+from six.moves import queue
+
+from v_magine import exceptions
+from v_magine import timeline
+
+LOG = logging
+
+DEFAULT_MAX_WORKERS = 4
+
+
+class Step(object):
+    """A named unit of work with declared inputs and outputs.
+
+    The step function is called with its inputs as keyword arguments and
+    must return a value for each declared output: a single value if there
+    is one output, a tuple otherwise.
+
+    When resuming from a journal, a completed step is skipped and its
+    recorded outputs are used. Steps without a checkpoint, e.g. opening a
+    session, are executed again if any of the steps depending on them needs
+    to be executed. The outputs of steps with store_outputs set to False,
+    e.g. credentials, are not recorded in the journal, so those steps are
+    executed again as well when their outputs are needed.
+    """
+    def __init__(self, name, func, inputs=None, outputs=None, after=None,
+                 checkpoint=True, store_outputs=True):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.after = list(after or [])
+        self.checkpoint = checkpoint
+        self.store_outputs = store_outputs
+
+    def execute(self, context):
+        kwargs = dict((name, context[name]) for name in self.inputs)
+        result = self.func(**kwargs)
+
+        if not self.outputs:
+            return {}
+        if len(self.outputs) == 1:
+            result = (result,)
+        if result is None or len(result) != len(self.outputs):
+            raise exceptions.StepSchedulerException(
+                'Step "%s" did not return the expected outputs: %s' %
+                (self.name, ", ".join(self.outputs)))
+        return dict(zip(self.outputs, result))
+
+
+class StepScheduler(object):
+    """Runs a DAG of steps, executing independent steps concurrently.
+
+    Dependencies are derived from the step inputs, which must be either
+    provided by exactly one other step or be part of the initial context,
+    plus any explicit ordering constraint passed in "after". Ready steps are
+    started in the order in which they have been added, so steps on the
+    critical path should be added first.
+    """
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self._steps = []
+        self._max_workers = max_workers
+
+    def add_step(self, name, func, inputs=None, outputs=None, after=None,
+                 checkpoint=True, store_outputs=True):
+        if name in [step.name for step in self._steps]:
+            raise exceptions.StepSchedulerException(
+                'Duplicate step name: "%s"' % name)
+        step = Step(name, func, inputs, outputs, after, checkpoint,
+                    store_outputs)
+        self._steps.append(step)
+        return step
+
+    def get_steps(self):
+        return list(self._steps)
+
+    def get_dependencies(self, initial_names):
+        providers = {}
+        for step in self._steps:
+            for output in step.outputs:
+                if output in providers or output in initial_names:
+                    raise exceptions.StepSchedulerException(
+                        'Value "%s" is provided more than once' % output)
+                providers[output] = step.name
+
+        step_names = set([step.name for step in self._steps])
+        dependencies = {}
+        for step in self._steps:
+            step_deps = set()
+            for name in step.after:
+                if name not in step_names:
+                    raise exceptions.StepSchedulerException(
+                        'Step "%(step)s" depends on unknown step "%(name)s"' %
+                        {"step": step.name, "name": name})
+                step_deps.add(name)
+            for name in step.inputs:
+                if name in providers:
+                    step_deps.add(providers[name])
+                elif name not in initial_names:
+                    raise exceptions.StepSchedulerException(
+                        'Input "%(name)s" of step "%(step)s" is not provided' %
+                        {"step": step.name, "name": name})
+            dependencies[step.name] = step_deps
+
+        self._get_topological_order(dependencies)
+        return dependencies
+
+    @staticmethod
+    def _get_topological_order(dependencies):
+        order = []
+        unresolved = dict(dependencies)
+        while unresolved:
+            ready = sorted([name for (name, deps) in unresolved.items()
+                            if deps <= set(order)])
+            if not ready:
+                raise exceptions.StepSchedulerException(
+                    "Circular dependency between steps: %s" %
+                    ", ".join(sorted(unresolved)))
+            for name in ready:
+                order.append(name)
+                del unresolved[name]
+        return order
+
+    def _get_skipped_steps(self, dependencies, journal):
+        steps = dict((step.name, step) for step in self._steps)
+        dependents = dict((name, set()) for name in dependencies)
+        for (name, deps) in dependencies.items():
+            for dep in deps:
+                dependents[dep].add(name)
+
+        skipped = set()
+        all_dependents = {}
+        for name in reversed(self._get_topological_order(dependencies)):
+            all_dependents[name] = set(dependents[name])
+            for dependent in dependents[name]:
+                all_dependents[name] |= all_dependents[dependent]
+
+            if not journal.is_step_completed(name):
+                continue
+            step = steps[name]
+            if ((step.checkpoint and step.store_outputs) or
+                    all_dependents[name] <= skipped):
+                skipped.add(name)
+        return skipped
+
+    def _run_step(self, step, context, results):
+        LOG.debug('Starting step "%s"', step.name)
+        start_time = time.time()
+        try:
+            with timeline.span(step.name, timeline.CATEGORY_STEP):
+                outputs = step.execute(context)
+            LOG.debug('Step "%(step)s" completed in %(elapsed).2f s',
+                      {"step": step.name,
+                       "elapsed": time.time() - start_time})
+            results.put((step.name, outputs, None))
+        except BaseException:
+            LOG.debug('Step "%s" failed', step.name)
+            results.put((step.name, None, sys.exc_info()))
+
+    def run(self, context=None, journal=None, progress=None):
+        """Runs all the steps and returns the resulting context.
+
+        If a step fails, no further steps are started, the ones still
+        running are waited for and the first exception is raised.
+        """
+        context = dict(context or {})
+        dependencies = self.get_dependencies(set(context))
+
+        steps = dict((step.name, step) for step in self._steps)
+        pending = list(self._steps)
+        completed = set()
+        running = {}
+        results = queue.Queue()
+        exc_info = None
+
+        if journal:
+            skipped = self._get_skipped_steps(dependencies, journal)
+            for step in list(pending):
+                if step.name in skipped:
+                    LOG.info('Skipping completed step "%s"', step.name)
+                    context.update(journal.get_step_outputs(step.name))
+                    completed.add(step.name)
+                    pending.remove(step)
+
+        if progress:
+            progress.start([step.name for step in pending])
+
+        while pending or running:
+            if not exc_info:
+                for step in list(pending):
+                    if len(running) >= self._max_workers:
+                        break
+                    if dependencies[step.name] <= completed:
+                        pending.remove(step)
+                        if journal:
+                            journal.set_step_started(step.name)
+                        if progress:
+                            progress.set_step_started(step.name)
+                        thread = threading.Thread(
+                            target=self._run_step,
+                            args=(step, dict(context), results),
+                            name="Step-%s" % step.name)
+                        thread.daemon = True
+                        running[step.name] = thread
+                        thread.start()
+
+            if not running:
+                break
+
+            (step_name, outputs, step_exc_info) = results.get()
+            running.pop(step_name).join()
+            if step_exc_info:
+                exc_info = exc_info or step_exc_info
+                if journal:
+                    journal.set_step_failed(step_name, str(step_exc_info[1]))
+            else:
+                context.update(outputs)
+                completed.add(step_name)
+                if journal:
+                    journal.set_step_completed(
+                        step_name,
+                        outputs if steps[step_name].store_outputs else {})
+                if progress:
+                    progress.set_step_completed(step_name, outputs)
+
+        if exc_info:
+            six.reraise(*exc_info)
+        return context
@@ -0,0 +1,646 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+"""Runs a simulated deployment with in-memory virt, SSH and PXE backends.
+
+The simulation executes the actual Worker deployment logic, replacing only
+the operations interacting with Hyper-V, the controller VM and the host with
+fakes replaying the latencies of a real deployment, optionally scaled. This
+allows to measure the orchestration overhead on any platform, e.g.:
+
+    python -m v_magine.simulation --timeline timelines/<timestamp>.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from v_magine import cancellation
+from v_magine import compute
+from v_magine import constants
+from v_magine import logstore
+from v_magine import package_proxy
+from v_magine import progress
+from v_magine import readiness
+from v_magine import timeline
+from v_magine import utils
+from v_magine import worker
+from v_magine.virt import base as base_virt_driver
+
+LOG = logging
+
+DEFAULT_LATENCY_SCALE = 0.002
+
+# Seconds. The keys are the names of the deployment steps or downloads the
+# simulated operations belong to, so that latencies can be replayed from a
+# recorded deployment timeline
+DEFAULT_LATENCIES = dict(progress.DEFAULT_STEP_DURATIONS)
+DEFAULT_LATENCIES.update({
+    "prefetch_%s" % worker.HYPERV_NOVA_MSI_NAME: 60,
+    "prefetch_%s" % worker.FREERDP_WEBCONNECT_MSI_NAME: 20,
+})
+
+DEFAULT_CONSOLE_OUTPUT = [
+    b"Loading vmlinuz... ok\r\n",
+    b"Loading initrd.img... ok\r\n",
+    b"Starting installer, one moment...\r\n",
+    b"Installing software...\r\n",
+    b"Running post-installation scripts...\r\n",
+    b"Reached target Shutdown.\r\n",
+]
+
+SIMULATED_HOST_MEMORY = 16 * 1024 * 1024 * 1024
+SIMULATED_EXT_VSWITCH_NAME = "external"
+
+DEFAULT_DEPLOYMENT_ARGS = {
+    "ext_vswitch_name": SIMULATED_EXT_VSWITCH_NAME,
+    "centos_mirror": "http://mirror.centos.org/centos/7/os/x86_64/",
+    "openstack_vm_mem_mb": 8192,
+    "openstack_vm_vcpu_count": 2,
+    "admin_password": "Passw0rd",
+    "mgmt_ext_dhcp": True,
+    "use_proxy": False,
+    "hyperv_host_username": "Administrator",
+    "hyperv_host_password": "Passw0rd",
+    "compute_hosts": ["localhost", "hyperv-02"],
+    "fip_range": "192.168.133.0/24",
+    "fip_range_start": "192.168.133.100",
+    "fip_range_end": "192.168.133.200",
+    "fip_gateway": "192.168.133.1",
+    "fip_name_servers": ["8.8.8.8"],
+}
+
+
+class LatencyModel(object):
+    """Provides the latencies of the simulated operations, in seconds."""
+    def __init__(self, latencies=None, scale=DEFAULT_LATENCY_SCALE):
+        self._latencies = dict(DEFAULT_LATENCIES)
+        self._latencies.update(latencies or {})
+        self._scale = scale
+
+    @classmethod
+    def from_timeline(cls, timeline_path, scale=DEFAULT_LATENCY_SCALE):
+        """Replays the step and download latencies of a saved timeline."""
+        with open(timeline_path, 'rb') as f:
+            data = json.loads(f.read().decode())
+
+        latencies = {}
+        for span in data["spans"]:
+            if (span["category"] in [timeline.CATEGORY_STEP,
+                                     timeline.CATEGORY_DOWNLOAD] and
+                    span.get("duration") is not None):
+                latencies[span["name"]] = span["duration"]
+        return cls(latencies, scale)
+
+    def get(self, name):
+        return self._latencies.get(name, 0) * self._scale
+
+    def sleep(self, name):
+        cancellation.sleep(self.get(name))
+
+
+class SimulatedGuest(object):
+    """Tracks when the controller VM guest accepts SSH connections."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ssh_ready_time = None
+        self._ip_addresses = []
+
+    def boot(self, boot_time):
+        with self._lock:
+            self._ssh_ready_time = time.time() + boot_time
+
+    def shutdown(self):
+        with self._lock:
+            self._ssh_ready_time = None
+
+    def is_ssh_ready(self):
+        with self._lock:
+            return (self._ssh_ready_time is not None and
+                    time.time() >= self._ssh_ready_time)
+
+    def set_ip_addresses(self, ip_addresses):
+        self._ip_addresses = list(ip_addresses)
+
+    def get_ip_addresses(self):
+        if self.is_ssh_ready():
+            return list(self._ip_addresses)
+        return []
+
+
+class _SimulatedConsoleThread(threading.Thread):
+    def __init__(self, console_named_pipe, console_output, delay):
+        super(_SimulatedConsoleThread, self).__init__()
+        self.setDaemon(True)
+        self._console_named_pipe = console_named_pipe
+        self._console_output = console_output
+        self._delay = delay
+
+    def run(self):
+        try:
+            # Blocks until the console is opened for reading
+            with open(self._console_named_pipe, 'wb') as f:
+                for data in self._console_output:
+                    time.sleep(self._delay)
+                    f.write(data)
+                    f.flush()
+        except Exception as ex:
+            LOG.exception(ex)
+
+
+class FakeVirtDriver(base_virt_driver.BaseDriver):
+    """In-memory virt driver.
+
+    On platforms supporting FIFOs the VM console output is written to the
+    console named pipe while the PXE installation proceeds, otherwise it is
+    written at once when the VM is started.
+    """
+    def __init__(self, latencies, guest, console_output=None):
+        self._latencies = latencies
+        self._guest = guest
+        self._console_output = console_output or DEFAULT_CONSOLE_OUTPUT
+        self._vms = {}
+        self._vswitches = {SIMULATED_EXT_VSWITCH_NAME: {
+            "name": SIMULATED_EXT_VSWITCH_NAME, "is_external": True}}
+
+    def check_platform(self):
+        pass
+
+    def get_host_available_memory(self):
+        return SIMULATED_HOST_MEMORY
+
+    def get_vm_memory_usage(self, vm_name):
+        return self._vms[vm_name]["max_memory_mb"] * 1024 * 1024
+
+    def get_host_nics(self):
+        return [{"name": "Ethernet", "in_use": True}]
+
+    def get_vswitches(self):
+        return list(self._vswitches.values())
+
+    def vm_exists(self, vm_name):
+        return vm_name in self._vms
+
+    def vm_is_stopped(self, vm_name):
+        return not self._vms[vm_name]["running"]
+
+    def power_off_vm(self, vm_name):
+        self._vms[vm_name]["running"] = False
+        self._guest.shutdown()
+
+    def destroy_vm(self, vm_name):
+        self._latencies.sleep("check_remove_vm")
+        console_named_pipe = self._vms.pop(vm_name)["console_named_pipe"]
+        if os.path.exists(console_named_pipe):
+            os.remove(console_named_pipe)
+
+    def create_vm(self, vm_name, vm_path, max_disk_size, max_memory_mb,
+                  min_memory_mb, vcpus_num, vmnic_info, vfd_path,
+                  iso_path, console_named_pipe):
+        self._latencies.sleep("create_openstack_vm")
+        if os.path.exists(console_named_pipe):
+            os.remove(console_named_pipe)
+        if hasattr(os, "mkfifo"):
+            os.mkfifo(console_named_pipe)
+
+        self._vms[vm_name] = {"max_memory_mb": max_memory_mb,
+                              "vcpus_num": vcpus_num,
+                              "vmnic_info": vmnic_info,
+                              "console_named_pipe": console_named_pipe,
+                              "running": False}
+
+    def start_vm(self, vm_name):
+        vm = self._vms[vm_name]
+        vm["running"] = True
+
+        delay = (self._latencies.get("pxe_boot_openstack_vm") /
+                 len(self._console_output))
+        console_thread = _SimulatedConsoleThread(
+            vm["console_named_pipe"], self._console_output, delay)
+        if hasattr(os, "mkfifo"):
+            console_thread.start()
+        else:
+            console_thread.run()
+
+    def reboot_vm(self, vm_name):
+        self._latencies.sleep("reboot_openstack_vm")
+        self._guest.boot(self._latencies.get("wait_for_rdo_vm_reboot"))
+
+    def vswitch_exists(self, vswitch_name):
+        return vswitch_name in self._vswitches
+
+    def create_vswitch(self, vswitch_name, external_port_name=None,
+                       create_internal_port=False):
+        self._vswitches[vswitch_name] = {
+            "name": vswitch_name, "is_external": bool(external_port_name)}
+
+    def add_vswitch_host_firewall_rule(self, vswitch_name, rule_name,
+                                       local_ports,
+                                       protocol=base_virt_driver.TCP,
+                                       allow=True, description=""):
+        pass
+
+    def set_vswitch_host_ip(self, vswitch_name, host_ip, subnet_mask):
+        self._latencies.sleep("create_vswitches")
+
+    def get_guest_ip_addresses(self, vm_name):
+        return (self._guest.get_ip_addresses(), [])
+
+
+class FakePyBootdManager(object):
+    def __init__(self, latencies):
+        self._latencies = latencies
+        self._mac_pxelinux_cfgs = {}
+        self._started = False
+
+    def generate_mac_pxelinux_cfg(self, pxe_mac_address, params):
+        self._mac_pxelinux_cfgs[pxe_mac_address] = params
+
+    def start(self, listen_address, tftp_root_dir, pool_start, reservations,
+              pool_count=None):
+        self._latencies.sleep("start_pxe_service")
+        self._started = True
+
+    def is_healthy(self):
+        return self._started
+
+    def get_stats(self):
+        if self._started:
+            return {"bootp_requests": 0, "leases": {}, "tftp_requests": 0,
+                    "tftp_active_transfers": 0, "tftp_bytes_sent": 0,
+                    "tftp_throughput": 0, "tftp_recent_transfers": []}
+
+    def stop(self):
+        self._started = False
+
+
+class FakeRDOInstaller(object):
+    def __init__(self, latencies, guest, stdout_callback, stderr_callback):
+        self._latencies = latencies
+        self._guest = guest
+        self._stdout_callback = stdout_callback
+        self._stderr_callback = stderr_callback
+        self._connected = False
+
+    def _check_connected(self):
+        if not self._connected:
+            raise Exception("Not connected")
+
+    def _exec_simulated_cmd(self, name):
+        self._check_connected()
+        self._stdout_callback("Simulating %s\r\n" % name)
+        self._latencies.sleep(name)
+
+    def connect(self, host, ssh_key_path, username, password, term_type,
+                term_cols, term_rows):
+        if not self._guest.is_ssh_ready():
+            raise Exception("Unable to connect to %s" % host)
+        self._latencies.sleep("connect_rdo_vm")
+        self._connected = True
+
+    def disconnect(self):
+        self._connected = False
+
+    def update_os(self):
+        self._exec_simulated_cmd("update_rdo_vm")
+
+    def reboot(self):
+        self._check_connected()
+        self._guest.boot(self._latencies.get("wait_for_rdo_vm_reboot"))
+        self.disconnect()
+
+    def check_new_kernel(self):
+        self._exec_simulated_cmd("check_rdo_vm_new_kernel")
+        return True
+
+    def configure_yum_proxy(self, proxy_url):
+        self._exec_simulated_cmd("configure_rdo_vm_yum_proxy")
+        return True
+
+    def get_nova_config(self):
+        self._exec_simulated_cmd("get_nova_config")
+        return {"oslo_messaging_rabbit": {"rabbit_host": "localhost"}}
+
+    def check_hyperv_compute_services(self, host_name):
+        self._check_connected()
+
+    def install_rdo(self, rdo_admin_password, fip_range, fip_range_start,
+                    fip_range_end, fip_gateway, fip_name_servers):
+        self._exec_simulated_cmd("install_rdo")
+
+    def install_lis(self):
+        self._exec_simulated_cmd("install_lis")
+
+
+class SimulatedSSHReadinessProber(readiness.SSHReadinessProber):
+    def __init__(self, guest, host, **kwargs):
+        super(SimulatedSSHReadinessProber, self).__init__(host, **kwargs)
+        self._guest = guest
+
+    def is_ssh_ready(self):
+        return self._guest.is_ssh_ready()
+
+
+class FakeComputeHostTransport(compute.BaseComputeHostTransport):
+    def __init__(self, host):
+        self._host = host
+
+    def get_hostname(self):
+        return self._host
+
+    def get_windows_version_info(self):
+        return {"description": "Simulated Windows Server",
+                "version": "10.0.14393"}
+
+    def makedirs(self, path):
+        pass
+
+    def put_file(self, local_path):
+        return local_path
+
+    def get_installed_products(self, vendor):
+        return []
+
+    def install_msi(self, msi_path, features, properties, log_file):
+        pass
+
+    def uninstall_product(self, product_id, log_file):
+        pass
+
+    def add_user_to_group_by_sid(self, username, group_sid):
+        pass
+
+
+class SimulatedDeploymentActions(object):
+    """Deployment actions on top of the fake virt and PXE backends."""
+    def __init__(self, virt_driver, pybootd_manager, guest, latencies,
+                 data_dir):
+        self._virt_driver = virt_driver
+        self._pybootd_manager = pybootd_manager
+        self._guest = guest
+        self._latencies = latencies
+        self._data_dir = data_dir
+        self._vm_name = None
+        self._openstack_deployed = False
+
+    def is_openstack_deployed(self):
+        return self._openstack_deployed
+
+    def set_openstack_deployment_status(self, deployed):
+        self._openstack_deployed = deployed
+
+    def check_platform_requirements(self):
+        self._virt_driver.check_platform()
+
+    def generate_controller_ssh_key(self):
+        self._latencies.sleep("generate_ssh_key")
+        key_path = os.path.join(self._data_dir, "simulated_rsa")
+        pub_key_path = "%s.pub" % key_path
+        for path in [key_path, pub_key_path]:
+            with open(path, 'wb') as f:
+                f.write(b"simulated")
+        return (key_path, pub_key_path)
+
+    def get_password_md5(self, password):
+        self._latencies.sleep("generate_md5_password")
+        return "$1$simulated$"
+
+    def get_console_named_pipe(self, vm_name):
+        return os.path.join(self._data_dir, "%s.console" % vm_name)
+
+    def vm_exists(self, vm_name):
+        return self._virt_driver.vm_exists(vm_name)
+
+    def check_remove_vm(self, vm_name):
+        if self._virt_driver.vm_exists(vm_name):
+            if not self._virt_driver.vm_is_stopped(vm_name):
+                self._virt_driver.power_off_vm(vm_name)
+            self._virt_driver.destroy_vm(vm_name)
+
+    def get_internal_network_config(self):
+        subnet = utils.get_random_ipv4_subnet()
+        return {"subnet": subnet,
+                "netmask": "255.255.255.0",
+                "host_ip": subnet[:-1] + "1"}
+
+    def create_vswitches(self, external_vswitch_name, internal_network_config):
+        if not self._virt_driver.vswitch_exists(external_vswitch_name):
+            raise Exception("Virtual switch not found: %s" %
+                            external_vswitch_name)
+        self._virt_driver.set_vswitch_host_ip(
+            "%s-internal" % constants.PRODUCT_NAME,
+            internal_network_config["host_ip"],
+            internal_network_config["netmask"])
+
+    def get_openstack_vm_network_config(self, vm_name, external_vswitch_name):
+        return [(external_vswitch_name, "%s-%s" % (vm_name, vnic_name),
+                 utils.get_random_mac_address(), vnic_name == "pxe",
+                 False, None, None, None)
+                for vnic_name in ["mgmt-ext", "mgmt-int", "data", "ext",
+                                  "pxe"]]
+
+    def create_kickstart_image(self, ks_image_path, *args):
+        self._latencies.sleep("create_kickstart_image")
+        with open(ks_image_path, 'wb') as f:
+            f.write(b"simulated")
+
+    def create_openstack_vm(self, vm_name, vm_dir, vcpu_count, max_mem_mb,
+                            vfd_path, iso_path, vm_network_config,
+                            console_named_pipe):
+        self._virt_driver.create_vm(vm_name, vm_dir, None, max_mem_mb,
+                                    max_mem_mb, vcpu_count,
+                                    vm_network_config, vfd_path, iso_path,
+                                    console_named_pipe)
+        self._vm_name = vm_name
+
+    def get_openstack_vm_ip_info(self, vm_network_config, subnet):
+        base_addr = subnet[:-1]
+        vnic_ip_info = []
+        for (last_octet, vnic_name) in [(2, "pxe"), (3, "mgmt-int")]:
+            for vif_config in vm_network_config:
+                if vif_config[1] == "%s-%s" % (self._vm_name, vnic_name):
+                    vnic_ip_info.append((vif_config[1], vif_config[2],
+                                         base_addr + str(last_octet)))
+
+        self._guest.set_ip_addresses([vnic_ip_info[-1][2]])
+        return vnic_ip_info
+
+    def generate_mac_pxelinux_cfg(self, pxe_mac_address, *args):
+        self._pybootd_manager.generate_mac_pxelinux_cfg(pxe_mac_address,
+                                                        args)
+
+    def start_pxe_service(self, listen_address, reservations, pxe_os_id):
+        self._pybootd_manager.start(listen_address, pxe_os_id,
+                                    reservations[0][1], reservations)
+
+    def stop_pxe_service(self):
+        self._pybootd_manager.stop()
+
+    def start_package_proxy(self, listen_address, proxy_url, proxy_username,
+                            proxy_password):
+        self._latencies.sleep("start_package_proxy")
+        return "http://%s:%d" % (listen_address, package_proxy.DEFAULT_PORT)
+
+    def stop_package_proxy(self):
+        pass
+
+    def start_openstack_vm(self):
+        self._virt_driver.start_vm(self._vm_name)
+
+    def reboot_openstack_vm(self):
+        self._virt_driver.reboot_vm(self._vm_name)
+
+    def get_vm_ip_addresses(self, vm_name):
+        (ipv4_addresses,
+         ipv6_addresses) = self._virt_driver.get_guest_ip_addresses(vm_name)
+        return ipv4_addresses + ipv6_addresses
+
+    def get_compute_host_transport(self, host, username, password,
+                                   remote=False):
+        return FakeComputeHostTransport(host)
+
+    def validate_compute_hosts(self, compute_hosts, username, password):
+        pass
+
+    def set_compute_hosts(self, compute_hosts):
+        pass
+
+    def check_installed_components(self, transport):
+        self._latencies.sleep("uninstall_hyperv_components")
+        return []
+
+    def uninstall_product(self, transport, product_id, log_file):
+        pass
+
+    def _download_msi(self, name, target_path, cancellation_token):
+        cancellation.sleep(self._latencies.get("prefetch_%s" % name),
+                           cancellation_token)
+        with open(target_path, 'wb') as f:
+            f.write(b"simulated")
+
+    def download_hyperv_compute_msi(self, target_path,
+                                    cancellation_token=None):
+        self._download_msi(worker.HYPERV_NOVA_MSI_NAME, target_path,
+                           cancellation_token)
+
+    def download_freerdp_webconnect_msi(self, target_path,
+                                        cancellation_token=None):
+        self._download_msi(worker.FREERDP_WEBCONNECT_MSI_NAME, target_path,
+                           cancellation_token)
+
+    def install_hyperv_compute(self, transport, msi_path, nova_config,
+                               openstack_base_dir, hyperv_host_username,
+                               hyperv_host_password):
+        self._latencies.sleep("install_hyperv_compute")
+
+    def install_freerdp_webconnect(self, transport, msi_path, nova_config,
+                                   hyperv_host_username,
+                                   hyperv_host_password):
+        self._latencies.sleep("install_freerdp_webconnect")
+
+
+class SimulatedWorker(worker.Worker):
+    def __init__(self, data_dir, latencies=None, console_output=None,
+                 log_store=None):
+        self._latencies = latencies or LatencyModel()
+        self._guest = SimulatedGuest()
+        dep_actions = SimulatedDeploymentActions(
+            FakeVirtDriver(self._latencies, self._guest, console_output),
+            FakePyBootdManager(self._latencies), self._guest,
+            self._latencies, data_dir)
+        super(SimulatedWorker, self).__init__(dep_actions, data_dir,
+                                              log_store)
+
+    def _create_rdo_installer(self):
+        return FakeRDOInstaller(self._latencies, self._guest,
+                                self._send_step_output,
+                                self._stderr_callback)
+
+    def _get_rdo_vm_prober(self, mgmt_ip):
+        return SimulatedSSHReadinessProber(
+            self._guest, mgmt_ip,
+            guest_ips_func=lambda: self._dep_actions.get_vm_ip_addresses(
+                worker.OPENSTACK_CONTROLLER_VM_NAME),
+            cancellation_token=self._cancellation_token)
+
+
+def run_simulation(data_dir, latencies=None, console_output=None,
+                   args=None):
+    """Runs a simulated deployment, returns True if successful."""
+    def _progress_status_update(enable, step, total_steps, msg,
+                                percentage=None, eta=None):
+        if msg and percentage is not None:
+            LOG.info("Progress %(percentage).1f%%, ETA %(eta).2f s: %(msg)s",
+                     {"percentage": percentage, "eta": eta, "msg": msg})
+
+    def _error(ex):
+        LOG.error("Simulated deployment failed: %s", ex)
+
+    deployment_args = dict(DEFAULT_DEPLOYMENT_ARGS)
+    deployment_args["openstack_base_dir"] = os.path.join(data_dir,
+                                                         "OpenStack")
+    deployment_args.update(args or {})
+
+    log_store = logstore.LogStore(data_dir)
+    log_store.start()
+    try:
+        simulated_worker = SimulatedWorker(data_dir, latencies,
+                                           console_output, log_store)
+        simulated_worker.set_stdout_callback(lambda data: None)
+        simulated_worker.set_stderr_callback(lambda data: None)
+        simulated_worker.set_error_callback(_error)
+        simulated_worker.set_progress_status_update_callback(
+            _progress_status_update)
+        return simulated_worker.deploy_openstack(deployment_args)
+    finally:
+        log_store.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs a simulated OpenStack deployment")
+    parser.add_argument("--timeline",
+                        help="Deployment timeline providing the latencies")
+    parser.add_argument("--scale", type=float, default=DEFAULT_LATENCY_SCALE,
+                        help="Factor applied to the latencies")
+    parser.add_argument("--console-log",
+                        help="VM console log providing the console output")
+    parser.add_argument("--data-dir",
+                        help="Directory for the journal and the timelines")
+    parsed_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if parsed_args.timeline:
+        latencies = LatencyModel.from_timeline(parsed_args.timeline,
+                                               parsed_args.scale)
+    else:
+        latencies = LatencyModel(scale=parsed_args.scale)
+
+    console_output = None
+    if parsed_args.console_log:
+        with open(parsed_args.console_log, 'rb') as f:
+            console_output = f.readlines()
+
+    data_dir = parsed_args.data_dir or tempfile.mkdtemp(
+        prefix="%s-simulation-" % constants.PRODUCT_NAME)
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    start_time = time.time()
+    success = run_simulation(data_dir, latencies, console_output)
+    LOG.info("Simulated deployment %(result)s in %(elapsed).2f s, data "
+             "directory: %(data_dir)s",
+             {"result": "succeeded" if success else "failed",
+              "elapsed": time.time() - start_time, "data_dir": data_dir})
+    return 0 if success else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
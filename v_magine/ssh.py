@@ -0,0 +1,510 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import argparse
+import binascii
+import contextlib
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+from six.moves import shlex_quote
+
+from v_magine import cancellation
+from v_magine import timeline
+from v_magine import utils
+
+LOG = logging
+
+SSH_PORT = 22
+SSH_CONNECT_TIMEOUT_S = 30
+SSH_KEEPALIVE_INTERVAL_S = 15
+# OpenSSH MaxSessions default
+DEFAULT_MAX_CHANNELS = 10
+# About 15 minutes, e.g. to wait for a reboot
+CONNECT_MAX_ATTEMPTS = 35
+CONNECT_MIN_RETRY_INTERVAL_S = 1
+CONNECT_MAX_RETRY_INTERVAL_S = 30
+HASH_READ_SIZE = 1024 * 1024
+# The paramiko default window (2 MB) stalls pipelined writes of large files
+SFTP_WINDOW_SIZE = 16 * 1024 * 1024
+SFTP_MAX_PACKET_SIZE = 32 * 1024
+SFTP_WRITE_SIZE = 1024 * 1024
+
+
+class SSHSession(object):
+    """A persistent SSH connection shared by all the remote operations.
+
+    Channels are multiplexed on a single transport, kept alive with
+    keepalive messages, and at most max_channels are open at the same time.
+    The SFTP subsystem is opened once and reused. If the connection is
+    lost, e.g. after a reboot, it is established again when the next
+    channel is opened.
+
+    Transport compression trades CPU for bandwidth, it is worth enabling
+    only for slow links and compressible payloads.
+    """
+    def __init__(self, cancellation_token=None,
+                 max_channels=DEFAULT_MAX_CHANNELS, compress=False,
+                 sftp_window_size=SFTP_WINDOW_SIZE,
+                 sftp_max_packet_size=SFTP_MAX_PACKET_SIZE):
+        self._cancellation_token = (cancellation_token or
+                                    cancellation.CancellationToken())
+        self._compress = compress
+        self._sftp_window_size = sftp_window_size
+        self._sftp_max_packet_size = sftp_max_packet_size
+        self._channel_slots = threading.BoundedSemaphore(max_channels)
+        self._lock = threading.RLock()
+        self._client = None
+        self._sftp = None
+        self._conn_info = None
+        self._metrics = {
+            "connections": 0,
+            "last_connect_time_s": None,
+            "total_connect_time_s": 0,
+            "channels_opened": 0,
+            "channels_active": 0,
+            "max_channels_active": 0,
+            "sftp_sessions_opened": 0,
+        }
+
+    @utils.retry_on_error(max_attempts=CONNECT_MAX_ATTEMPTS,
+                          sleep_seconds=CONNECT_MIN_RETRY_INTERVAL_S,
+                          backoff_factor=2,
+                          max_sleep_seconds=CONNECT_MAX_RETRY_INTERVAL_S)
+    @timeline.timed(timeline.CATEGORY_SSH, "ssh_connect")
+    def connect(self, host, username, password=None, key_filename=None,
+                port=SSH_PORT):
+        with self._lock:
+            self._conn_info = (host, username, password, key_filename, port)
+            self._connect()
+
+    def _connect(self):
+        (host, username, password, key_filename, port) = self._conn_info
+        self._close_client()
+
+        self._cancellation_token.check()
+        LOG.debug("Connecting to %s", host)
+        start_time = time.time()
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host, port=port, username=username, password=password,
+                       key_filename=key_filename,
+                       timeout=SSH_CONNECT_TIMEOUT_S,
+                       compress=self._compress)
+        client.get_transport().set_keepalive(SSH_KEEPALIVE_INTERVAL_S)
+        self._client = client
+
+        connect_time = time.time() - start_time
+        self._metrics["connections"] += 1
+        self._metrics["last_connect_time_s"] = connect_time
+        self._metrics["total_connect_time_s"] += connect_time
+        LOG.debug("Connected to %(host)s in %(connect_time).2f s",
+                  {"host": host, "connect_time": connect_time})
+
+    def is_active(self):
+        transport = self._client and self._client.get_transport()
+        return bool(transport and transport.is_active())
+
+    def _get_transport(self):
+        with self._lock:
+            if not self.is_active():
+                if not self._conn_info:
+                    raise Exception("Not connected")
+                LOG.info("SSH connection lost, reconnecting")
+                self.connect(*self._conn_info)
+            return self._client.get_transport()
+
+    def acquire_channel(self):
+        """Opens a session channel, to be closed with release_channel."""
+        self._channel_slots.acquire()
+        try:
+            chan = self._get_transport().open_session()
+        except Exception:
+            self._channel_slots.release()
+            raise
+
+        with self._lock:
+            self._metrics["channels_opened"] += 1
+            self._metrics["channels_active"] += 1
+            self._metrics["max_channels_active"] = max(
+                self._metrics["max_channels_active"],
+                self._metrics["channels_active"])
+        return chan
+
+    def release_channel(self, chan):
+        chan.close()
+        with self._lock:
+            self._metrics["channels_active"] -= 1
+        self._channel_slots.release()
+
+    @contextlib.contextmanager
+    def open_channel(self):
+        """Opens a session channel, closing it on exit."""
+        chan = self.acquire_channel()
+        try:
+            yield chan
+        finally:
+            self.release_channel(chan)
+
+    def call_cancellable(self, chan, func, *args, **kwargs):
+        """Calls func, closing chan if the operation is cancelled."""
+        # Closing the channel unblocks any pending operation on it
+        handle = self._cancellation_token.register(chan.close)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._cancellation_token.unregister(handle)
+            self._cancellation_token.check()
+
+    def exec_command(self, cmd):
+        """Executes a command, returns its exit status and stdout."""
+        with self.open_channel() as chan:
+            chan.exec_command(cmd)
+            output = self.call_cancellable(chan, chan.makefile('rb').read)
+            return (chan.recv_exit_status(), output)
+
+    def get_connection_count(self):
+        with self._lock:
+            return self._metrics["connections"]
+
+    def get_sftp(self):
+        with self._lock:
+            transport = self._get_transport()
+            if (not self._sftp or self._sftp.get_channel().closed or
+                    self._sftp.get_channel().get_transport() != transport):
+                self._sftp = paramiko.SFTPClient.from_transport(
+                    transport, window_size=self._sftp_window_size,
+                    max_packet_size=self._sftp_max_packet_size)
+                self._metrics["sftp_sessions_opened"] += 1
+            return self._sftp
+
+    def get_metrics(self):
+        with self._lock:
+            return dict(self._metrics)
+
+    def _close_client(self):
+        if self._sftp:
+            self._sftp.close()
+            self._sftp = None
+        if self._client:
+            self._client.close()
+            self._client = None
+
+    def close(self):
+        with self._lock:
+            if self._client:
+                LOG.debug("SSH session metrics: %s", self._metrics)
+            self._close_client()
+            self._conn_info = None
+
+
+class UploadCache(object):
+    """Uploads files on the remote host, skipping the ones already there.
+
+    Files uploaded during the current connection are recorded in a manifest
+    by SHA-256 hash and skipped without any round trip. The others are
+    checked with a single remote sha256sum and only the missing or changed
+    ones are transferred, on the shared SFTP session.
+    """
+    def __init__(self, session, write_size=SFTP_WRITE_SIZE):
+        self._session = session
+        self._write_size = write_size
+        self._lock = threading.Lock()
+        self._local_hashes = {}
+        self._manifest = {}
+        self._manifest_connection = None
+
+    def _get_local_hash(self, path):
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+        cached = self._local_hashes.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(HASH_READ_SIZE)
+                if not data:
+                    break
+                sha256.update(data)
+        self._local_hashes[path] = (key, sha256.hexdigest())
+        return self._local_hashes[path][1]
+
+    def _get_remote_hashes(self, remote_paths):
+        # Missing files are reported with a non-zero exit status, the
+        # hashes of the existing ones are still returned
+        (exit_status, output) = self._session.exec_command(
+            "sha256sum -- %s 2>/dev/null" %
+            " ".join([shlex_quote(path) for path in remote_paths]))
+
+        remote_hashes = {}
+        for line in output.decode("utf-8", "replace").splitlines():
+            (file_hash, sep, path) = line.partition("  ")
+            if sep:
+                remote_hashes[path] = file_hash
+        return remote_hashes
+
+    def _write_file(self, sftp, local_path, path, progress_callback):
+        size = os.path.getsize(local_path)
+        transferred = 0
+        with open(local_path, 'rb') as src:
+            with sftp.open(path, 'wb') as dst:
+                # Do not wait for each write to be acknowledged, errors are
+                # reported when closing the file
+                dst.set_pipelined(True)
+                while True:
+                    data = src.read(self._write_size)
+                    if not data:
+                        break
+                    dst.write(data)
+                    transferred += len(data)
+                    if progress_callback:
+                        progress_callback(transferred, size)
+
+        remote_size = sftp.stat(path).st_size
+        if remote_size != size:
+            raise IOError("Size mismatch in upload: %(remote_size)d != "
+                          "%(size)d" % {"remote_size": remote_size,
+                                        "size": size})
+
+    def _put_file(self, local_path, remote_path, progress_callback=None):
+        sftp = self._session.get_sftp()
+        # Avoid leaving a truncated file if the transfer is interrupted
+        tmp_path = "%s.part" % remote_path
+        self._session.call_cancellable(
+            sftp.get_channel(), self._write_file, sftp, local_path,
+            tmp_path, progress_callback)
+        sftp.posix_rename(tmp_path, remote_path)
+
+    def upload(self, files, progress_callback=None):
+        """Uploads the given (local_path, remote_path) pairs.
+
+        progress_callback is called with the remote path, the transferred
+        and the total bytes while each file is uploaded.
+        """
+        with self._lock:
+            # The remote files might have changed while disconnected, e.g.
+            # if the host has been reinstalled
+            connection = self._session.get_connection_count()
+            if self._manifest_connection != connection:
+                self._manifest = {}
+                self._manifest_connection = connection
+
+            hashes = dict((remote_path, self._get_local_hash(local_path))
+                          for (local_path, remote_path) in files)
+            unknown = [remote_path for (local_path, remote_path) in files
+                       if self._manifest.get(remote_path) !=
+                       hashes[remote_path]]
+            if not unknown:
+                return
+
+            remote_hashes = self._get_remote_hashes(unknown)
+            for (local_path, remote_path) in files:
+                if remote_path not in unknown:
+                    continue
+                if remote_hashes.get(remote_path) != hashes[remote_path]:
+                    LOG.debug("Uploading %(local_path)s to %(remote_path)s",
+                              {"local_path": local_path,
+                               "remote_path": remote_path})
+                    callback = None
+                    if progress_callback:
+                        callback = functools.partial(progress_callback,
+                                                     remote_path)
+                    self._put_file(local_path, remote_path, callback)
+                else:
+                    LOG.debug("%s is up to date, skipping upload",
+                              remote_path)
+                self._manifest[remote_path] = hashes[remote_path]
+
+
+class _BenchmarkSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(
+            os.fstat(self.writefile.fileno()))
+
+
+class _BenchmarkSFTPServer(paramiko.SFTPServerInterface):
+    """Write only SFTP server for the files in root_dir."""
+    def __init__(self, server, root_dir, *args, **kwargs):
+        super(_BenchmarkSFTPServer, self).__init__(server, *args, **kwargs)
+        self._root_dir = root_dir
+
+    def _get_path(self, path):
+        return os.path.join(self._root_dir, os.path.basename(path))
+
+    def open(self, path, flags, attr):
+        handle = _BenchmarkSFTPHandle(flags)
+        handle.writefile = open(self._get_path(path), 'wb')
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.stat(self._get_path(path)))
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+    lstat = stat
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.rename(self._get_path(oldpath), self._get_path(newpath))
+            return paramiko.SFTP_OK
+        except OSError as ex:
+            return paramiko.SFTPServer.convert_errno(ex.errno)
+
+
+class _BenchmarkServer(paramiko.ServerInterface):
+    def __init__(self, username, password):
+        self._username = username
+        self._password = password
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (self._username, self._password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        # Only the remote hashes are requested, reporting the files as
+        # missing so that they are always uploaded. The channel is closed
+        # by the client, after getting the reply to this request
+        def _reply():
+            channel.send_exit_status(1)
+            channel.shutdown_write()
+
+        threading.Thread(target=_reply).start()
+        return True
+
+
+def _serve_sftp(sock, host_key, root_dir, window_size, compress, username,
+                password):
+    """Serves a single SFTP connection, returns the server transport."""
+    (conn, addr) = sock.accept()
+    # The window advertised by the server limits the data in flight of
+    # the uploads
+    transport = paramiko.Transport(
+        conn, default_window_size=window_size,
+        default_max_packet_size=SFTP_MAX_PACKET_SIZE)
+    transport.use_compression(compress)
+    transport.add_server_key(host_key)
+    transport.set_subsystem_handler("sftp", paramiko.SFTPServer,
+                                    _BenchmarkSFTPServer, root_dir)
+    transport.start_server(server=_BenchmarkServer(username, password))
+    return transport
+
+
+def _benchmark_upload(host_key, local_path, root_dir, window_size, compress,
+                      upload_func):
+    """Returns the time taken by upload_func on a loopback connection."""
+    username = "v-magine"
+    password = binascii.hexlify(os.urandom(16)).decode()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1)
+    server_transports = []
+    server_thread = threading.Thread(
+        target=lambda: server_transports.append(_serve_sftp(
+            sock, host_key, root_dir, window_size, compress, username,
+            password)))
+    server_thread.daemon = True
+    server_thread.start()
+
+    session = SSHSession(compress=compress, sftp_window_size=window_size)
+    try:
+        session.connect("127.0.0.1", username, password,
+                        port=sock.getsockname()[1])
+        remote_path = "/%s" % os.path.basename(local_path)
+        start_time = time.time()
+        upload_func(session, local_path, remote_path)
+        return time.time() - start_time
+    finally:
+        session.close()
+        server_thread.join()
+        for transport in server_transports:
+            transport.close()
+        sock.close()
+
+
+def _write_benchmark_file(path, size_mb, compressible):
+    # Text lines with few distinct values compress like logs or scripts
+    text = "".join("%08d benchmark data line\n" % (i % 16)
+                   for i in range(32 * 1024)).encode()
+    with open(path, 'wb') as f:
+        for i in range(size_mb):
+            f.write(text[:1024 * 1024] if compressible else
+                    os.urandom(1024 * 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the SFTP upload throughput of sftp.put and "
+        "of UploadCache.upload on a loopback connection")
+    parser.add_argument("--size-mb", type=int, default=64,
+                        help="Size of the uploaded file")
+    parser.add_argument("--window-sizes-mb", type=int, nargs="+",
+                        default=[2, SFTP_WINDOW_SIZE // (1024 * 1024), 64],
+                        help="SSH channel window sizes")
+    parser.add_argument("--compress", action="store_true",
+                        help="Enable the SSH transport compression")
+    parser.add_argument("--compressible", action="store_true",
+                        help="Upload text instead of random data")
+    parsed_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # The server transports log the connections closed by the clients
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+    host_key = paramiko.RSAKey.generate(2048)
+    methods = [
+        ("sftp.put", lambda session, local_path, remote_path:
+            session.get_sftp().put(local_path, remote_path)),
+        ("upload", lambda session, local_path, remote_path:
+            UploadCache(session).upload([(local_path, remote_path)])),
+    ]
+
+    local_dir = tempfile.mkdtemp()
+    root_dir = tempfile.mkdtemp()
+    try:
+        local_path = os.path.join(local_dir, "upload.bin")
+        _write_benchmark_file(local_path, parsed_args.size_mb,
+                              parsed_args.compressible)
+
+        for window_size_mb in parsed_args.window_sizes_mb:
+            for (method_name, upload_func) in methods:
+                duration = _benchmark_upload(
+                    host_key, local_path, root_dir,
+                    window_size_mb * 1024 * 1024, parsed_args.compress,
+                    upload_func)
+                print("%(method)-10s window %(window)3d MB: %(duration)6.2f "
+                      "s, %(throughput)7.2f MB/s" %
+                      {"method": method_name, "window": window_size_mb,
+                       "duration": duration,
+                       "throughput": parsed_args.size_mb / duration})
+    finally:
+        shutil.rmtree(local_dir)
+        shutil.rmtree(root_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,511 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import argparse
+import logging
+import mmap
+import os
+import select
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from v_magine import utils
+
+LOG = logging
+
+TFTP_PORT = 69
+
+OPCODE_RRQ = 1
+OPCODE_WRQ = 2
+OPCODE_DATA = 3
+OPCODE_ACK = 4
+OPCODE_ERROR = 5
+OPCODE_OACK = 6
+
+ERROR_UNDEFINED = 0
+ERROR_FILE_NOT_FOUND = 1
+ERROR_ACCESS_VIOLATION = 2
+ERROR_ILLEGAL_OPERATION = 4
+ERROR_UNKNOWN_TID = 5
+
+OPTION_BLKSIZE = "blksize"
+OPTION_WINDOWSIZE = "windowsize"
+OPTION_TSIZE = "tsize"
+OPTION_TIMEOUT = "timeout"
+
+DEFAULT_BLOCK_SIZE = 512
+MIN_BLOCK_SIZE = 8
+# RFC 2348
+MAX_BLOCK_SIZE = 65464
+DEFAULT_MAX_WINDOW_SIZE = 64
+# Bytes sent before waiting for an ack, larger windows overflow the receive
+# buffer of the clients, causing timeouts
+MAX_WINDOW_BYTES = 64 * 1024
+DEFAULT_TIMEOUT_S = 1
+MAX_TIMEOUT_S = 255
+MAX_RETRIES = 5
+MAX_PACKET_SIZE = 516
+BLOCK_NUMBER_MODULO = 65536
+
+
+class TftpError(Exception):
+    def __init__(self, code, msg):
+        super(TftpError, self).__init__(msg)
+        self.code = code
+
+
+def parse_request(data):
+    """Returns the opcode, file name, mode and options of a request."""
+    if len(data) < 2:
+        raise TftpError(ERROR_ILLEGAL_OPERATION, "Invalid request")
+    (opcode,) = struct.unpack("!H", data[:2])
+    fields = data[2:].split(b"\0")
+    if opcode not in (OPCODE_RRQ, OPCODE_WRQ) or len(fields) < 3:
+        raise TftpError(ERROR_ILLEGAL_OPERATION, "Invalid request")
+
+    fields = [field.decode("ascii", "replace") for field in fields[:-1]]
+    options = dict((name.lower(), value) for (name, value) in
+                   zip(fields[2::2], fields[3::2]))
+    return (opcode, fields[0], fields[1].lower(), options)
+
+
+def _get_error_packet(code, msg):
+    return struct.pack("!HH", OPCODE_ERROR, code) + msg.encode() + b"\0"
+
+
+class TftpTransfer(object):
+    """Sends a file to a client, as negotiated in its read request.
+
+    The block size (RFC 2348), the window size (RFC 7440), the transfer
+    size (RFC 2349) and the timeout are negotiated when requested. The
+    window of blocks sent before waiting for an acknowledgment is resent
+    starting after the last acknowledged block on timeout. The file is
+    memory mapped, so that each block is sliced from the page cache.
+    """
+    def __init__(self, listen_address, client_addr, path, options,
+                 max_block_size=MAX_BLOCK_SIZE,
+                 max_window_size=DEFAULT_MAX_WINDOW_SIZE):
+        self._listen_address = listen_address
+        self._client_addr = client_addr
+        self._path = path
+        self._options = options
+        self._max_block_size = max_block_size
+        self._max_window_size = max_window_size
+
+        self._block_size = DEFAULT_BLOCK_SIZE
+        self._window_size = 1
+        self._timeout = DEFAULT_TIMEOUT_S
+        self._sock = None
+        self._stats = {"file": os.path.basename(path),
+                       "client": client_addr[0], "success": False,
+                       "bytes": 0, "duration": 0, "throughput": 0,
+                       "retransmits": 0}
+
+    def get_stats(self):
+        return dict(self._stats)
+
+    def _negotiate_options(self, file_size):
+        accepted = {}
+        for (name, value) in self._options.items():
+            try:
+                value = int(value)
+            except ValueError:
+                continue
+
+            if name == OPTION_BLKSIZE and value >= MIN_BLOCK_SIZE:
+                self._block_size = min(value, self._max_block_size)
+                accepted[name] = self._block_size
+            elif name == OPTION_WINDOWSIZE and value >= 1:
+                self._window_size = min(value, self._max_window_size)
+                accepted[name] = self._window_size
+            elif name == OPTION_TIMEOUT and 1 <= value <= MAX_TIMEOUT_S:
+                self._timeout = value
+                accepted[name] = value
+            elif name == OPTION_TSIZE:
+                accepted[name] = file_size
+
+        if OPTION_WINDOWSIZE in accepted:
+            # The block size is negotiated first
+            self._window_size = max(1, min(
+                self._window_size, MAX_WINDOW_BYTES // self._block_size))
+            accepted[OPTION_WINDOWSIZE] = self._window_size
+        return accepted
+
+    def _send(self, packet):
+        self._sock.sendto(packet, self._client_addr)
+
+    def _receive(self, deadline):
+        """Returns the next packet from the client or None on timeout."""
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return None
+            self._sock.settimeout(timeout)
+            try:
+                (packet, addr) = self._sock.recvfrom(MAX_PACKET_SIZE)
+            except socket.timeout:
+                return None
+
+            if addr != self._client_addr:
+                self._sock.sendto(
+                    _get_error_packet(ERROR_UNKNOWN_TID, "Unknown TID"),
+                    addr)
+            elif len(packet) >= 4:
+                return struct.unpack("!HH", packet[:4]) + (packet[4:],)
+
+    def _send_oack(self, accepted):
+        oack = struct.pack("!H", OPCODE_OACK) + b"".join(
+            [("%s\0%s\0" % item).encode() for item in accepted.items()])
+        for retry in range(MAX_RETRIES):
+            self._send(oack)
+            deadline = time.time() + self._timeout
+            while True:
+                response = self._receive(deadline)
+                if not response:
+                    self._stats["retransmits"] += 1
+                    break
+                (opcode, value, data) = response
+                if opcode == OPCODE_ERROR:
+                    # Clients may reject the options after getting tsize
+                    LOG.debug("TFTP options rejected by %s: %s",
+                              self._client_addr[0], data.rstrip(b"\0"))
+                    return False
+                if opcode == OPCODE_ACK and value == 0:
+                    return True
+        raise TftpError(ERROR_UNDEFINED, "Timeout waiting for OACK ack")
+
+    def _send_blocks(self, data):
+        size = len(data)
+        # The last block is shorter than the block size, possibly empty
+        block_count = size // self._block_size + 1
+        # Index of the first block not acknowledged, starting from 1
+        base = 1
+        retries = 0
+        while base <= block_count:
+            window_end = min(base + self._window_size, block_count + 1)
+            for index in range(base, window_end):
+                offset = (index - 1) * self._block_size
+                self._send(
+                    struct.pack("!HH", OPCODE_DATA,
+                                index % BLOCK_NUMBER_MODULO) +
+                    data[offset:offset + self._block_size])
+
+            deadline = time.time() + self._timeout
+            while True:
+                response = self._receive(deadline)
+                if not response:
+                    retries += 1
+                    if retries >= MAX_RETRIES:
+                        raise TftpError(ERROR_UNDEFINED,
+                                        "Timeout waiting for ack")
+                    self._stats["retransmits"] += window_end - base
+                    break
+
+                (opcode, value, error_msg) = response
+                if opcode == OPCODE_ERROR:
+                    # No error is sent back to the client
+                    raise TftpError(
+                        None, "Transfer aborted by the client: %s" %
+                        error_msg.rstrip(b"\0").decode("ascii", "replace"))
+                if opcode != OPCODE_ACK:
+                    continue
+                # Block numbers roll over, get the acked block in the window
+                acked = (value - (base - 1)) % BLOCK_NUMBER_MODULO
+                if not acked or acked > window_end - base:
+                    # Duplicate ack of an older block, resending the
+                    # window for it would double the traffic
+                    continue
+                retries = 0
+                if acked < window_end - base:
+                    # Blocks lost, resume from the first one missing
+                    self._stats["retransmits"] += window_end - base - acked
+                base += acked
+                break
+
+    def _open_data(self, f):
+        file_size = os.fstat(f.fileno()).st_size
+        if not file_size:
+            # Empty files cannot be memory mapped
+            return (b"", None)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return (mm, mm)
+
+    def run(self):
+        start_time = time.time()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        mm = None
+        try:
+            self._sock.bind((self._listen_address, 0))
+            try:
+                f = open(self._path, 'rb')
+            except (IOError, OSError):
+                raise TftpError(ERROR_FILE_NOT_FOUND, "File not found")
+            with f:
+                (data, mm) = self._open_data(f)
+                accepted = self._negotiate_options(len(data))
+                if accepted and not self._send_oack(accepted):
+                    return self.get_stats()
+
+                self._send_blocks(data)
+
+            duration = time.time() - start_time
+            self._stats.update({
+                "success": True, "bytes": len(data), "duration": duration,
+                "throughput": len(data) / duration if duration else 0,
+                "block_size": self._block_size,
+                "window_size": self._window_size})
+            LOG.info("TFTP transfer of %(file)s to %(client)s: %(bytes)d "
+                     "bytes in %(duration).2f s, %(throughput).0f B/s, "
+                     "block size %(block_size)d, window size "
+                     "%(window_size)d, retransmits %(retransmits)d",
+                     self._stats)
+        except TftpError as ex:
+            LOG.warn("TFTP transfer of %s to %s failed: %s",
+                     self._path, self._client_addr[0], ex)
+            if ex.code is not None:
+                self._send(_get_error_packet(ex.code, str(ex)))
+        except Exception as ex:
+            LOG.exception(ex)
+        finally:
+            if mm:
+                mm.close()
+            self._sock.close()
+        return self.get_stats()
+
+
+class TftpServer(object):
+    """Read only TFTP server for the files in root_dir.
+
+    The requests are received on the sock list and each transfer is
+    performed on its own socket by the TftpTransfer returned by
+    create_transfer. If is_allowed_client is provided, only the clients
+    for which it returns True can get files.
+    """
+    def __init__(self, root_dir, listen_address, port=TFTP_PORT,
+                 max_block_size=MAX_BLOCK_SIZE,
+                 max_window_size=DEFAULT_MAX_WINDOW_SIZE,
+                 is_allowed_client=None):
+        self._root_dir = os.path.abspath(root_dir)
+        self._listen_address = listen_address
+        self._port = port
+        self._max_block_size = max_block_size
+        self._max_window_size = max_window_size
+        self._is_allowed_client = is_allowed_client
+        self.sock = []
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self._listen_address, self._port))
+        self.sock.append(sock)
+
+    def _get_path(self, file_name):
+        path = os.path.normpath(os.path.join(
+            self._root_dir, file_name.replace("\\", "/").lstrip("/")))
+        if not path.startswith(os.path.join(self._root_dir, "")):
+            raise TftpError(ERROR_ACCESS_VIOLATION, "Access violation")
+        return path
+
+    def create_transfer(self, sock, addr, data):
+        """Returns the transfer for a request or None if not valid."""
+        try:
+            if (self._is_allowed_client and
+                    not self._is_allowed_client(addr[0])):
+                raise TftpError(ERROR_ACCESS_VIOLATION, "Access violation")
+
+            (opcode, file_name, mode, options) = parse_request(data)
+            if opcode != OPCODE_RRQ:
+                raise TftpError(ERROR_ILLEGAL_OPERATION,
+                                "Only read requests are supported")
+            LOG.debug("TFTP read request from %s: %s, options: %s",
+                      addr[0], file_name, options)
+
+            return TftpTransfer(self._listen_address, addr,
+                                self._get_path(file_name), options,
+                                self._max_block_size, self._max_window_size)
+        except TftpError as ex:
+            LOG.warn("Invalid TFTP request from %s: %s", addr[0], ex)
+            sock.sendto(_get_error_packet(ex.code, str(ex)), addr)
+
+
+def _parse_options(data):
+    fields = [field.decode("ascii", "replace")
+              for field in data.split(b"\0")[:-1]]
+    return dict((name.lower(), value) for (name, value) in
+                zip(fields[0::2], fields[1::2]))
+
+
+def download(server_addr, file_name, block_size=None, window_size=None,
+             timeout=DEFAULT_TIMEOUT_S):
+    """Downloads a file with a read request, returns its content.
+
+    The block size and the window size are requested as options when
+    provided. As in RFC 7440, the blocks are acknowledged at the end of
+    each window and after the first block out of order, so that the server
+    resends the blocks following the last one received in order.
+    """
+    options = {OPTION_TSIZE: 0}
+    if block_size:
+        options[OPTION_BLKSIZE] = block_size
+    if window_size:
+        options[OPTION_WINDOWSIZE] = window_size
+    request = struct.pack("!H", OPCODE_RRQ) + b"".join(
+        [("%s\0" % field).encode() for field in
+         [file_name, "octet"] + [str(item) for option in options.items()
+                                 for item in option]])
+
+    block_size = DEFAULT_BLOCK_SIZE
+    window_size = 1
+    chunks = []
+    # Number of the last block received in order, modulo 65536
+    last_block = 0
+    unacked = 0
+    out_of_order = False
+    transfer_addr = None
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(timeout)
+        last_packet = request
+        sock.sendto(request, server_addr)
+        retries = 0
+        while True:
+            try:
+                (packet, addr) = sock.recvfrom(MAX_BLOCK_SIZE + 4)
+            except socket.timeout:
+                retries += 1
+                if retries >= MAX_RETRIES:
+                    raise TftpError(ERROR_UNDEFINED, "Transfer timed out")
+                sock.sendto(last_packet, transfer_addr or server_addr)
+                continue
+
+            if transfer_addr is None:
+                # The server replies from the port used for the transfer
+                transfer_addr = addr
+            elif addr != transfer_addr or len(packet) < 4:
+                continue
+            retries = 0
+
+            (opcode, value) = struct.unpack("!HH", packet[:4])
+            if opcode == OPCODE_ERROR:
+                raise TftpError(value, packet[4:].rstrip(b"\0").decode(
+                    "ascii", "replace"))
+            elif opcode == OPCODE_OACK:
+                accepted = _parse_options(packet[2:])
+                block_size = int(accepted.get(OPTION_BLKSIZE, block_size))
+                window_size = int(accepted.get(OPTION_WINDOWSIZE,
+                                               window_size))
+                last_packet = struct.pack("!HH", OPCODE_ACK, 0)
+                sock.sendto(last_packet, transfer_addr)
+            elif opcode == OPCODE_DATA:
+                if value != (last_block + 1) % BLOCK_NUMBER_MODULO:
+                    if not out_of_order:
+                        out_of_order = True
+                        unacked = 0
+                        sock.sendto(last_packet, transfer_addr)
+                    continue
+
+                out_of_order = False
+                chunks.append(packet[4:])
+                last_block = value
+                unacked += 1
+                last_packet = struct.pack("!HH", OPCODE_ACK, last_block)
+                is_last = len(packet) - 4 < block_size
+                if is_last or unacked == window_size:
+                    unacked = 0
+                    sock.sendto(last_packet, transfer_addr)
+                if is_last:
+                    return b"".join(chunks)
+    finally:
+        sock.close()
+
+
+def _serve(server, stopped):
+    while not stopped.is_set():
+        (readable, _, _) = select.select(server.sock, [], [], 0.5)
+        for sock in readable:
+            (data, addr) = sock.recvfrom(MAX_PACKET_SIZE)
+            transfer = server.create_transfer(sock, addr, data)
+            if transfer:
+                transfer_thread = threading.Thread(target=transfer.run)
+                transfer_thread.daemon = True
+                transfer_thread.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Downloads the PXE boot files from a loopback TFTP "
+        "server with the given block and window sizes")
+    parser.add_argument("--root-dir",
+                        default=os.path.join(utils.get_pxe_files_dir(),
+                                             "centos7"),
+                        help="Directory of the boot files, random files are "
+                        "generated if the boot files are not found")
+    parser.add_argument("--files", nargs="+",
+                        default=["vmlinuz", "initrd.img"])
+    parser.add_argument("--size-mb", type=int, default=32,
+                        help="Size of the generated files")
+    parser.add_argument("--block-sizes", type=int, nargs="+",
+                        default=[DEFAULT_BLOCK_SIZE, 1428, 8192])
+    parser.add_argument("--window-sizes", type=int, nargs="+",
+                        default=[1, 4, 16])
+    parsed_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    tmp_dir = None
+    root_dir = parsed_args.root_dir
+    if not all(os.path.isfile(os.path.join(root_dir, file_name))
+               for file_name in parsed_args.files):
+        tmp_dir = tempfile.mkdtemp()
+        root_dir = tmp_dir
+        for file_name in parsed_args.files:
+            with open(os.path.join(root_dir, file_name), 'wb') as f:
+                for i in range(parsed_args.size_mb):
+                    f.write(os.urandom(1024 * 1024))
+
+    server = TftpServer(root_dir, "127.0.0.1", port=0)
+    server.bind()
+    server_addr = server.sock[0].getsockname()
+    stopped = threading.Event()
+    server_thread = threading.Thread(target=_serve, args=(server, stopped))
+    server_thread.start()
+    success = True
+    try:
+        for block_size in parsed_args.block_sizes:
+            for window_size in parsed_args.window_sizes:
+                for file_name in parsed_args.files:
+                    with open(os.path.join(root_dir, file_name), 'rb') as f:
+                        expected = f.read()
+                    start_time = time.time()
+                    data = download(server_addr, file_name, block_size,
+                                    window_size)
+                    duration = time.time() - start_time
+                    if data != expected:
+                        success = False
+                    print("%(file)-12s block size %(block_size)5d, window "
+                          "size %(window_size)2d: %(duration)6.2f s, "
+                          "%(throughput)7.2f MB/s%(error)s" %
+                          {"file": file_name, "block_size": block_size,
+                           "window_size": window_size, "duration": duration,
+                           "throughput": len(data) / duration / 1024 / 1024,
+                           "error": "" if data == expected else
+                           ", content mismatch"})
+    finally:
+        stopped.set()
+        server_thread.join()
+        for sock in server.sock:
+            sock.close()
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+    return 0 if success else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import contextlib
+import functools
+import json
+import logging
+import socket
+import threading
+import time
+
+from v_magine import constants
+
+LOG = logging
+
+CATEGORY_STEP = "step"
+CATEGORY_SSH = "ssh"
+CATEGORY_WMI = "wmi"
+CATEGORY_DOWNLOAD = "download"
+
+_active_timeline = None
+
+
+class Timeline(object):
+    """Records timing spans, nested per thread."""
+    def __init__(self):
+        self._spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start_time = time.time()
+        self._end_time = None
+        self._success = None
+
+    def _get_span_stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def span(self, name, category, **kwargs):
+        stack = self._get_span_stack()
+        with self._lock:
+            span = {"id": len(self._spans) + 1,
+                    "parent_id": stack[-1]["id"] if stack else None,
+                    "name": name,
+                    "category": category,
+                    "thread": threading.current_thread().name,
+                    "thread_id": threading.current_thread().ident,
+                    "start": time.time(),
+                    "end": None,
+                    "args": kwargs,
+                    "error": None}
+            self._spans.append(span)
+
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as ex:
+            span["error"] = ex.__class__.__name__
+            raise
+        finally:
+            stack.pop()
+            span["end"] = time.time()
+
+    def stop(self, success):
+        self._end_time = time.time()
+        self._success = success
+
+    def to_dict(self):
+        with self._lock:
+            spans = [dict(span) for span in self._spans]
+        for span in spans:
+            if span["end"] is not None:
+                span["duration"] = span["end"] - span["start"]
+
+        return {"hostname": socket.gethostname(),
+                "product_version": constants.VERSION,
+                "start_time": self._start_time,
+                "end_time": self._end_time,
+                "success": self._success,
+                "spans": spans}
+
+    def to_chrome_trace(self):
+        """Returns the spans in the Chrome trace event format."""
+        events = []
+        with self._lock:
+            spans = list(self._spans)
+        for span in spans:
+            end_time = span["end"] or self._end_time or time.time()
+            args = dict(span["args"])
+            if span["error"]:
+                args["error"] = span["error"]
+            events.append({"name": span["name"],
+                           "cat": span["category"],
+                           "ph": "X",
+                           "ts": int((span["start"] - self._start_time) * 1e6),
+                           "dur": int((end_time - span["start"]) * 1e6),
+                           "pid": 1,
+                           "tid": span["thread_id"],
+                           "args": args})
+        return {"traceEvents": events,
+                "displayTimeUnit": "ms",
+                "otherData": {"hostname": socket.gethostname(),
+                              "product_version": constants.VERSION}}
+
+    def save(self, json_path, chrome_trace_path):
+        for (path, data) in [(json_path, self.to_dict()),
+                             (chrome_trace_path, self.to_chrome_trace())]:
+            with open(path, 'wb') as f:
+                f.write(json.dumps(data, indent=2, default=str).encode())
+        LOG.info("Timeline saved: %s", json_path)
+
+
+def set_active_timeline(timeline):
+    global _active_timeline
+    _active_timeline = timeline
+
+
+def get_active_timeline():
+    return _active_timeline
+
+
+@contextlib.contextmanager
+def span(name, category, **kwargs):
+    """Records a span in the active timeline, if any."""
+    timeline = _active_timeline
+    if timeline is None:
+        yield {"args": {}}
+    else:
+        with timeline.span(name, category, **kwargs) as s:
+            yield s
+
+
+def timed(category, name=None):
+    def _timed(func):
+        @functools.wraps(func)
+        def _exec_timed(*args, **kwargs):
+            with span(name or func.__name__, category):
+                return func(*args, **kwargs)
+        return _exec_timed
+    return _timed
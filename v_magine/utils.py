@@ -10,12 +10,14 @@ import random
 import re
 import subprocess
 import tempfile
-import time
 
 from dns import resolver
 from six.moves.urllib import parse
 from six.moves.urllib import request
 
+from v_magine import cancellation
+from v_magine import exceptions
+
 LOG = logging
 
 
@@ -33,16 +35,26 @@ def execute_process(args, shell=False):
     return (out, err)
 
 
-def download_file(url, target_path, report_hook=None):
+def download_file(url, target_path, report_hook=None,
+                  cancellation_token=None):
     class URLopenerWithException(request.FancyURLopener):
         def http_error_default(self, url, fp, errcode, errmsg, headers):
             raise Exception("Download failed with error: %s" % errcode)
+
+    def _report_hook(block_count, block_size, total_size):
+        # Called for every block read
+        if cancellation_token:
+            cancellation_token.check()
+        if report_hook:
+            report_hook(block_count, block_size, total_size)
+
     return URLopenerWithException().retrieve(url, target_path,
-                                             reporthook=report_hook)
+                                             reporthook=_report_hook)
 
 
 def retry_on_error(max_attempts=10, sleep_seconds=0,
-                   terminal_exceptions=[]):
+                   terminal_exceptions=[], backoff_factor=1,
+                   max_sleep_seconds=None):
     def _retry_on_error(func):
         @functools.wraps(func)
         def _exec_retry(*args, **kwargs):
@@ -54,15 +66,23 @@ def retry_on_error(max_attempts=10, sleep_seconds=0,
                     LOG.debug("Got a KeyboardInterrupt, skip retrying")
                     LOG.exception(ex)
                     raise
+                except exceptions.CancelDeploymentException:
+                    raise
                 except Exception as ex:
                     if any([isinstance(ex, tex)
                             for tex in terminal_exceptions]):
                         raise
+                    # The error might be a consequence of the cancellation,
+                    # e.g. a closed connection
+                    cancellation.check()
 
                     i += 1
                     if i < max_attempts:
                         LOG.warn("Exception occurred, retrying: %s", ex)
-                        time.sleep(sleep_seconds)
+                        sleep = sleep_seconds * backoff_factor ** (i - 1)
+                        if max_sleep_seconds is not None:
+                            sleep = min(sleep, max_sleep_seconds)
+                        cancellation.sleep(sleep)
                     else:
                         raise
         return _exec_retry
@@ -97,6 +117,10 @@ def get_pxe_files_dir():
     return os.path.join(get_base_dir(), "pxe")
 
 
+def get_package_cache_dir():
+    return os.path.join(get_base_dir(), "package-cache")
+
+
 def get_random_ipv4_subnet():
     # 24 bit only for now
     return ("10." + str(random.randint(1, 254)) + "." +
@@ -15,10 +15,11 @@
 #    under the License.
 
 import logging
-import time
 import wmi
 
 from v_magine.i18n import _
+from v_magine import cancellation
+from v_magine import timeline
 from v_magine.virt.hyperv import vmutils
 
 LOG = logging.getLogger(__name__)
@@ -158,11 +159,16 @@ class NetworkUtils(object):
             raise vmutils.HyperVException(_('Job failed with error %d') %
                                           ret_val)
 
+        with timeline.span("wmi_job", timeline.CATEGORY_WMI) as span:
+            job = self._wait_for_job_completion(jobpath)
+            span["args"]["description"] = job.Description
+
+    def _wait_for_job_completion(self, jobpath):
         job_wmi_path = jobpath.replace('\\', '/')
         job = wmi.WMI(moniker=job_wmi_path)
 
         while job.JobState == WMI_JOB_STATE_RUNNING:
-            time.sleep(0.1)
+            cancellation.sleep(0.1)
             job = wmi.WMI(moniker=job_wmi_path)
         if job.JobState != WMI_JOB_STATE_COMPLETED:
             job_state = job.JobState
@@ -195,6 +201,7 @@ class NetworkUtils(object):
         elap = job.ElapsedTime
         LOG.debug(_("WMI job succeeded: %(desc)s, Elapsed=%(elap)s"),
                   {'desc': desc, 'elap': elap})
+        return job
 
     def _create_switch_port(self, vswitch_name, switch_port_name):
         """Creates a switch port."""
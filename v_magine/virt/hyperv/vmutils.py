@@ -19,12 +19,13 @@ Utility class for VM related operations on Hyper-V.
 """
 
 import logging
-import time
 import uuid
 import wmi
 
 from v_magine.i18n import _, _LW
 
+from v_magine import cancellation
+from v_magine import timeline
 from v_magine.virt.hyperv import constants
 
 LOG = logging.getLogger(__name__)
@@ -556,10 +557,16 @@ class VMUtils(object):
 
     def _wait_for_job(self, job_path):
         """Poll WMI job state and wait for completion."""
+        with timeline.span("wmi_job", timeline.CATEGORY_WMI) as span:
+            job = self._wait_for_job_completion(job_path)
+            span["args"]["description"] = job.Description
+        return job
+
+    def _wait_for_job_completion(self, job_path):
         job = self._get_wmi_obj(job_path)
 
         while job.JobState == constants.WMI_JOB_STATE_RUNNING:
-            time.sleep(0.1)
+            cancellation.sleep(0.1)
             job = self._get_wmi_obj(job_path)
         if job.JobState != constants.WMI_JOB_STATE_COMPLETED:
             job_state = job.JobState
@@ -9,8 +9,10 @@ import pywintypes
 import six
 import win32api
 import win32con
+import win32netcon
 import win32process
 import win32security
+import win32wnet
 import wmi
 
 from ctypes import windll
@@ -182,6 +184,7 @@ class WindowsUtils(object):
     _ERROR_NO_SUCH_MEMBER = 1387
     _ERROR_MEMBER_IN_ALIAS = 1378
     _ERROR_INVALID_MEMBER = 1388
+    _ERROR_SESSION_CREDENTIAL_CONFLICT = 1219
 
     def __init__(self):
         self._wmi_conn_cimv2 = None
@@ -198,22 +201,70 @@ class WindowsUtils(object):
         if hotfix_id_list:
             return hotfix_id_list[0].InstalledOn
 
-    def get_installed_products(self, vendor):
+    @staticmethod
+    def get_wmi_conn(host, username=None, password=None):
+        return wmi.WMI(computer=host, user=username, password=password)
+
+    def connect_remote_host(self, host, username, password):
+        """Authenticates the SMB session used by the administrative shares."""
+        try:
+            win32wnet.WNetAddConnection2(
+                win32netcon.RESOURCETYPE_ANY, None, r"\\%s\IPC$" % host,
+                None, username, password)
+        except pywintypes.error as ex:
+            # A session with the host already exists
+            if ex.winerror != self._ERROR_SESSION_CREDENTIAL_CONFLICT:
+                raise
+
+    def disconnect_remote_host(self, host):
+        try:
+            win32wnet.WNetCancelConnection2(r"\\%s\IPC$" % host, 0, True)
+        except pywintypes.error as ex:
+            LOG.exception(ex)
+
+    @staticmethod
+    def get_hostname(conn):
+        return conn.Win32_ComputerSystem()[0].Name
+
+    @staticmethod
+    def get_windows_dir(conn):
+        return conn.Win32_OperatingSystem()[0].WindowsDirectory
+
+    @staticmethod
+    def create_process(conn, cmd):
+        (pid, ret_val) = conn.Win32_Process.Create(CommandLine=cmd)
+        if ret_val:
+            raise exceptions.BaseVMagineException(
+                "Win32_Process.Create failed with error: %d" % ret_val)
+        return pid
+
+    @staticmethod
+    def is_process_running(conn, pid):
+        return bool(conn.Win32_Process(ProcessId=pid))
+
+    def get_installed_products(self, vendor, conn=None):
         products = []
-        for p in self._conn_cimv2.Win32_Product(vendor=vendor):
+        for p in (conn or self._conn_cimv2).Win32_Product(vendor=vendor):
             products.append((p.IdentifyingNumber, p.Caption))
         return products
 
-    def uninstall_product(self, product_id, log_path, hidden=False):
+    @staticmethod
+    def get_msi_uninstall_cmd(product_id, log_path, hidden=False):
         if hidden:
             ui = "/qn"
         else:
             ui = "/qb"
-        utils.execute_process(["msiexec.exe", "/uninstall", product_id, ui,
-                               "/l*v", log_path])
+        return ('msiexec.exe /uninstall %(product_id)s %(ui)s '
+                '/l*v "%(log_path)s"' %
+                {"product_id": product_id, "ui": ui, "log_path": log_path})
 
-    def install_msi(self, msi_path, features, properties, log_path,
-                    hidden=False):
+    def uninstall_product(self, product_id, log_path, hidden=False):
+        utils.execute_process(
+            self.get_msi_uninstall_cmd(product_id, log_path, hidden))
+
+    @staticmethod
+    def get_msi_install_cmd(msi_path, features, properties, log_path,
+                            hidden=False):
         if hidden:
             ui = "/qn"
         else:
@@ -230,11 +281,17 @@ class WindowsUtils(object):
                 args.append('%(k)s="%(v)s"' %
                             {"k": k, "v": str(v).replace('"', '""')})
 
-        LOG.debug("Installing MSI: %s" % args)
+        return " ".join(args)
+
+    def install_msi(self, msi_path, features, properties, log_path,
+                    hidden=False):
+        cmd = self.get_msi_install_cmd(msi_path, features, properties,
+                                       log_path, hidden)
+        LOG.debug("Installing MSI: %s" % cmd)
         # When passing a args list, peopen escapes quotes and other
         # characters. This can be avoided by passing the entire command
         # line as a string
-        utils.execute_process(" ".join(args))
+        utils.execute_process(cmd)
 
     def check_os_version(self, major, minor):
         os_version_str = self._conn_cimv2.Win32_OperatingSystem()[0].Version
@@ -400,23 +457,25 @@ class WindowsUtils(object):
         return (win32api.HIWORD(ms), win32api.LOWORD(ms),
                 win32api.HIWORD(ls), win32api.LOWORD(ls))
 
-    def get_windows_version_info(self):
-        version_info = self._conn_cimv2.Win32_OperatingSystem()[0]
+    def get_windows_version_info(self, conn=None):
+        version_info = (conn or self._conn_cimv2).Win32_OperatingSystem()[0]
         return {"description": version_info.Caption,
                 "version": version_info.Version}
 
-    def get_group_by_sid(self, sid):
-        l = self._conn_cimv2.Win32_Group(SID=sid)
+    def get_group_by_sid(self, sid, conn=None):
+        l = (conn or self._conn_cimv2).Win32_Group(SID=sid)
         if l:
             return (l[0].Domain, l[0].Name)
         else:
             raise exceptions.GroupNotFoundException()
 
-    def add_user_to_local_group(self, username, groupname):
+    def add_user_to_local_group(self, username, groupname, host=None):
         lmi = Win32_LOCALGROUP_MEMBERS_INFO_3()
         lmi.lgrmi3_domainandname = six.text_type(username)
 
-        ret_val = netapi32.NetLocalGroupAddMembers(0, six.text_type(groupname),
+        server_name = six.text_type(host) if host else 0
+        ret_val = netapi32.NetLocalGroupAddMembers(server_name,
+                                                   six.text_type(groupname),
                                                    3, ctypes.addressof(lmi), 1)
 
         if ret_val == self._NERR_GroupNotFound:
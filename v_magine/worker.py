@@ -2,6 +2,8 @@
 # All Rights Reserved.
 # Licensed under the AGPLv3, see LICENCE file for details.
 
+import functools
+import io
 import logging
 import os
 import socket
@@ -12,12 +14,22 @@ import sys
 import netaddr
 import validators
 
-from v_magine import actions
+from v_magine import bootprogress
+from v_magine import cache
+from v_magine import cancellation
 from v_magine import centos
+from v_magine import compute
+from v_magine import console
 from v_magine import constants
 from v_magine import exceptions
+from v_magine import journal as deployment_journal
+from v_magine import logstore
+from v_magine import prefetch
+from v_magine import progress
 from v_magine import rdo
-from v_magine import security
+from v_magine import readiness
+from v_magine import scheduler as deployment_scheduler
+from v_magine import timeline
 from v_magine import utils
 
 LOG = logging
@@ -30,13 +42,40 @@ VMAGINE_ISSUES_URL = "https://github.com/cloudbase/v-magine/issues"
 VMAGINE_QUESTIONS_URL = "http://ask.cloudbase.it"
 CORIOLIS_URL = "https://cloudbase.it/coriolis"
 
+RDO_VM_SHUTDOWN_TIMEOUT_S = 120
+RDO_VM_BOOT_TIMEOUT_S = 20 * 60
+MAX_CONCURRENT_DEPLOYMENT_STEPS = 4
+TIMELINES_DIR_NAME = "timelines"
+CONSOLE_LOG_NAME = "%s-console" % constants.PRODUCT_NAME
+HOST_PROBES_CACHE_TTL_S = 5 * 60
+
+HYPERV_NOVA_MSI_NAME = "hyperv_nova_compute"
+HYPERV_NOVA_MSI_PATH = "%s.msi" % HYPERV_NOVA_MSI_NAME
+FREERDP_WEBCONNECT_MSI_NAME = "freerdp_webconnect"
+FREERDP_WEBCONNECT_MSI_PATH = "%s.msi" % FREERDP_WEBCONNECT_MSI_NAME
+
+CONSOLE_EVENT_ESCAPE = "escape"
+CONSOLE_EVENT_MENU_DONE = "menu_done"
+CONSOLE_EVENT_SHUTDOWN = "shutdown"
+CONSOLE_EVENT_BOOT_FAILED = "boot_failed"
+CONSOLE_PATTERNS = [
+    (b"\x1b", CONSOLE_EVENT_ESCAPE),
+    (b"\x1b[0m", CONSOLE_EVENT_MENU_DONE),
+    (b"Reached target Shutdown.", CONSOLE_EVENT_SHUTDOWN),
+    (b"Warning: Could not boot.", CONSOLE_EVENT_BOOT_FAILED),
+]
+
 
 class _VMConsoleThread(threading.Thread):
-    def __init__(self, console_named_pipe, stdout_callback):
+    def __init__(self, console_named_pipe, log_store,
+                 stdout_callback, cancellation_token, progress_tracker=None):
         super(_VMConsoleThread, self).__init__()
         self.setDaemon(True)
         self._console_named_pipe = console_named_pipe
+        self._log_store = log_store
         self._stdout_callback = stdout_callback
+        self._cancellation_token = cancellation_token
+        self._progress_tracker = progress_tracker
         self._exception = None
 
     def get_exception(self):
@@ -49,52 +88,72 @@ class _VMConsoleThread(threading.Thread):
         except Exception as ex:
             self._exception = ex
 
-    def _read_console(self):
-        base_dir = utils.get_base_dir()
-        console_log_file = os.path.join(
-            base_dir, "%s-console.log" % constants.PRODUCT_NAME)
+    def _send_console_output(self, data):
+        if data:
+            self._stdout_callback(data)
 
-        buf = ""
+    def _read_console(self):
         menu_done = False
-
-        with open(console_log_file, 'ab') as console_log_file:
-            with open(self._console_named_pipe, 'rb') as vm_console_pipe:
-                while True:
-                    data = vm_console_pipe.readline()
-
-                    # Exit loop when the VM reboots
-                    if not data:
-                        LOG.debug("Console: no more data")
-                        break
-
-                    # NOTE: Workaround due to formatting issues with menu.c32
-                    # TODO: Needs to be fixed in term.js
-                    if not menu_done:
-                        buf += data
-                        if b'\x1b' not in buf:
-                            self._stdout_callback(data)
-                        idx = buf.find(b"\x1b[0m")
-                        if idx >= 0:
-                            self._stdout_callback(buf[idx + len(b"\x1b[0m"):])
-                            menu_done = True
-                            buf = b""
-                            LOG.debug("Console: pxelinux menu done")
-                    else:
-                        self._stdout_callback(data)
-
-                    console_log_file.write(data)
-                    # TODO(alexpilotti): Fix why the heck CentOS gets stuck
-                    # instead of rebooting and remove this awful workaround :)
-                    if data.find("Reached target Shutdown.") != -1:
+        # NOTE: Workaround due to formatting issues with menu.c32
+        # TODO: Needs to be fixed in term.js
+        # The output is hidden from the first escape sequence up to the end
+        # of the pxelinux menu
+        hidden = False
+
+        # Unbuffered, to get the output as soon as it is available
+        with io.open(self._console_named_pipe, 'rb',
+                     buffering=0) as vm_console_pipe:
+            reader = console.ConsoleReader(vm_console_pipe, CONSOLE_PATTERNS)
+            while True:
+                (data, events) = reader.read()
+
+                # Exit loop when the VM reboots. Cancelling the
+                # deployment removes the VM, closing the pipe as well
+                if not data:
+                    LOG.debug("Console: no more data")
+                    self._cancellation_token.check()
+                    break
+
+                self._cancellation_token.check()
+                self._log_store.write(CONSOLE_LOG_NAME, data)
+                if self._progress_tracker:
+                    self._progress_tracker.feed(data)
+
+                output_start = 0
+                output_end = len(data)
+                shutdown = False
+                boot_failed = False
+                for (event, end) in events:
+                    if event == CONSOLE_EVENT_ESCAPE and not menu_done:
+                        if not hidden:
+                            self._send_console_output(
+                                data[output_start:end - 1])
+                            hidden = True
+                    elif event == CONSOLE_EVENT_MENU_DONE and not menu_done:
+                        LOG.debug("Console: pxelinux menu done")
+                        menu_done = True
+                        hidden = False
+                        output_start = end
+                    elif event == CONSOLE_EVENT_SHUTDOWN:
                         LOG.debug("Console: reached target Shutdown")
+                        shutdown = True
+                        output_end = end
                         break
+                    elif event == CONSOLE_EVENT_BOOT_FAILED:
+                        boot_failed = True
 
-                    if data.find("Warning: Could not boot.") != -1:
-                        raise exceptions.CouldNotBootException()
+                if not hidden:
+                    self._send_console_output(data[output_start:output_end])
+                if boot_failed:
+                    raise exceptions.CouldNotBootException()
+                # TODO(alexpilotti): Fix why the heck CentOS gets stuck
+                # instead of rebooting and remove this awful workaround :)
+                if shutdown:
+                    break
 
 
 class Worker(object):
-    def __init__(self):
+    def __init__(self, dep_actions=None, data_dir=None, log_store=None):
         super(Worker, self).__init__()
 
         self._term_type = None
@@ -103,10 +162,33 @@ class Worker(object):
 
         self._curr_step = 0
         self._max_steps = 0
+        self._status_msg = None
+        self._status_lock = threading.Lock()
+        self._progress_estimator = None
+        self._compute_hosts_runner = compute.ComputeHostsRunner()
 
         self._is_install_done = True
+        self._cancel_deployment = False
+        self._cancellation_token = cancellation.CancellationToken()
+
+        if not dep_actions:
+            # Imported here as it requires the Windows specific modules,
+            # which are not needed when running a simulation
+            from v_magine import actions
+            dep_actions = actions.DeploymentActions()
+        self._dep_actions = dep_actions
+
+        self._host_probes_cache = cache.TTLCache(HOST_PROBES_CACHE_TTL_S)
 
-        self._dep_actions = actions.DeploymentActions()
+        self._data_dir = data_dir or utils.get_base_dir()
+        self._journal = deployment_journal.DeploymentJournal(
+            os.path.join(self._data_dir,
+                         "%s-deployment.json" % constants.PRODUCT_NAME))
+
+        if not log_store:
+            log_store = logstore.LogStore(self._data_dir)
+            log_store.start()
+        self._log_store = log_store
 
         self._stdout_callback = None
         self._stderr_callback = None
@@ -155,12 +237,35 @@ class Worker(object):
                 if vnic_cfg[1] == vnic_name][0]
 
     def _update_status(self, msg):
-        if self._cancel_deployment:
-            raise exceptions.CancelDeploymentException()
-
-        self._curr_step += 1
-        self._progress_status_update_callback(
-            True, self._curr_step, self._max_steps, msg)
+        self._cancellation_token.check()
+
+        with self._status_lock:
+            self._curr_step += 1
+            self._status_msg = msg
+        self._report_progress()
+
+    def _update_step_progress(self, step_name, msg, fraction):
+        """Reports the progress of a running step, without a new status."""
+        with self._status_lock:
+            self._status_msg = msg
+        if (not self._progress_estimator or
+                not self._progress_estimator.set_step_fraction(step_name,
+                                                               fraction)):
+            self._report_progress()
+
+    def _report_progress(self, percentage=None, eta=None):
+        with self._status_lock:
+            if self._progress_estimator and percentage is None:
+                (percentage, eta) = self._progress_estimator.get_progress()
+            self._progress_status_update_callback(
+                True, self._curr_step, self._max_steps, self._status_msg,
+                percentage=percentage, eta=eta)
+
+    def _send_step_output(self, data):
+        # The step output is used to estimate the step progress
+        if self._progress_estimator:
+            self._progress_estimator.add_output(data)
+        self._stdout_callback(data)
 
     def _start_progress_status(self, msg=''):
         if msg:
@@ -170,43 +275,42 @@ class Worker(object):
     def _stop_progress_status(self, msg=''):
         self._progress_status_update_callback(False, 0, 0, msg)
 
-    def _deploy_openstack_vm(self, ext_vswitch_name, openstack_vm_vcpu_count,
-                             openstack_vm_mem_mb, openstack_base_dir,
-                             admin_password, repo_url,
-                             mgmt_ext_ip, mgmt_ext_netmask,
-                             mgmt_ext_gateway, mgmt_ext_name_servers,
-                             proxy_url, proxy_username, proxy_password):
-        vm_name = OPENSTACK_CONTROLLER_VM_NAME
-        vm_admin_user = "root"
-        vm_dir = os.path.join(openstack_base_dir, vm_name)
-
-        # TODO(alexpilotti): Add support for more OSs
-        pxe_os_id = "centos7"
-        console_named_pipe = r"\\.\pipe\%s" % vm_name
-
-        iso_path = os.path.join(vm_dir, "ks.iso")
-
+    def _generate_ssh_key(self):
         self._update_status('Generating SSH key...')
-        (ssh_key_path,
-         ssh_pub_key_path) = self._dep_actions.generate_controller_ssh_key()
+        return self._dep_actions.generate_controller_ssh_key()
 
+    def _generate_md5_password(self, admin_password):
         self._update_status('Generating MD5 password...')
-        encrypted_password = security.get_password_md5(admin_password)
-
-        if not os.path.isdir(vm_dir):
-            os.makedirs(vm_dir)
+        return self._dep_actions.get_password_md5(admin_password)
 
+    def _check_remove_vm(self, vm_name, vm_dir):
         self._update_status('Check if OpenStack controller VM exists...')
         self._dep_actions.check_remove_vm(vm_name)
 
+        if not os.path.isdir(vm_dir):
+            os.makedirs(vm_dir)
+
+    def _create_vswitches(self, ext_vswitch_name):
         self._update_status('Creating virtual switches...')
         internal_net_config = self._dep_actions.get_internal_network_config()
         self._dep_actions.create_vswitches(ext_vswitch_name,
                                            internal_net_config)
+        return internal_net_config
 
+    def _get_vm_network_config(self, vm_name, ext_vswitch_name):
         vm_network_config = self._dep_actions.get_openstack_vm_network_config(
             vm_name, ext_vswitch_name)
         LOG.info("VNIC Network config: %s " % vm_network_config)
+        return vm_network_config
+
+    def _create_kickstart_image(self, vm_name, vm_dir, encrypted_password,
+                                vm_network_config, repo_url,
+                                ssh_pub_key_path, mgmt_ext_ip,
+                                mgmt_ext_netmask, mgmt_ext_gateway,
+                                mgmt_ext_name_servers, proxy_url,
+                                proxy_username, proxy_password,
+                                package_proxy_url):
+        iso_path = os.path.join(vm_dir, "ks.iso")
 
         mgmt_ext_mac_address = self._get_mac_address(vm_network_config,
                                                      "%s-mgmt-ext" % vm_name)
@@ -216,22 +320,44 @@ class Worker(object):
                                                  "%s-data" % vm_name)
         ext_mac_address = self._get_mac_address(vm_network_config,
                                                 "%s-ext" % vm_name)
-        pxe_mac_address = self._get_mac_address(vm_network_config,
-                                                "%s-pxe" % vm_name)
 
         self._dep_actions.create_kickstart_image(
             iso_path, encrypted_password, mgmt_ext_mac_address,
             mgmt_int_mac_address, data_mac_address, ext_mac_address,
             repo_url, ssh_pub_key_path, mgmt_ext_ip, mgmt_ext_netmask,
             mgmt_ext_gateway, mgmt_ext_name_servers, proxy_url,
-            proxy_username, proxy_password)
+            proxy_username, proxy_password, package_proxy_url)
+        return iso_path
 
+    def _start_package_proxy(self, internal_net_config, proxy_url,
+                             proxy_username, proxy_password):
+        self._update_status('Starting the package cache proxy...')
+        try:
+            return self._dep_actions.start_package_proxy(
+                internal_net_config["host_ip"], proxy_url, proxy_username,
+                proxy_password)
+        except Exception as ex:
+            # The packages are downloaded without caching them
+            LOG.exception(ex)
+            LOG.warn("The package cache proxy could not be started")
+
+    def _create_openstack_vm(self, vm_name, vm_dir, openstack_vm_vcpu_count,
+                             openstack_vm_mem_mb, iso_path, vm_network_config,
+                             console_named_pipe):
         self._update_status('Creating the OpenStack controller VM...')
         self._dep_actions.create_openstack_vm(
             vm_name, vm_dir, openstack_vm_vcpu_count,
             openstack_vm_mem_mb, None, iso_path,
             vm_network_config, console_named_pipe)
 
+    def _start_pxe_service(self, vm_name, vm_network_config,
+                           internal_net_config, repo_url, mgmt_ext_ip,
+                           mgmt_ext_netmask, mgmt_ext_gateway,
+                           mgmt_ext_name_servers, proxy_url, proxy_username,
+                           proxy_password):
+        # TODO(alexpilotti): Add support for more OSs
+        pxe_os_id = "centos7"
+
         vnic_ip_info = self._dep_actions.get_openstack_vm_ip_info(
             vm_network_config, internal_net_config["subnet"])
 
@@ -242,18 +368,36 @@ class Worker(object):
             internal_net_config["host_ip"],
             [vnic_ip[1:] for vnic_ip in vnic_ip_info], pxe_os_id)
 
+        mgmt_ext_mac_address = self._get_mac_address(vm_network_config,
+                                                     "%s-mgmt-ext" % vm_name)
+        pxe_mac_address = self._get_mac_address(vm_network_config,
+                                                "%s-pxe" % vm_name)
+
         self._dep_actions.generate_mac_pxelinux_cfg(
             pxe_mac_address, mgmt_ext_mac_address.replace('-', ':'),
             repo_url, mgmt_ext_ip, mgmt_ext_netmask, mgmt_ext_gateway,
             mgmt_ext_name_servers, proxy_url, proxy_username,
             proxy_password)
 
+        return [vnic_ip[2] for vnic_ip in vnic_ip_info
+                if vnic_ip[0] == "%s-mgmt-int" % vm_name][0]
+
+    def _pxe_boot_openstack_vm(self, console_named_pipe, ext_vswitch_name,
+                               repo_url):
         self._update_status('PXE booting OpenStack controller VM...')
         self._dep_actions.start_openstack_vm()
 
         LOG.debug("Reading from console")
+        progress_tracker = bootprogress.BootProgressTracker(
+            lambda phase, description, fraction: self._update_step_progress(
+                "pxe_boot_openstack_vm",
+                'PXE booting OpenStack controller VM: %s...' % description,
+                fraction))
         console_thread = _VMConsoleThread(console_named_pipe,
-                                          self._stdout_callback)
+                                          self._log_store,
+                                          self._send_step_output,
+                                          self._cancellation_token,
+                                          progress_tracker)
         console_thread.start()
         console_thread.join()
 
@@ -267,112 +411,372 @@ class Worker(object):
             else:
                 raise ex
 
+    def _reboot_openstack_vm(self):
         self._update_status('Rebooting OpenStack controller VM...')
         self._dep_actions.reboot_openstack_vm()
 
         LOG.info("PXE booting done")
 
-        vm_int_mgmt_ip = [vnic_ip[2] for vnic_ip in vnic_ip_info
-                          if vnic_ip[0] == "%s-mgmt-int" % vm_name][0]
-
-        return (vm_int_mgmt_ip, vm_admin_user, ssh_key_path)
-
-    def _install_rdo(self, rdo_installer, host, ssh_key_path, username,
-                     password, rdo_admin_password, fip_range, fip_range_start,
-                     fip_range_end, fip_gateway, fip_name_servers):
-        reboot_sleep_s = 30
-
-        def reboot_and_reconnect():
-            self._update_status('Rebooting RDO VM...')
-            rdo_installer.reboot()
-
-            time.sleep(reboot_sleep_s)
-
-            self._update_status(
-                'Enstablishing SSH connection with RDO VM...')
-            rdo_installer.connect(host, ssh_key_path, username, password,
-                                  self._term_type, self._term_cols,
-                                  self._term_rows)
-
-        try:
-            self._update_status(
-                'Waiting for the RDO VM to reboot...')
-            time.sleep(reboot_sleep_s)
-
-            self._update_status(
-                'Enstablishing SSH connection with RDO VM...')
-            rdo_installer.connect(host, ssh_key_path, username, password,
-                                  self._term_type, self._term_cols,
-                                  self._term_rows)
-
-            self._update_status('Updating RDO VM...')
-            rdo_installer.update_os()
-
-            self._update_status('Installing RDO...')
-            rdo_installer.install_rdo(rdo_admin_password, fip_range,
-                                      fip_range_start, fip_range_end,
-                                      fip_gateway, fip_name_servers)
-
-            self._update_status(
-                'Checking if rebooting the RDO VM is required...')
-            if rdo_installer.check_new_kernel():
-                reboot_and_reconnect()
-
-            self._update_status('Installing Hyper-V LIS components...')
-            rdo_installer.install_lis()
-            reboot_and_reconnect()
-
-            self._update_status("Retrieving OpenStack configuration...")
-            nova_config = rdo_installer.get_nova_config()
-
-            self._update_status('RDO successfully deployed!')
-
-            return nova_config
-        finally:
-            rdo_installer.disconnect()
-
-    def _install_local_hyperv_compute(self, nova_config,
-                                      openstack_base_dir, hyperv_host_username,
-                                      hyperv_host_password):
+    def _add_openstack_vm_steps(self, scheduler):
+        scheduler.add_step(
+            "check_remove_vm", self._check_remove_vm,
+            inputs=["vm_name", "vm_dir"])
+        scheduler.add_step(
+            "create_vswitches", self._create_vswitches,
+            inputs=["ext_vswitch_name"],
+            outputs=["internal_net_config"])
+        scheduler.add_step(
+            "start_package_proxy", self._start_package_proxy,
+            inputs=["internal_net_config", "proxy_url", "proxy_username",
+                    "proxy_password"],
+            outputs=["package_proxy_url"],
+            checkpoint=False)
+        scheduler.add_step(
+            "generate_ssh_key", self._generate_ssh_key,
+            outputs=["ssh_key_path", "ssh_pub_key_path"])
+        scheduler.add_step(
+            "generate_md5_password", self._generate_md5_password,
+            inputs=["admin_password"],
+            outputs=["encrypted_password"],
+            store_outputs=False)
+        scheduler.add_step(
+            "get_vm_network_config", self._get_vm_network_config,
+            inputs=["vm_name", "ext_vswitch_name"],
+            outputs=["vm_network_config"])
+        scheduler.add_step(
+            "create_kickstart_image", self._create_kickstart_image,
+            inputs=["vm_name", "vm_dir", "encrypted_password",
+                    "vm_network_config", "repo_url", "ssh_pub_key_path",
+                    "mgmt_ext_ip", "mgmt_ext_netmask", "mgmt_ext_gateway",
+                    "mgmt_ext_name_servers", "proxy_url", "proxy_username",
+                    "proxy_password", "package_proxy_url"],
+            outputs=["iso_path"],
+            after=["check_remove_vm"])
+        scheduler.add_step(
+            "create_openstack_vm", self._create_openstack_vm,
+            inputs=["vm_name", "vm_dir", "openstack_vm_vcpu_count",
+                    "openstack_vm_mem_mb", "iso_path", "vm_network_config",
+                    "console_named_pipe"],
+            after=["check_remove_vm", "create_vswitches"])
+        scheduler.add_step(
+            "start_pxe_service", self._start_pxe_service,
+            inputs=["vm_name", "vm_network_config", "internal_net_config",
+                    "repo_url", "mgmt_ext_ip", "mgmt_ext_netmask",
+                    "mgmt_ext_gateway", "mgmt_ext_name_servers", "proxy_url",
+                    "proxy_username", "proxy_password"],
+            outputs=["mgmt_ip"],
+            after=["create_openstack_vm"],
+            checkpoint=False)
+        scheduler.add_step(
+            "pxe_boot_openstack_vm", self._pxe_boot_openstack_vm,
+            inputs=["console_named_pipe", "ext_vswitch_name", "repo_url"],
+            after=["start_pxe_service"])
+        scheduler.add_step(
+            "reboot_openstack_vm", self._reboot_openstack_vm,
+            after=["pxe_boot_openstack_vm"])
+
+    def _create_rdo_installer(self):
+        return rdo.RDOInstaller(
+            self._send_step_output, self._stderr_callback,
+            self._cancellation_token,
+            ssh_compress=self._dep_actions.get_ssh_compression())
+
+    def _get_rdo_vm_prober(self, mgmt_ip):
+        return readiness.SSHReadinessProber(
+            mgmt_ip,
+            guest_ips_func=lambda: self._dep_actions.get_vm_ip_addresses(
+                OPENSTACK_CONTROLLER_VM_NAME),
+            cancellation_token=self._cancellation_token)
+
+    def _wait_for_rdo_vm_reboot(self, mgmt_ip):
+        self._update_status('Waiting for the RDO VM to reboot...')
+        self._get_rdo_vm_prober(mgmt_ip).wait_until_ready(
+            RDO_VM_BOOT_TIMEOUT_S)
+
+    def _connect_rdo_vm(self, rdo_installer, mgmt_ip, ssh_key_path, ssh_user,
+                        ssh_password):
+        self._update_status('Enstablishing SSH connection with RDO VM...')
+        self._get_rdo_vm_prober(mgmt_ip).wait_until_ready(
+            RDO_VM_BOOT_TIMEOUT_S)
+        rdo_installer.connect(mgmt_ip, ssh_key_path, ssh_user, ssh_password,
+                              self._term_type, self._term_cols,
+                              self._term_rows)
+
+    def _reboot_and_reconnect_rdo_vm(self, rdo_installer, mgmt_ip,
+                                     ssh_key_path, ssh_user, ssh_password):
+        self._update_status('Rebooting RDO VM...')
+        rdo_installer.reboot()
+
+        if not self._get_rdo_vm_prober(mgmt_ip).wait_for_shutdown(
+                RDO_VM_SHUTDOWN_TIMEOUT_S):
+            LOG.warn("The RDO VM did not shut down after the reboot request")
+
+        self._connect_rdo_vm(rdo_installer, mgmt_ip, ssh_key_path, ssh_user,
+                             ssh_password)
+
+    def _configure_rdo_vm_yum_proxy(self, rdo_installer, package_proxy_url):
+        self._update_status('Configuring the RDO VM package proxy...')
+        if (not rdo_installer.configure_yum_proxy(package_proxy_url) and
+                package_proxy_url):
+            LOG.warn("The package cache proxy is not reachable from the RDO "
+                     "VM, packages will be downloaded without caching them")
+
+    def _update_rdo_vm(self, rdo_installer):
+        self._update_status('Updating RDO VM...')
+        rdo_installer.update_os()
+
+    def _install_rdo(self, rdo_installer, admin_password, fip_range,
+                     fip_range_start, fip_range_end, fip_gateway,
+                     fip_name_servers):
+        self._update_status('Installing RDO...')
+        rdo_installer.install_rdo(admin_password, fip_range,
+                                  fip_range_start, fip_range_end,
+                                  fip_gateway, fip_name_servers)
+
+    def _check_rdo_vm_new_kernel(self, rdo_installer, mgmt_ip, ssh_key_path,
+                                 ssh_user, ssh_password):
+        self._update_status(
+            'Checking if rebooting the RDO VM is required...')
+        if rdo_installer.check_new_kernel():
+            self._reboot_and_reconnect_rdo_vm(
+                rdo_installer, mgmt_ip, ssh_key_path, ssh_user, ssh_password)
+
+    def _install_lis(self, rdo_installer, mgmt_ip, ssh_key_path, ssh_user,
+                     ssh_password):
+        self._update_status('Installing Hyper-V LIS components...')
+        rdo_installer.install_lis()
+        self._reboot_and_reconnect_rdo_vm(
+            rdo_installer, mgmt_ip, ssh_key_path, ssh_user, ssh_password)
+
+    def _get_nova_config(self, rdo_installer):
+        self._update_status("Retrieving OpenStack configuration...")
+        nova_config = rdo_installer.get_nova_config()
+        LOG.debug("OpenStack config: %s" % nova_config)
+
+        self._update_status('RDO successfully deployed!')
+        return nova_config
+
+    def _add_rdo_steps(self, scheduler):
+        ssh_inputs = ["rdo_installer", "mgmt_ip", "ssh_key_path", "ssh_user",
+                      "ssh_password"]
+
+        scheduler.add_step(
+            "wait_for_rdo_vm_reboot", self._wait_for_rdo_vm_reboot,
+            inputs=["mgmt_ip"],
+            after=["reboot_openstack_vm"])
+        scheduler.add_step(
+            "connect_rdo_vm", self._connect_rdo_vm,
+            inputs=ssh_inputs,
+            after=["wait_for_rdo_vm_reboot"],
+            checkpoint=False)
+        # Executed again when resuming, as the proxy might have changed
+        scheduler.add_step(
+            "configure_rdo_vm_yum_proxy", self._configure_rdo_vm_yum_proxy,
+            inputs=["rdo_installer", "package_proxy_url"],
+            after=["connect_rdo_vm"],
+            checkpoint=False)
+        scheduler.add_step(
+            "update_rdo_vm", self._update_rdo_vm,
+            inputs=["rdo_installer"],
+            after=["configure_rdo_vm_yum_proxy"])
+        scheduler.add_step(
+            "install_rdo", self._install_rdo,
+            inputs=["rdo_installer", "admin_password", "fip_range",
+                    "fip_range_start", "fip_range_end", "fip_gateway",
+                    "fip_name_servers"],
+            after=["update_rdo_vm"])
+        scheduler.add_step(
+            "check_rdo_vm_new_kernel", self._check_rdo_vm_new_kernel,
+            inputs=ssh_inputs,
+            after=["install_rdo"])
+        scheduler.add_step(
+            "install_lis", self._install_lis,
+            inputs=ssh_inputs,
+            after=["check_rdo_vm_new_kernel"])
+        scheduler.add_step(
+            "get_nova_config", self._get_nova_config,
+            inputs=["rdo_installer"],
+            outputs=["nova_config"],
+            after=["install_lis"],
+            store_outputs=False)
+
+    def _run_on_compute_hosts(self, step_name, compute_hosts,
+                              hyperv_host_username, hyperv_host_password,
+                              func):
+        """Calls func with a transport for each compute host concurrently."""
+        def _run_on_host(host):
+            transport = self._dep_actions.get_compute_host_transport(
+                host, hyperv_host_username, hyperv_host_password)
+            try:
+                func(transport)
+            finally:
+                transport.close()
+
+        def _host_completed(completed_count, hosts_count):
+            if self._progress_estimator:
+                self._progress_estimator.set_step_fraction(
+                    step_name, completed_count / float(hosts_count))
+            if hosts_count > 1:
+                self._report_progress()
+
+        self._compute_hosts_runner.run(
+            compute_hosts, _run_on_host, _host_completed)
+
+    def _check_compute_hosts(self, compute_hosts, hyperv_host_username,
+                             hyperv_host_password):
+        self._update_status('Checking the Hyper-V compute hosts...')
+        self._dep_actions.validate_compute_hosts(
+            compute_hosts, hyperv_host_username, hyperv_host_password)
+
+    def _uninstall_hyperv_components(self, compute_hosts,
+                                     hyperv_host_username,
+                                     hyperv_host_password):
         self._update_status('Checking if the OpenStack components for '
                             'Hyper-V are already installed...')
-        for msi_info in self._dep_actions.check_installed_components():
-            self._update_status('Uninstalling %s' % msi_info[1])
-            self._dep_actions.uninstall_product(
-                msi_info[0], "uninstall_%s.log" % msi_info[1])
 
-        nova_msi_path = "hyperv_nova_compute.msi"
-        freerdp_webconnect_msi_path = "freerdp_webconnect.msi"
-        try:
-            self._update_status('Downloading Hyper-V OpenStack components...')
-            self._dep_actions.download_hyperv_compute_msi(nova_msi_path)
-
-            self._update_status('Installing Hyper-V OpenStack components...')
-            self._dep_actions.install_hyperv_compute(
-                nova_msi_path, nova_config, openstack_base_dir,
-                hyperv_host_username, hyperv_host_password)
-
-            self._update_status('Downloading FreeRDP-WebConnect...')
-            self._dep_actions.download_freerdp_webconnect_msi(
-                freerdp_webconnect_msi_path)
-
-            self._update_status('Installing FreeRDP-WebConnect...')
-            self._dep_actions.install_freerdp_webconnect(
-                freerdp_webconnect_msi_path, nova_config,
-                hyperv_host_username, hyperv_host_password)
-        finally:
-            if os.path.exists(nova_msi_path):
-                os.remove(nova_msi_path)
-            if os.path.exists(freerdp_webconnect_msi_path):
-                os.remove(freerdp_webconnect_msi_path)
+        def _uninstall(transport):
+            for msi_info in self._dep_actions.check_installed_components(
+                    transport):
+                LOG.info("Uninstalling %(product)s on %(host)s",
+                         {"product": msi_info[1],
+                          "host": transport.get_hostname()})
+                self._dep_actions.uninstall_product(
+                    transport, msi_info[0], "uninstall_%s.log" % msi_info[1])
+
+        self._run_on_compute_hosts(
+            "uninstall_hyperv_components", compute_hosts,
+            hyperv_host_username, hyperv_host_password, _uninstall)
+
+    def _start_msi_prefetch(self, msi_prefetcher):
+        msi_prefetcher.start(
+            HYPERV_NOVA_MSI_NAME,
+            functools.partial(self._dep_actions.download_hyperv_compute_msi,
+                              cancellation_token=self._cancellation_token),
+            HYPERV_NOVA_MSI_PATH)
+        msi_prefetcher.start(
+            FREERDP_WEBCONNECT_MSI_NAME,
+            functools.partial(
+                self._dep_actions.download_freerdp_webconnect_msi,
+                cancellation_token=self._cancellation_token),
+            FREERDP_WEBCONNECT_MSI_PATH)
+
+    def _get_prefetched_msi(self, msi_prefetcher, name, msg):
+        if not msi_prefetcher.is_done(name):
+            self._update_status(msg)
+        return msi_prefetcher.get(name)
+
+    def _install_hyperv_compute(self, nova_config, msi_prefetcher,
+                                openstack_base_dir, compute_hosts,
+                                hyperv_host_username, hyperv_host_password):
+        nova_msi_path = self._get_prefetched_msi(
+            msi_prefetcher, HYPERV_NOVA_MSI_NAME,
+            'Downloading Hyper-V OpenStack components...')
+
+        self._update_status('Installing Hyper-V OpenStack components...')
+        self._run_on_compute_hosts(
+            "install_hyperv_compute", compute_hosts,
+            hyperv_host_username, hyperv_host_password,
+            lambda transport: self._dep_actions.install_hyperv_compute(
+                transport, nova_msi_path, nova_config, openstack_base_dir,
+                hyperv_host_username, hyperv_host_password))
+
+    def _install_freerdp_webconnect(self, nova_config, msi_prefetcher,
+                                    compute_hosts, hyperv_host_username,
+                                    hyperv_host_password):
+        freerdp_webconnect_msi_path = self._get_prefetched_msi(
+            msi_prefetcher, FREERDP_WEBCONNECT_MSI_NAME,
+            'Downloading FreeRDP-WebConnect...')
+
+        self._update_status('Installing FreeRDP-WebConnect...')
+        self._run_on_compute_hosts(
+            "install_freerdp_webconnect", compute_hosts,
+            hyperv_host_username, hyperv_host_password,
+            lambda transport: self._dep_actions.install_freerdp_webconnect(
+                transport, freerdp_webconnect_msi_path, nova_config,
+                hyperv_host_username, hyperv_host_password))
 
         self._update_status('Hyper-V OpenStack installed successfully')
 
+    def _add_hyperv_compute_steps(self, scheduler):
+        host_inputs = ["compute_hosts", "hyperv_host_username",
+                       "hyperv_host_password"]
+        # Fails early if a host cannot be reached or the credentials are
+        # not valid anymore
+        scheduler.add_step(
+            "check_compute_hosts", self._check_compute_hosts,
+            inputs=host_inputs)
+        # The existing components are kept until the controller is
+        # deployed, as a deployment failing before would leave the hosts
+        # without them
+        scheduler.add_step(
+            "uninstall_hyperv_components",
+            self._uninstall_hyperv_components,
+            inputs=host_inputs,
+            after=["get_nova_config", "check_compute_hosts"])
+        # MSI installs cannot run in parallel on the same host, the hosts
+        # are deployed concurrently within each step
+        scheduler.add_step(
+            "install_hyperv_compute", self._install_hyperv_compute,
+            inputs=["nova_config", "msi_prefetcher",
+                    "openstack_base_dir"] + host_inputs,
+            after=["uninstall_hyperv_components"])
+        scheduler.add_step(
+            "install_freerdp_webconnect", self._install_freerdp_webconnect,
+            inputs=["nova_config", "msi_prefetcher"] + host_inputs,
+            after=["install_hyperv_compute"])
+
     def _validate_deployment(self, rdo_installer):
         self._update_status('Validating OpenStack deployment...')
         # Skip for now
         # rdo_installer.check_hyperv_compute_services(platform.node())
 
+    def _load_deployment_journal(self, args, vm_name):
+        """Returns True if a previous deployment can be resumed."""
+        fingerprint = deployment_journal.get_fingerprint(args)
+        if not self._journal.load(fingerprint):
+            return False
+
+        # The controller VM installation cannot be resumed half-way
+        ssh_key_path = self._journal.get_step_outputs(
+            "generate_ssh_key").get("ssh_key_path")
+        if (not self._journal.is_step_completed("reboot_openstack_vm") or
+                not self._dep_actions.vm_exists(vm_name) or
+                not ssh_key_path or not os.path.exists(ssh_key_path)):
+            LOG.info("The previous deployment cannot be resumed")
+            self._journal.reset()
+            return False
+
+        LOG.info("Resuming the previous deployment")
+        return True
+
+    def _save_deployment_timeline(self, deployment_timeline, success):
+        deployment_timeline.stop(success)
+        try:
+            timelines_dir = os.path.join(self._data_dir, TIMELINES_DIR_NAME)
+            if not os.path.isdir(timelines_dir):
+                os.makedirs(timelines_dir)
+
+            base_path = os.path.join(
+                timelines_dir,
+                time.strftime("%Y%m%d-%H%M%S", time.localtime()))
+            deployment_timeline.save("%s.json" % base_path,
+                                     "%s.trace.json" % base_path)
+        except Exception as ex:
+            LOG.exception(ex)
+            LOG.error("Failed to save the deployment timeline")
+
+    def _get_deployment_scheduler(self):
+        scheduler = deployment_scheduler.StepScheduler(
+            max_workers=MAX_CONCURRENT_DEPLOYMENT_STEPS)
+        self._add_openstack_vm_steps(scheduler)
+        self._add_rdo_steps(scheduler)
+        self._add_hyperv_compute_steps(scheduler)
+        scheduler.add_step(
+            "validate_deployment", self._validate_deployment,
+            inputs=["rdo_installer"],
+            after=["install_freerdp_webconnect"])
+        return scheduler
+
     def _get_default_openstack_base_dir(self):
         if sys.platform == 'win32':
             drive = os.environ['SYSTEMDRIVE']
@@ -391,26 +795,56 @@ class Worker(object):
         finally:
             self._stop_progress_status()
 
+    def invalidate_host_probes(self):
+        """Makes the next get_config call probe the host again."""
+        self._host_probes_cache.invalidate()
+
+    def _get_openstack_vm_memory_mb(self):
+        try:
+            # TODO: This data should not be retrieved if there is no
+            # hypervisor
+            return self._host_probes_cache.get(
+                "openstack_vm_memory_mb",
+                lambda: self._dep_actions.get_openstack_vm_memory_mb(
+                    OPENSTACK_CONTROLLER_VM_NAME))
+        except Exception as ex:
+            LOG.exception(ex)
+            return (0, 0, 0)
+
+    def _probe_host(self):
+        probes = [
+            ("openstack_vm_memory_mb", self._get_openstack_vm_memory_mb),
+            ("cpu_count", functools.partial(
+                self._host_probes_cache.get, "cpu_count",
+                utils.get_cpu_count)),
+            ("curr_user", functools.partial(
+                self._host_probes_cache.get, "curr_user",
+                self._dep_actions.get_current_user)),
+            ("proxy_url", functools.partial(
+                self._host_probes_cache.get, "proxy_url", utils.get_proxy)),
+            ("name_servers", functools.partial(
+                self._host_probes_cache.get, "name_servers", utils.get_dns)),
+        ]
+
+        # The probes are independent, run them concurrently
+        scheduler = deployment_scheduler.StepScheduler(
+            max_workers=len(probes))
+        for (name, func) in probes:
+            scheduler.add_step("probe_%s" % name, func, outputs=[name])
+        return scheduler.run()
+
     def get_config(self):
         try:
             LOG.debug("get_config called")
 
             self._start_progress_status('Loading default values...')
 
-            min_mem_mb = 0
-            suggested_mem_mb = 0
-            max_mem_mb = 0
+            host_info = self._probe_host()
 
-            try:
-                # TODO: This data should not be retrieved if there is no
-                # hypervisor
-                (min_mem_mb, suggested_mem_mb,
-                 max_mem_mb) = self._dep_actions.get_openstack_vm_memory_mb(
-                    OPENSTACK_CONTROLLER_VM_NAME)
-            except Exception as ex:
-                LOG.exception(ex)
+            (min_mem_mb, suggested_mem_mb,
+             max_mem_mb) = host_info["openstack_vm_memory_mb"]
 
-            cpu_count = utils.get_cpu_count()
+            cpu_count = host_info["cpu_count"]
 
             suggested_openstack_vm_vcpu_count = min(
                 cpu_count,
@@ -421,10 +855,10 @@ class Worker(object):
             fip_range_end = None
             fip_gateway = None
 
-            curr_user = self._dep_actions.get_current_user()
+            curr_user = host_info["curr_user"]
 
-            proxy_url = utils.get_proxy()
-            name_servers = utils.get_dns()
+            proxy_url = host_info["proxy_url"]
+            name_servers = host_info["name_servers"]
 
             config_dict = {
                 "default_openstack_base_dir":
@@ -447,6 +881,7 @@ class Worker(object):
                 "default_mgmt_ext_dhcp": False,
                 "default_mgmt_ext_name_servers": name_servers,
                 "localhost": socket.gethostname(),
+                "default_compute_hosts": self._dep_actions.get_compute_hosts(),
             }
 
             return config_dict
@@ -631,6 +1066,8 @@ class Worker(object):
             LOG.debug("remove_openstack_deployment called")
             self._dep_actions.check_remove_vm(OPENSTACK_CONTROLLER_VM_NAME)
             self._dep_actions.set_openstack_deployment_status(False)
+            self._journal.clear()
+            self.invalidate_host_probes()
             return True
         except Exception as ex:
             LOG.exception(ex)
@@ -642,17 +1079,30 @@ class Worker(object):
             # TODO: evaluate synchronizing access to _cancel_deployment
             if not self._cancel_deployment:
                 self._cancel_deployment = True
-                self._dep_actions.check_remove_vm(OPENSTACK_CONTROLLER_VM_NAME)
+                # Interrupt the running operations before removing the VM
+                self._cancellation_token.cancel()
+                with cancellation.detached():
+                    self._dep_actions.check_remove_vm(
+                        OPENSTACK_CONTROLLER_VM_NAME)
+                self._journal.clear()
         except Exception as ex:
             LOG.exception(ex)
             self._error_callback(ex)
 
     def deploy_openstack(self, args):
+        deployment_timeline = timeline.Timeline()
+        timeline.set_active_timeline(deployment_timeline)
+        # The logs written during the deployment are archived with its ID
+        self._log_store.set_deployment_id(
+            time.strftime("%Y%m%d-%H%M%S", time.localtime()))
+        success = False
         try:
             self._start_progress_status('Deployment started')
 
             self._is_install_done = False
             self._cancel_deployment = False
+            self._cancellation_token = cancellation.CancellationToken()
+            cancellation.set_active_token(self._cancellation_token)
 
             self._dep_actions.set_openstack_deployment_status(False)
 
@@ -689,6 +1139,9 @@ class Worker(object):
 
             hyperv_host_username = args.get("hyperv_host_username")
             hyperv_host_password = args.get("hyperv_host_password")
+            compute_hosts = (args.get("compute_hosts") or
+                             [compute.LOCALHOST])
+            self._validate_compute_hosts(compute_hosts)
 
             fip_range = str(netaddr.IPNetwork(args.get("fip_range")).cidr)
             fip_range_start = str(netaddr.IPAddress(
@@ -700,41 +1153,75 @@ class Worker(object):
             fip_name_servers = args.get("fip_name_servers")
 
             self._curr_step = 0
-            self._max_steps = 27
+            self._max_steps = 29
 
             self._dep_actions.check_platform_requirements()
-            rdo_installer = rdo.RDOInstaller(self._stdout_callback,
-                                             self._stderr_callback)
-
-            (mgmt_ip, ssh_user, ssh_key_path) = self._deploy_openstack_vm(
-                ext_vswitch_name, openstack_vm_vcpu_count,
-                openstack_vm_mem_mb, openstack_base_dir,
-                admin_password, repo_url,
-                mgmt_ext_ip, mgmt_ext_netmask,
-                mgmt_ext_gateway, mgmt_ext_name_servers, proxy_url,
-                proxy_username, proxy_password)
-
-            # Authenticate with the SSH key
-            ssh_password = None
-            # ssh_password = admin_password
-
-            nova_config = self._install_rdo(rdo_installer, mgmt_ip,
-                                            ssh_key_path, ssh_user,
-                                            ssh_password, admin_password,
-                                            fip_range, fip_range_start,
-                                            fip_range_end, fip_gateway,
-                                            fip_name_servers)
-            LOG.debug("OpenStack config: %s" % nova_config)
-
-            self._install_local_hyperv_compute(nova_config,
-                                               openstack_base_dir,
-                                               hyperv_host_username,
-                                               hyperv_host_password)
-            self._validate_deployment(rdo_installer)
+            rdo_installer = self._create_rdo_installer()
+
+            vm_name = OPENSTACK_CONTROLLER_VM_NAME
+            self._load_deployment_journal(args, vm_name)
+
+            # Download the Hyper-V components while the controller is
+            # being deployed
+            msi_prefetcher = prefetch.DownloadPrefetcher()
+            # Stops the downloads and removes their files on any failure
+            try:
+                if not self._journal.is_step_completed(
+                        "install_freerdp_webconnect"):
+                    self._start_msi_prefetch(msi_prefetcher)
+
+                context = {
+                    "vm_name": vm_name,
+                    "vm_dir": os.path.join(openstack_base_dir, vm_name),
+                    "console_named_pipe":
+                        self._dep_actions.get_console_named_pipe(vm_name),
+                    "ext_vswitch_name": ext_vswitch_name,
+                    "repo_url": repo_url,
+                    "openstack_vm_mem_mb": openstack_vm_mem_mb,
+                    "openstack_vm_vcpu_count": openstack_vm_vcpu_count,
+                    "openstack_base_dir": openstack_base_dir,
+                    "admin_password": admin_password,
+                    "mgmt_ext_ip": mgmt_ext_ip,
+                    "mgmt_ext_netmask": mgmt_ext_netmask,
+                    "mgmt_ext_gateway": mgmt_ext_gateway,
+                    "mgmt_ext_name_servers": mgmt_ext_name_servers,
+                    "proxy_url": proxy_url,
+                    "proxy_username": proxy_username,
+                    "proxy_password": proxy_password,
+                    "hyperv_host_username": hyperv_host_username,
+                    "hyperv_host_password": hyperv_host_password,
+                    "compute_hosts": compute_hosts,
+                    "fip_range": fip_range,
+                    "fip_range_start": fip_range_start,
+                    "fip_range_end": fip_range_end,
+                    "fip_gateway": fip_gateway,
+                    "fip_name_servers": fip_name_servers,
+                    "rdo_installer": rdo_installer,
+                    "msi_prefetcher": msi_prefetcher,
+                    "ssh_user": "root",
+                    # Authenticate with the SSH key
+                    "ssh_password": None,
+                }
+
+                self._progress_estimator = progress.ProgressEstimator(
+                    progress.ProgressHistory(os.path.join(
+                        self._data_dir,
+                        "%s-progress-history.json" % constants.PRODUCT_NAME)),
+                    self._report_progress)
+
+                self._get_deployment_scheduler().run(
+                    context, self._journal, self._progress_estimator)
+            finally:
+                rdo_installer.disconnect()
+                msi_prefetcher.cleanup()
 
             self._update_status('Your OpenStack deployment is ready!')
 
+            self._progress_estimator.save_history()
+            self._journal.clear()
             self._dep_actions.set_openstack_deployment_status(True)
+            self._dep_actions.set_compute_hosts(compute_hosts)
+            success = True
             return True
             self._stop_progress_status()
         except Exception as ex:
@@ -750,14 +1237,30 @@ class Worker(object):
             self._error_callback(ex)
             return False
         finally:
+            cancellation.set_active_token(None)
+            self._progress_estimator = None
             self._dep_actions.stop_pxe_service()
+            self._dep_actions.stop_package_proxy()
+            # The available host memory changed
+            self.invalidate_host_probes()
+            timeline.set_active_timeline(None)
+            self._save_deployment_timeline(deployment_timeline, success)
+            self._log_store.set_deployment_id(None)
             self._is_install_done = True
 
-    def validate_host_config(self, username, password):
+    def validate_host_config(self, username, password, compute_hosts=None):
         try:
             LOG.debug("validate_host_config called")
             self._start_progress_status("Validating Hyper-V host user...")
             self._dep_actions.validate_host_user(username, password)
+
+            if compute_hosts is not None:
+                LOG.debug("compute_hosts: %s", compute_hosts)
+                self._validate_compute_hosts(compute_hosts)
+                self._start_progress_status(
+                    "Validating the Hyper-V compute hosts...")
+                self._dep_actions.validate_compute_hosts(
+                    compute_hosts, username, password)
             return True
         except Exception as ex:
             LOG.exception(ex)
@@ -791,6 +1294,26 @@ class Worker(object):
                 Worker._validate_single_ip_address(
                     name_server, "Invalid name server: %s")
 
+    @staticmethod
+    def _validate_compute_hosts(compute_hosts):
+        if not compute_hosts:
+            raise exceptions.BaseVMagineException(
+                "At least one compute host is required")
+
+        hosts = set()
+        for host in compute_hosts:
+            if not host or not utils.is_valid_hostname(host):
+                Worker._validate_single_ip_address(
+                    host, "Invalid compute host: %s")
+
+            # The local host can be referred to with different names
+            key = compute.LOCALHOST if compute.is_localhost(host) else (
+                host.lower())
+            if key in hosts:
+                raise exceptions.BaseVMagineException(
+                    "Duplicate compute host: %s" % host)
+            hosts.add(key)
+
     def validate_openstack_networking_config(self, fip_range, fip_range_start,
                                              fip_range_end, fip_gateway,
                                              fip_name_servers):
@@ -25,6 +25,7 @@ angular.module('stackInABoxApp', []).controller('StackInABoxCtrl',
       $scope.hypervHostUsername = null;
       $scope.hypervHostPassword = null;
       $scope.hypervHostName = null;
+      $scope.computeHosts = [];
       $scope.controllerIp = null;
       $scope.horizonUrl = null;
       $scope.downloadUrl = null;
@@ -180,12 +181,12 @@ function getAvailableHostNicsCompleted(hostNicsJson) {
 
 function gotStdOutData(data){
     console.log(data);
-    term.write(data.replace('\n', '\r\n'));
+    term.write(data.replace(/\r?\n/g, '\r\n'));
 }
 
 function gotStdErrData(data){
     console.log("err: " + data);
-    term.write(data.replace('\n', '\r\n'));
+    term.write(data.replace(/\r?\n/g, '\r\n'));
 }
 
 function getDeploymentConfigDict() {
@@ -200,6 +201,7 @@ function getDeploymentConfigDict() {
     dict["admin_password"] = $scope.adminPassword;
     dict["hyperv_host_username"] = $scope.hypervHostUsername;
     dict["hyperv_host_password"] = $scope.hypervHostPassword;
+    dict["compute_hosts"] = $scope.computeHosts;
     dict["fip_range"] = $scope.fipRange;
     dict["fip_range_start"] = $scope.fipRangeStart;
     dict["fip_range_end"] = $scope.fipRangeEnd;
@@ -370,6 +372,7 @@ function configCompleted(configJson) {
     $scope.mgmtExtDhcp = defaultConfig.default_mgmt_ext_dhcp;
     $scope.mgmtExtNameServers = defaultConfig.default_mgmt_ext_name_servers;
     $scope.hypervHostName = defaultConfig.localhost;
+    $scope.computeHosts = defaultConfig.default_compute_hosts;
 
     $scope.$apply();
 
@@ -599,6 +602,7 @@ function initUi() {
         }
         $("#hypervhostusername").removeClass("hide_validation");
         $("#hypervhostpassword").removeClass("hide_validation");
+        $("#computehosts").removeClass("hide_validation");
         return false;
     });
 